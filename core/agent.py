@@ -4,9 +4,14 @@ core/agent.py
 This file contains the agent implementation.
 """
 
-import ast
 import json
+from concurrent.futures import ThreadPoolExecutor
+from core.json_stream import IncrementalJSONParser, parse_function_call
+from core.tool_registry import ToolRegistry
 from models import llm
+from models.backend import get_backend
+from models.tokens import context_window, truncate_to_tokens
+from modules.history import TRUNCATION_MARKER, ConversationHistory
 from textwrap import dedent
 from tools import (
     browse,
@@ -25,6 +30,15 @@ from dataviz.visualizer.visualizer import Visualizer
 
 USE_FUNCTION_CALLS = True
 
+# Share of the model's context window for the message history resent on
+# every step. The objective and plan are always kept; older steps are evicted
+# to stay within it.
+HISTORY_CONTEXT_FRACTION = 0.5
+# Number of tools (besides UserInput) whose schemas are sent on each step.
+TOOLS_PER_STEP = 4
+# Tool output beyond this many tokens is cut off before it enters the prompt.
+MAX_TOOL_OUTPUT_TOKENS = 1000
+
 INTRO_PROMPT = """You are an intelligent agent that is given the following objective:
 {objective}
 
@@ -53,6 +67,9 @@ Use the following structure to your response:
 2. PLAN: Define the next action, re-planning if necessary.
 3. ACTION: Provide the next action in JSON format. ONLY output JSON.
 
+The tools you can use for this action are:
+{tool_prompt}
+
 If the you feel that the task is complete, use the UserInput tool to confirm.
 If you are stuck, ask the UserInput for clarification.
 
@@ -70,7 +87,7 @@ If provided, the output (or error) from the tool used is provided below:
 Now, continue working towards the objective.
 
 As a reminder, here are the tools you can use:
-{tool_prompt}
+{tool_names}
 
 If the you feel that the task is complete, use the UserInput tool to confirm.
 If you are stuck, ask the UserInput for clarification.
@@ -97,11 +114,19 @@ class Agent:
         self.model = llm.LLM(model="gpt-3.5-turbo", max_tokens=1000, temperature=0.0)
         self.visualizer = Visualizer("/tmp/openagi_data.json")
         self.tools = []
+        self.registry = None
+        # Tools run here so they can start while the response is still streaming.
+        self.tool_executor = ThreadPoolExecutor(max_workers=1)
         self.tool_prompt = ""
         self.initial_plan = ""
         self.current_plan = ""
-        self.messages = []
-        self.assistant_messages = []
+        # The history is resent with every step's call, so it's sized for the
+        # model those calls go to.
+        self.step_model = llm.FUNCTION_CALL_MODEL if USE_FUNCTION_CALLS else self.model.model
+        self.history = ConversationHistory(
+            token_budget=int(context_window(self.step_model) * HISTORY_CONTEXT_FRACTION),
+            model=self.step_model,
+        )
 
     def initialize(self):
         self.state = AgentState.INITIALIZING
@@ -120,11 +145,13 @@ class Agent:
             user_input.UserInput(),
         ]
 
-        tool_strings = [str(tool.json_openai()) for tool in self.tools]
-        self.tool_prompt = "\n".join(tool_strings)
+        self.registry = ToolRegistry(self.tools)
+        # Pinned in the history and re-sent every step, so only names and
+        # descriptions; the selected tools' schemas are sent with each step.
+        self.tool_prompt = self.registry.summary()
 
         # Ask the user for what the agent objective is
-        self.objective = input(
+        self.objective = get_backend().user_input(
             """\033[1m
 Hi, my name is DAN. I am a general agent that can Do Anything Now.
 What can I do for you today?\n\n\033[0m> """
@@ -138,25 +165,117 @@ What can I do for you today?\n\n\033[0m> """
         )
         print("\033[95m" + prompt + "\033[0m")
         viz_id = self.visualizer.add_new_stage(title="Planning", content="Thinking...")
-        response = self.model.generate_chat_completion(prompt)
-        print("\033[94m" + response)
-        self.visualizer.amend_stage(stage_id=viz_id, content=response)
-        self.messages.append({"role": "user", "content": prompt})
-        self.messages.append({"role": "assistant", "content": response})
+        response = self.stream_to_stage(self.model.stream_chat_completion(prompt), viz_id)
+        self.history.pin({"role": "user", "content": prompt})
+        self.history.pin({"role": "assistant", "content": response})
         self.initial_plan = self.current_plan = response
         self.state = AgentState.RUNNING
 
+    def stream_to_stage(self, chunks, viz_id):
+        """Prints and visualizes streamed content as it arrives. Returns the full text."""
+        pieces = []
+        print("\033[94m", end="")
+        for chunk in chunks:
+            print(chunk, end="", flush=True)
+            # The first chunk replaces the "Thinking..." placeholder.
+            self.visualizer.amend_stage(stage_id=viz_id, content=chunk, append=bool(pieces))
+            pieces.append(chunk)
+        print("\033[0m")
+        response = "".join(pieces)
+        self.visualizer.amend_stage(stage_id=viz_id, content=response)
+        print(self.model.stream_stats[-1])
+        return response
+
+    def stream_message(self, deltas, viz_id, on_function_call=None):
+        """Accumulates streamed deltas into a message dict with content and/or
+        function_call, rendering any content as it arrives.
+
+        If given, on_function_call(name, arguments) is called as soon as the
+        function_call arguments form a complete JSON object, without waiting for
+        the rest of the stream. Returns the message and the callback's result.
+        """
+        content = []
+        function_call = None
+        parser = IncrementalJSONParser()
+        dispatched = None
+        for delta in deltas:
+            if delta.get("content"):
+                print("\033[94m" + delta["content"] + "\033[0m", end="", flush=True)
+                self.visualizer.amend_stage(
+                    stage_id=viz_id, content=delta["content"], append=bool(content)
+                )
+                content.append(delta["content"])
+            if delta.get("function_call"):
+                if function_call is None:
+                    function_call = {"name": "", "arguments": ""}
+                function_call["name"] += delta["function_call"].get("name", "")
+                fragment = delta["function_call"].get("arguments", "")
+                function_call["arguments"] += fragment
+                if on_function_call is not None and not parser.complete and parser.feed(fragment):
+                    try:
+                        dispatched = on_function_call(function_call["name"], parser.value())
+                    except ValueError:
+                        # Malformed arguments are reported once the stream ends.
+                        pass
+        print()
+        print(self.model.stream_stats[-1])
+
+        message = {"role": "assistant", "content": "".join(content) or None}
+        if function_call is not None:
+            message["function_call"] = function_call
+            self.visualizer.amend_stage(stage_id=viz_id, content=str(function_call))
+        return message, dispatched
+
+    def run_tool(self, name, arguments):
+        tool = self.registry.by_name.get(name)
+        if tool is None:
+            raise ValueError(f"Unknown tool: {name}")
+        print("RUNNING TOOL:", tool)
+        print("INPUTS:", arguments)
+
+        def run():
+            tool.parse_input(arguments)
+            return tool.run()
+
+        return get_backend().run_tool(name, arguments, run)
+
+    def dispatch_tool(self, name, arguments):
+        """Starts running a tool in the background and returns its future."""
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments)
+        return self.tool_executor.submit(self.run_tool, name, arguments)
+
     def run(self):
         tool_output = None
+        # Set when the model asked for a tool it wasn't sent, so that the next
+        # step offers the whole catalog.
+        send_all_tools = False
 
         while self.state == AgentState.RUNNING:
+            if tool_output is not None:
+                tool_output = truncate_to_tokens(
+                    str(tool_output), MAX_TOOL_OUTPUT_TOKENS, self.step_model, TRUNCATION_MARKER
+                )
+
+            # Only the tools relevant to the objective, the latest plan and the
+            # last tool output are sent.
+            if send_all_tools:
+                tool_names = list(self.registry.by_name)
+            else:
+                tool_names = self.registry.select(
+                    "\n".join([self.objective, self.current_plan, str(tool_output or "")]),
+                    top_k=TOOLS_PER_STEP,
+                )
+
             # Generate a chat completion
             prompt = dedent(
                 FUNC_CALL_PROMPT.format(
-                    tool_output=tool_output, tool_prompt=self.tool_prompt
+                    tool_output=tool_output, tool_names=", ".join(tool_names)
                 )
                 if USE_FUNCTION_CALLS
-                else ORIG_TOOL_PROMPT.format(tool_output=tool_output)
+                else ORIG_TOOL_PROMPT.format(
+                    tool_output=tool_output, tool_prompt=self.registry.prompt_for(tool_names)
+                )
             )
             print("\033[95m" + prompt + "\033[0m")
             viz_id = self.visualizer.add_new_stage(
@@ -164,57 +283,57 @@ What can I do for you today?\n\n\033[0m> """
             )
 
             if USE_FUNCTION_CALLS:
-                functions = [tool.json_openai() for tool in self.tools]
-                print("Functions:", functions)
-                message = self.model.generate_chat_completion_with_functions(
-                    prompt, self.messages + self.assistant_messages, functions
+                functions = self.registry.schemas_for(tool_names)
+                print("Functions:", [function["name"] for function in functions])
+                message, tool_future = self.stream_message(
+                    self.model.stream_chat_completion_with_functions(
+                        prompt, self.history.messages(), functions
+                    ),
+                    viz_id,
+                    on_function_call=self.dispatch_tool,
                 )
 
+                response = None
                 try:
                     print("Message:", message)
-                    response = None
                     if "function_call" in message:
                         print(
                             "\033[94m"
                             + "Function call: "
-                            + str(message.function_call)
+                            + str(message["function_call"])
                             + "\033[0m"
                         )
-                        response = message.function_call
+                        response = message["function_call"]
                     else:
-                        print("\033[94m" + str(message.content) + "\033[0m")
-                        response = ast.literal_eval(message.content)
+                        response = parse_function_call(message["content"])
                         # Strip out "function."
                         if "function." in response["name"]:
                             response["name"] = response["name"].split(".")[1]
                 except Exception as error:
                     print(f"Error parsing message.content: {error}")
+                if message.get("content"):
+                    self.current_plan = message["content"]
+                send_all_tools = not isinstance(response, dict) or response.get("name") not in tool_names
 
-                # Use the function call to get the tool by name
-                function_name = response["name"]
-                tool = None
-                for t in self.tools:
-                    if type(t).__name__ == function_name:
-                        tool = t
-                        break
-
-                print("RUNNING TOOL:", tool)
-
-                # Set the tool's input
                 try:
-                    print("INPUTS:", response["arguments"])
-                    tool.parse_input(json.loads(response["arguments"]))
-                    # If no errors, run the tool and capture the output.
-                    tool_output = tool.run()
+                    # The tool was already started if its arguments streamed in
+                    # as a complete object; otherwise start it now.
+                    if tool_future is None:
+                        tool_future = self.dispatch_tool(
+                            response["name"], response["arguments"]
+                        )
+                    tool_output = tool_future.result()
                 except Exception as error:
                     tool_output = str(error)
                     print("Error: " + tool_output)
 
             else:
-                response = self.model.generate_chat_completion(
-                    prompt, self.messages + self.assistant_messages
+                response = self.stream_to_stage(
+                    self.model.stream_chat_completion(
+                        prompt, self.history.messages()
+                    ),
+                    viz_id,
                 )
-                print("\033[94m" + response + "\033[0m")
 
                 # Parse the text response after "ACTION" as JSON.
                 action_str = response.split("ACTION:")[1]
@@ -226,6 +345,8 @@ What can I do for you today?\n\n\033[0m> """
                 )
 
                 print("Action str:", action_str)
+                # The reflection and plan that preceded the action.
+                self.current_plan = response.split("ACTION:")[0]
 
                 output = json.loads(action_str)
                 if "action" not in output:
@@ -237,18 +358,9 @@ What can I do for you today?\n\n\033[0m> """
                     print("FINAL RESULT:\n\n" + output["output"])
                     return
 
-                # Get the tool by name
-                tool = None
-                for t in self.tools:
-                    if type(t).__name__ == output["action"]:
-                        tool = t
-                        break
-
-                # Set the tool's input
+                send_all_tools = output["action"] not in tool_names
                 try:
-                    tool.parse_input(output["input"])
-                    # If no errors, run the tool and capture the output.
-                    tool_output = tool.run()
+                    tool_output = self.run_tool(output["action"], output["input"])
                 except Exception as error:
                     tool_output = str(error)
                     print("Error: " + tool_output)
@@ -257,17 +369,15 @@ What can I do for you today?\n\n\033[0m> """
                     title=output["action"], content=str(tool_output)
                 )
 
-            if len(self.assistant_messages) > 10:
-                self.assistant_messages.pop(0)
-                self.assistant_messages.pop(0)
-            self.assistant_messages.append({"role": "user", "content": prompt})
-            self.assistant_messages.append(
-                {"role": "assistant", "content": str(response)}
+            self.history.append_turn(
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": str(response)},
             )
+            print(f"History: {self.history.total_tokens} tokens")
 
             # TODO: Add the tool input and output to messages
             # if output["action"] == "UserInput":
-            #     self.assistant_messages.append({"role": "user", "content": str(tool_output)})
+            #     self.history.append({"role": "user", "content": str(tool_output)})
 
             # # Fake the tool being run by getting user input
             # tool_output = input("Please enter the output from the tool:\n")
@@ -4,13 +4,18 @@ core/agent.py
 This file contains an experimental agent implementation.
 """
 
+import hashlib
 import json
+import os
+from functools import partial
 from models import llm
+from models.backend import get_backend
 from textwrap import dedent
+from modules.memory_stores.memory_client import RemoteVectorStore
 from modules.memory_stores.vector_store import VectorStore
 from dataviz.visualizer.visualizer import Visualizer
+from models.tokens import remaining_tokens, truncate_to_tokens
 from tools import browse, code, datetime_tool, location, search, summarize, terminal, user_input
-import tiktoken
 
 
 class AgentState:
@@ -55,9 +60,16 @@ class Agent:
         self.tool_prompt = "\n".join(tool_strings)
 
         # Ask the user for what the agent objective is
-        self.objective = input("What is my objective?\n")
+        self.objective = get_backend().user_input("What is my objective?\n")
         self.visualizer.add_new_stage(title="Objective", content=self.objective)
-        self.memory = VectorStore(dedent(
+        # With a memory server, agents in other processes working on the same
+        # objective share this memory. OPENAGI_MEMORY_STORE picks the store.
+        if os.environ.get("OPENAGI_MEMORY_SERVER"):
+            memory_class = partial(RemoteVectorStore, os.environ.get("OPENAGI_MEMORY_STORE")
+                                   or "experimental_agent-" + hashlib.sha1(self.objective.encode()).hexdigest()[:16])
+        else:
+            memory_class = VectorStore
+        self.memory = memory_class(dedent(
             """
             On a scale of 1 to 10, where 1 is completely useless, and 10 is actually achieving the goal, rate the importance
             of the following piece of memory when it comes to achieving the following goal.
@@ -68,7 +80,10 @@ class Agent:
             Rate this piece of memory:
             {}
             """
-        ), self.objective)
+        ), self.objective,
+            # A reflection is added every step; merge near-identical ones and
+            # cap the total so the planning prompt stays bounded.
+            dedup_threshold=0.97, max_items=1000)
         self.state = AgentState.RUNNING
 
     def run(self):
@@ -174,11 +189,13 @@ If the task is complete, output the following JSON:
                     tool = t
                     break
             
-            # Set the tool's input
-            tool.parse_input(output["input"])
-            
-            # If no errors, run the tool and capture the output.
-            tool_output = tool.run()
+            def run_tool():
+                # Set the tool's input
+                tool.parse_input(output["input"])
+                # If no errors, run the tool and capture the output.
+                return tool.run()
+
+            tool_output = get_backend().run_tool(output["action"], output["input"], run_tool)
 
             # Action is over, now entering reflection stage.
             reflection_prompt = self.build_reflection_prompt(output["action"], output["input"], tool_output)
@@ -188,7 +205,7 @@ If the task is complete, output the following JSON:
             self.visualizer.amend_stage(stage_id=viz_id, content=reflection_response)
             print("Printing reflection response: ", reflection_response)
             self.memory.add(reflection_response)
-            dummy = input("PAUSE")
+            dummy = get_backend().user_input("PAUSE")
             
             # # Fake the tool being run by getting user input
             # tool_output = input("Please enter the output from the tool:\n")
@@ -207,15 +224,15 @@ You should summarize the actual output itself, not just meta-information about t
 The output itself will be discarded, and only your summary will be kept. So, if there is anything you want to remember, put it in your summary.
         """)
     
-        encoding = tiktoken.get_encoding("cl100k_base")
-        system_prompt_tokens = len(encoding.encode(self.secondary_model.system_prompt))
-        base_prompt_tokens = len(encoding.encode(base_prompt))
-        tokens_remaining = 4096 - system_prompt_tokens - base_prompt_tokens - self.secondary_model.max_tokens
+        tokens_remaining = remaining_tokens(
+            self.secondary_model.model,
+            self.secondary_model.max_tokens,
+            self.secondary_model.system_prompt,
+            base_prompt,
+        )
 
-        output_encoding = encoding.encode(str(output))
         # We have to make sure we don't overflow the context window.
-        output_encoding = output_encoding[:tokens_remaining]
-        output = encoding.decode(output_encoding)
+        output = truncate_to_tokens(str(output), tokens_remaining, self.secondary_model.model)
         return dedent(f"""
  You are an AI agent tasked with solving the following objective: {self.objective}.
 
@@ -0,0 +1,96 @@
+"""
+core/json_stream.py
+
+Helpers for parsing JSON produced by the LLM, either streamed in fragments or
+embedded in free-form text.
+"""
+
+import ast
+import json
+
+
+class IncrementalJSONParser:
+    """Consumes a JSON object in fragments and reports when it is complete.
+
+    Only the nesting structure is tracked while feeding, so each fragment costs
+    time proportional to its length. The text is decoded once, after the
+    top-level object closes.
+    """
+
+    def __init__(self):
+        self.fragments = []
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+        # Any text that arrived after the top-level object closed.
+        self.trailing = ""
+
+    def feed(self, fragment: str) -> bool:
+        """Adds a fragment. Returns True once the top-level object has closed."""
+        if self.complete:
+            self.trailing += fragment
+            return True
+        for i, char in enumerate(fragment):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                self.started = True
+            elif char in "}]":
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    self.fragments.append(fragment[:i + 1])
+                    self.trailing = fragment[i + 1:]
+                    self.complete = True
+                    return True
+        self.fragments.append(fragment)
+        return False
+
+    def text(self) -> str:
+        return "".join(self.fragments)
+
+    def value(self):
+        """Decodes the completed object."""
+        if not self.complete:
+            raise ValueError("JSON object is not complete yet")
+        return json.loads(self.text())
+
+
+def extract_json_object(text: str):
+    """Returns the first complete JSON object found in text, or None."""
+    start = text.find("{")
+    while start != -1:
+        parser = IncrementalJSONParser()
+        if parser.feed(text[start:]):
+            try:
+                return parser.value()
+            except ValueError:
+                pass
+        start = text.find("{", start + 1)
+    return None
+
+
+def parse_function_call(content: str) -> dict:
+    """Parses a function call that the model wrote as text instead of a function_call.
+
+    Strict JSON is tried first, then the first JSON object embedded in the text
+    (e.g. inside a code fence). ast.literal_eval is only the last resort, for
+    Python-style dicts with single quotes.
+    """
+    try:
+        return json.loads(content)
+    except ValueError:
+        pass
+    value = extract_json_object(content)
+    if isinstance(value, dict) and "name" in value:
+        return value
+    return ast.literal_eval(content.strip())
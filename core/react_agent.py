@@ -1,3 +1,4 @@
+from models.backend import get_backend
 from models.llm import LLM
 import re
 
@@ -84,7 +85,8 @@ def query(question, max_turns=5):
             if action not in known_actions:
                 raise Exception("Unknown action: {}: {}".format(action, action_input))
             print(" -- running {} {}".format(action, action_input))
-            observation = known_actions[action](action_input)
+            observation = get_backend().run_tool(
+                action, action_input, lambda: known_actions[action](action_input))
             print("Observation:", observation)
             next_prompt = "Observation: {}".format(observation)
         else:
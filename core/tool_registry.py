@@ -0,0 +1,119 @@
+"""
+core/tool_registry.py
+
+This file contains the registry of tools available to an agent.
+
+The registry builds each tool's OpenAI function schema once, and keeps a small
+TF-IDF keyword index over the tool descriptions so that each step only needs
+to send the tools relevant to the objective and plan.
+"""
+
+import math
+import re
+from collections import Counter
+
+from core.tool import BaseTool
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "i", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "use", "with", "you", "your",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    # Split CamelCase names like "SendEmail" into separate words first.
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOP_WORDS]
+
+
+class ToolRegistry:
+    def __init__(self, tools: list[BaseTool], always_include=("UserInput",)):
+        self.tools = list(tools)
+        self.by_name = {type(tool).__name__: tool for tool in self.tools}
+        # Tools sent on every step regardless of relevance.
+        self.always_include = [name for name in always_include if name in self.by_name]
+        self.schemas = {name: tool.json_openai() for name, tool in self.by_name.items()}
+        self.prompts = {name: str(schema) for name, schema in self.schemas.items()}
+        self._build_index()
+
+    def _build_index(self) -> None:
+        documents = {}
+        for name, tool in self.by_name.items():
+            text = " ".join([name, tool.description()] + [
+                f"{spec.name} {spec.description}" for spec in tool.input_spec()])
+            documents[name] = Counter(tokenize(text))
+
+        document_frequency = Counter(term for terms in documents.values() for term in terms)
+        num_documents = len(documents)
+        self.index = {}
+        for name, terms in documents.items():
+            weights = {
+                term: count * math.log(1 + num_documents / document_frequency[term])
+                for term, count in terms.items()
+            }
+            norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+            self.index[name] = {term: weight / norm for term, weight in weights.items()}
+
+    def select(self, query: str, top_k: int = 4) -> list[str]:
+        """Returns the names of the top_k tools most relevant to query, plus the
+        always-included tools. Falls back to every tool if nothing matches.
+
+        Keyword overlap misses synonyms ("curl" never matches Terminal), so
+        when fewer than top_k tools match, the rest of the catalog fills in."""
+        terms = set(tokenize(query))
+        scores = {
+            name: sum(weights.get(term, 0.0) for term in terms)
+            for name, weights in self.index.items()
+        }
+        if not any(scores.values()):
+            return list(self.by_name)
+        # A stable sort, so tools that don't match keep their catalog order.
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        selected = ranked[:top_k]
+        return selected + [name for name in self.always_include if name not in selected]
+
+    def schemas_for(self, names: list[str]) -> list[dict]:
+        return [self.schemas[name] for name in names]
+
+    def prompt_for(self, names: list[str] = None) -> str:
+        names = names if names is not None else list(self.by_name)
+        return "\n".join(self.prompts[name] for name in names)
+
+    def summary(self) -> str:
+        """One line per tool, its name and description, without the input
+        specs; cheap enough to keep in the pinned history."""
+        return "\n".join(f"{name}: {tool.description().strip().splitlines()[0]}"
+                         for name, tool in self.by_name.items())
+
+
+if __name__ == "__main__":
+    # Measures how many prompt tokens per step are saved by sending only the
+    # selected tools instead of the whole catalog. Both include the tool list
+    # pinned in the history, which is re-sent on every step: the full prompt
+    # of every tool before, the one-line summary now.
+    from models.tokens import count_tokens
+    from tools import browse, datetime_tool, email, location, phone_call, search, terminal, user_input
+
+    registry = ToolRegistry([
+        browse.BrowseTool(),
+        datetime_tool.DatetimeTool(),
+        email.SendEmail(),
+        location.UserProvidedLocation(),
+        phone_call.PhoneCall(),
+        search.SearchTool(),
+        terminal.Terminal(),
+        user_input.UserInput(),
+    ])
+    full_tokens = count_tokens(str(registry.schemas_for(list(registry.by_name)))) + count_tokens(registry.prompt_for())
+    pinned_tokens = count_tokens(registry.summary())
+    print(f"Full catalog: {full_tokens} tokens per step (schemas + pinned tool prompt)")
+    print(f"Pinned summary: {pinned_tokens} tokens per step")
+    for objective in [
+        "Find the latest news about the Python release and summarize the web page",
+        "Email my landlord that the rent will be late and tell them today's date",
+        "List the files in my home directory",
+        "Call the restaurant near my location and book a table",
+    ]:
+        names = registry.select(objective)
+        selected_tokens = count_tokens(str(registry.schemas_for(names))) + pinned_tokens
+        print(f"{selected_tokens:5d} tokens ({1 - selected_tokens / full_tokens:.0%} saved) {names} <- {objective!r}")
@@ -1,11 +1,15 @@
 import json
+import time
 
 class Visualizer:
-    def __init__(self, file_path):
+    def __init__(self, file_path, min_write_interval=0.25):
         self.file_path = file_path
         self.nodes = []
         self.edges = []
         self.current_stage_id = -1
+        # Streamed appends rewrite the file at most this often (in seconds).
+        self.min_write_interval = min_write_interval
+        self.last_write_time = 0.0
 
     def add_new_stage(self, title, content):
         self.current_stage_id += 1
@@ -35,23 +39,30 @@ class Visualizer:
         self._update_file()
         return self.current_stage_id
 
-    def amend_stage(self, stage_id, title=None, content=None):
+    def amend_stage(self, stage_id, title=None, content=None, append=False):
+        """Updates a stage. With append=True, content is added to the end of the
+        existing content, which lets a streamed response render incrementally."""
         # if content:
         #     # Replace newlines in content with &#xA; tags
         #     content = content.replace("\n", "&#xA;")
 
-        for node in self.nodes:
-            if node['id'] == str(stage_id):
-                if title is not None:
-                    node['data']['title'] = title
-                if content is not None:
-                    node['data']['content'] = content
-                break
+        # Stage ids are assigned sequentially, so they index directly into nodes.
+        node = self.nodes[int(stage_id)]
+        if title is not None:
+            node['data']['title'] = title
+        if content is not None:
+            if append:
+                node['data']['content'] += content
+            else:
+                node['data']['content'] = content
 
+        if append and time.monotonic() - self.last_write_time < self.min_write_interval:
+            return
         self._update_file()
 
     def _update_file(self):
         data = {"nodes": self.nodes, "edges": self.edges}
         with open(self.file_path, "w") as f:
             json.dump(data, f, indent=2)
+        self.last_write_time = time.monotonic()
 
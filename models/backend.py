@@ -0,0 +1,161 @@
+"""
+models/backend.py
+
+Backends decide how requests to external services are answered: OpenAI
+completions and embeddings, tool runs, and prompts to the user.
+
+* LiveBackend sends every request for real.
+* RecordingBackend does the same, and appends each request/response pair to
+  a cassette file (JSON lines).
+* ReplayBackend answers from a cassette without touching the network or
+  stdin, so agents can run offline and deterministically.
+
+The process-wide backend is chosen by OPENAGI_BACKEND (live, record or
+replay) with the cassette at OPENAGI_CASSETTE, or set with set_backend().
+"""
+
+import hashlib
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+
+import openai
+from openai.openai_object import OpenAIObject
+
+DEFAULT_CASSETTE = "cassette.jsonl"
+
+# Request fields that don't change the response.
+IGNORED_FIELDS = ["request_timeout"]
+
+
+class RecordedError(Exception):
+    """Replays an exception that was raised while recording."""
+    pass
+
+
+def request_key(kind: str, request) -> str:
+    if isinstance(request, dict):
+        request = {k: v for k, v in request.items() if k not in IGNORED_FIELDS}
+    canonical = json.dumps([kind, request], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Backend(ABC):
+    # True if requests may skip the backend and go straight to OpenAI, which
+    # is how AsyncLLM uses its own HTTP session.
+    passthrough = False
+    # True if nothing is sent over the network, so rate limits don't apply.
+    offline = False
+
+    @abstractmethod
+    def call(self, kind: str, request, fn):
+        """Returns the response to request, obtained by calling fn() or otherwise."""
+        pass
+
+    def chat_completion(self, params, timeout=None):
+        if params.get("stream"):
+            chunks = self.call("chat_completion", params, lambda: list(
+                openai.ChatCompletion.create(request_timeout=timeout, **params)))
+            return (OpenAIObject.construct_from(chunk) for chunk in chunks)
+        return OpenAIObject.construct_from(self.call("chat_completion", params, lambda: (
+            openai.ChatCompletion.create(request_timeout=timeout, **params))))
+
+    def embedding(self, params):
+        return OpenAIObject.construct_from(self.call("embedding", params, lambda: (
+            openai.Embedding.create(**params))))
+
+    def run_tool(self, name: str, arguments, run):
+        """Runs a tool (or an action) given the arguments it was called with."""
+        return self.call("tool", {"name": name, "arguments": arguments}, run)
+
+    def user_input(self, prompt: str) -> str:
+        return self.call("user_input", {"prompt": prompt}, lambda: input(prompt))
+
+
+class LiveBackend(Backend):
+    passthrough = True
+
+    def call(self, kind, request, fn):
+        return fn()
+
+    def chat_completion(self, params, timeout=None):
+        # Streams are passed through lazily so tokens arrive as they're generated.
+        return openai.ChatCompletion.create(request_timeout=timeout, **params)
+
+
+class RecordingBackend(Backend):
+    """Streams are read in full before being returned, so they can be recorded."""
+
+    def __init__(self, path=DEFAULT_CASSETTE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def call(self, kind, request, fn):
+        entry = {"kind": kind, "key": request_key(kind, request), "request": request}
+        try:
+            response = entry["response"] = fn()
+        except Exception as error:
+            # Failures are part of the run too (e.g. a tool error fed back to the agent).
+            entry["error"] = str(error)
+            raise
+        finally:
+            line = json.dumps(entry, default=str)
+            with self._lock:
+                with open(self.path, "a") as f:
+                    f.write(line + "\n")
+        return response
+
+
+class ReplayBackend(Backend):
+    offline = True
+
+    def __init__(self, path=DEFAULT_CASSETTE):
+        self.path = path
+        # Identical requests are answered in the order they were recorded. Once
+        # only one answer is left, it is repeated.
+        self.responses = defaultdict(deque)
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.responses[entry["key"]].append(entry)
+
+    def call(self, kind, request, fn):
+        key = request_key(kind, request)
+        responses = self.responses.get(key)
+        if not responses:
+            raise LookupError(f"No recorded {kind} response for {str(request)[:200]} in {self.path}")
+        entry = responses.popleft() if len(responses) > 1 else responses[0]
+        if "error" in entry:
+            raise RecordedError(entry["error"])
+        return entry["response"]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> Backend:
+    """Returns the process-wide backend, creating it from the environment on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            mode = os.environ.get("OPENAGI_BACKEND", "live")
+            path = os.environ.get("OPENAGI_CASSETTE", DEFAULT_CASSETTE)
+            if mode == "live":
+                _backend = LiveBackend()
+            elif mode == "record":
+                _backend = RecordingBackend(path)
+            elif mode == "replay":
+                _backend = ReplayBackend(path)
+            else:
+                raise ValueError(f"Unknown OPENAGI_BACKEND: {mode}")
+        return _backend
+
+
+def set_backend(backend: Backend) -> None:
+    global _backend
+    with _backend_lock:
+        _backend = backend
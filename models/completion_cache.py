@@ -0,0 +1,173 @@
+"""
+models/completion_cache.py
+
+An on-disk cache of chat completions for deterministic (temperature 0) calls.
+
+Entries are keyed by a hash of the request parameters that affect the output
+and stored in SQLite. The least recently used entries are evicted once the
+cache grows past max_bytes.
+
+Streamed completions share the same entries: the full response is rebuilt
+from the deltas once the stream ends, and a hit is replayed as a stream.
+Streams don't report usage, so a rebuilt response carries an estimate.
+
+Set OPENAGI_COMPLETION_CACHE to a file path to enable a shared cache for every
+LLM that isn't given one explicitly.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from models.tokens import approx_count_tokens
+
+# Request parameters that change the completion. Anything else (timeouts,
+# streaming flags) is ignored when building the key.
+KEY_PARAMS = ["model", "temperature", "max_tokens", "messages", "functions", "function_call"]
+
+
+class CompletionCache:
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def cacheable(params) -> bool:
+        """Only deterministic requests are cached. Streaming ones are cached by
+        LLM.stream_deltas rather than by the request itself."""
+        return params.get("temperature", 1.0) == 0 and not params.get("stream", False)
+
+    @staticmethod
+    def key(params) -> str:
+        relevant = {name: params.get(name) for name in KEY_PARAMS}
+        canonical = json.dumps(relevant, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, params):
+        """Returns the cached response dict for the request, or None."""
+        key = self.key(params)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, params, response) -> None:
+        key = self.key(params)
+        data = json.dumps(response)
+        size = len(data)
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time()))
+            self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Drops least recently used entries until the cache fits in max_bytes."""
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM completions ORDER BY last_access LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    break
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM completions")
+            self._conn.commit()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self._total_bytes,
+        }
+
+
+def response_from_deltas(deltas, params) -> dict:
+    """Rebuilds a chat completion response from the deltas of the stream that
+    answered params. Usage is estimated: a delta per completion token, and
+    approx_count_tokens of the prompt."""
+    message = {"role": "assistant", "content": None}
+    completion_tokens = 0
+    for delta in deltas:
+        completion_tokens += 1
+        if delta.get("content"):
+            message["content"] = (message["content"] or "") + delta["content"]
+        if delta.get("function_call"):
+            function_call = message.setdefault("function_call", {"name": "", "arguments": ""})
+            function_call["name"] += delta["function_call"].get("name", "")
+            function_call["arguments"] += delta["function_call"].get("arguments", "")
+    finish_reason = "function_call" if "function_call" in message else "stop"
+    prompt_tokens = sum(approx_count_tokens(str(prompt_message.get("content") or ""))
+                        for prompt_message in params.get("messages", []))
+    prompt_tokens += approx_count_tokens(json.dumps(params["functions"])) if params.get("functions") else 0
+    return {
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def deltas_from_response(response) -> list:
+    """The deltas a stream of a cached response is replayed as."""
+    message = response["choices"][0]["message"]
+    deltas = [{"role": "assistant"}]
+    if message.get("content"):
+        deltas.append({"content": message["content"]})
+    if message.get("function_call"):
+        deltas.append({"function_call": dict(message["function_call"])})
+    return deltas
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """Returns the process-wide cache configured by OPENAGI_COMPLETION_CACHE, if any."""
+    global _default_cache
+    path = os.environ.get("OPENAGI_COMPLETION_CACHE")
+    if _default_cache is None and path:
+        _default_cache = CompletionCache(path)
+    return _default_cache
@@ -3,18 +3,136 @@ models/embedding.py
 
 Calls the embedding model from OpenAI.
 
+BaseEmbeddingModel is the interface the memory stores embed through, so other
+implementations (see models/local_embedding.py) can be swapped in.
 """
 
+import numpy as np
 import openai
 import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from models.backend import get_backend
+from models.embedding_cache import get_default_cache
+from models.scheduler import FOREGROUND, estimate_tokens, get_scheduler
+from models.tokens import count_tokens
 
 # Set api key from env vars
-openai.api_key = os.environ["OPENAI_API_KEY"]
+openai.api_key = os.environ.get("OPENAI_API_KEY")
 
+# Limits of a single embedding request.
+MAX_BATCH_TOKENS = 8000
+MAX_BATCH_SIZE = 2048
 
-class EmbeddingModel:
-    def __init__(self, model="text-embedding-ada-002"):
+
+class BaseEmbeddingModel(ABC):
+    # Name of the model, also used to key cached embeddings.
+    model: str
+
+    @abstractmethod
+    def get_embeddings(self, texts) -> np.ndarray:
+        """Returns a (len(texts), dim) float32 matrix, one row per text."""
+        pass
+
+    def get_embedding(self, text) -> list[float]:
+        return self.get_embeddings([text])[0].tolist()
+
+
+class EmbeddingModel(BaseEmbeddingModel):
+    def __init__(self, model="text-embedding-ada-002", priority=FOREGROUND, max_concurrency=8, cache=None):
         self.model = model
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        # Optional EmbeddingCache consulted before any request is sent.
+        self.cache = cache if cache is not None else get_default_cache(model)
 
     def get_embedding(self, text):
-        return openai.Embedding.create(input=[text], model=self.model)['data'][0]['embedding']
+        if self.cache is not None:
+            cached = self.cache.get(self.model, text)
+            if cached is not None:
+                return cached.tolist()
+        embedding = self._request([text])[0]
+        if self.cache is not None:
+            self._cache_embeddings([text], np.asarray([embedding], dtype=np.float32))
+        return embedding
+
+    def get_embeddings(self, texts) -> np.ndarray:
+        """Embeds many texts at once and returns a (len(texts), dim) float32 matrix
+        whose rows are in the same order as texts.
+
+        Texts are packed into as few requests as the token and size limits
+        allow, and the requests are sent concurrently.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        cached = self.cache.get_many(self.model, texts) if self.cache is not None else [None] * len(texts)
+        missing = [i for i, embedding in enumerate(cached) if embedding is None]
+
+        results = []
+        batches = [[missing[i] for i in batch] for batch in self._batches([texts[i] for i in missing])] if missing else []
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                results = list(executor.map(lambda batch: self._request([texts[i] for i in batch]), batches))
+
+        dim = len(results[0][0]) if results else len(next(e for e in cached if e is not None))
+        matrix = np.empty((len(texts), dim), dtype=np.float32)
+        for i, embedding in enumerate(cached):
+            if embedding is not None:
+                matrix[i] = embedding
+        for batch, embeddings in zip(batches, results):
+            matrix[batch] = embeddings
+            if self.cache is not None:
+                self._cache_embeddings([texts[i] for i in batch], matrix[batch])
+        return matrix
+
+    def _cache_embeddings(self, texts, embeddings) -> None:
+        # The request was paid for either way, so a cache that can't take the
+        # embeddings (e.g. one shared with a model of another size) doesn't
+        # fail it.
+        try:
+            self.cache.put_many(self.model, texts, embeddings)
+        except ValueError as e:
+            print("Not caching embeddings: ", e)
+
+    def _batches(self, texts) -> list[list[int]]:
+        """Groups the indices of texts into batches that fit one request each."""
+        batches = [[]]
+        batch_tokens = 0
+        for i, tokens in enumerate(count_tokens(texts, self.model)):
+            batch = batches[-1]
+            if batch and (batch_tokens + tokens > MAX_BATCH_TOKENS or len(batch) >= MAX_BATCH_SIZE):
+                batch = []
+                batches.append(batch)
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens += tokens
+        return batches
+
+    def _request(self, texts) -> list[list[float]]:
+        backend = get_backend()
+        params = {"input": texts, "model": self.model}
+        if not backend.offline:
+            get_scheduler().acquire(estimate_tokens(params), self.priority)
+        data = backend.embedding(params)["data"]
+        # The API may return the embeddings out of order.
+        return [item["embedding"] for item in sorted(data, key=lambda item: item["index"])]
+
+
+if __name__ == "__main__":
+    import time
+
+    model = EmbeddingModel()
+    texts = [f"Chunk {i} of a long web page about topic {i % 37}." for i in range(200)]
+
+    start = time.perf_counter()
+    one_by_one = np.array([model.get_embedding(text) for text in texts], dtype=np.float32)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = model.get_embeddings(texts)
+    elapsed = time.perf_counter() - start
+
+    print(f"get_embedding x {len(texts)}: {sequential:.2f}s")
+    print(f"get_embeddings: {elapsed:.2f}s ({sequential / elapsed:.1f}x faster), shape {batched.shape}")
+    print("Same result:", np.allclose(one_by_one, batched))
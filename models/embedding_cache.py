@@ -0,0 +1,208 @@
+"""
+models/embedding_cache.py
+
+A persistent cache of embeddings keyed by (model, text hash).
+
+Vectors are appended to a raw float32 file that is memory-mapped for reads,
+and an append-only index log maps each key to its row. Once more than
+max_items are cached, the least recently used keys are evicted; their rows
+are reclaimed when the file is compacted.
+
+All vectors in a directory have the dimension of the first one stored;
+put_many raises ValueError for any other, so models of different sizes need
+separate directories.
+
+The in-memory index is the only record of which rows are taken, so a
+directory can only be used by one cache at a time. It is locked while open,
+and opening it from another process (or twice) raises RuntimeError.
+
+Set OPENAGI_EMBEDDING_CACHE to a directory to enable a shared cache for every
+EmbeddingModel that isn't given one explicitly; each model gets its own
+subdirectory.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows; directories aren't locked.
+    fcntl = None
+
+VECTORS_FILE = "vectors.f32"
+INDEX_FILE = "index.log"
+META_FILE = "meta.json"
+LOCK_FILE = "lock"
+
+
+class EmbeddingCache:
+    def __init__(self, directory, max_items=100_000):
+        self.directory = os.path.expanduser(directory)
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self.dim = None
+        # key -> row, least recently used first.
+        self.index = OrderedDict()
+        self.num_rows = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self._lock_file = open(self._path(LOCK_FILE), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                raise RuntimeError(f"Embedding cache {self.directory} is already in use")
+        self._load()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha1(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path(META_FILE)):
+            return
+        with open(self._path(META_FILE)) as f:
+            self.dim = json.load(f)["dim"]
+        # Bytes past the last complete vector are from an interrupted write.
+        self.num_rows = os.path.getsize(self._path(VECTORS_FILE)) // (4 * self.dim)
+        os.truncate(self._path(VECTORS_FILE), self.num_rows * 4 * self.dim)
+        if os.path.exists(self._path(INDEX_FILE)):
+            with open(self._path(INDEX_FILE)) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and int(parts[1]) < self.num_rows:
+                        self.index[parts[0]] = int(parts[1])
+                        self.index.move_to_end(parts[0])
+                    elif len(parts) == 1 and parts[0].startswith("-"):
+                        self.index.pop(parts[0][1:], None)
+
+    def _row(self, row: int) -> np.ndarray:
+        # The file only grows between compactions, so it is re-mapped lazily
+        # when a row past the end of the current mapping is read.
+        if self._mmap is None or row >= self._mmap.shape[0]:
+            self._mmap = np.memmap(self._path(VECTORS_FILE), dtype=np.float32, mode="r",
+                                   shape=(self.num_rows, self.dim))
+        return self._mmap[row]
+
+    def get(self, model: str, text: str):
+        """Returns the cached embedding as a float32 vector, or None."""
+        return self.get_many(model, [text])[0]
+
+    def get_many(self, model: str, texts) -> list:
+        """Returns the cached embedding of each text, or None where it is missing."""
+        keys = [self.key(model, text) for text in texts]
+        results = []
+        with self._lock:
+            for key in keys:
+                row = self.index.get(key)
+                if row is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                self.index.move_to_end(key)
+                results.append(np.array(self._row(row)))
+        return results
+
+    def put(self, model: str, text: str, embedding) -> None:
+        self.put_many(model, [text], np.asarray([embedding], dtype=np.float32))
+
+    def put_many(self, model: str, texts, embeddings: np.ndarray) -> None:
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(texts):
+            raise ValueError(f"Expected {len(texts)} embeddings, got an array of shape {embeddings.shape}")
+        with self._lock:
+            if self.dim is not None and embeddings.shape[1] != self.dim:
+                raise ValueError(f"Embeddings of {model} have dimension {embeddings.shape[1]}, "
+                                 f"but the cache in {self.directory} holds dimension {self.dim}")
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                with open(self._path(META_FILE), "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            keys = [self.key(model, text) for text in texts]
+            lines = []
+            with open(self._path(VECTORS_FILE), "ab") as f:
+                f.write(embeddings.tobytes())
+            for key in keys:
+                self.index[key] = self.num_rows
+                self.index.move_to_end(key)
+                lines.append(f"{key} {self.num_rows}\n")
+                self.num_rows += 1
+            while len(self.index) > self.max_items:
+                evicted, _ = self.index.popitem(last=False)
+                lines.append(f"-{evicted}\n")
+            with open(self._path(INDEX_FILE), "a") as f:
+                f.writelines(lines)
+            # Compact once dead rows outnumber live ones.
+            if self.num_rows > 2 * max(len(self.index), 1) and self.num_rows > 1024:
+                self._compact()
+
+    def _compact(self) -> None:
+        """Rewrites the vector file and index with only the live rows."""
+        rows = list(self.index.values())
+        vectors = np.array(self._all_rows()[rows])
+        tmp_vectors = self._path(VECTORS_FILE + ".tmp")
+        tmp_index = self._path(INDEX_FILE + ".tmp")
+        vectors.tofile(tmp_vectors)
+        with open(tmp_index, "w") as f:
+            f.writelines(f"{key} {row}\n" for row, key in enumerate(self.index))
+        self._mmap = None
+        os.replace(tmp_vectors, self._path(VECTORS_FILE))
+        os.replace(tmp_index, self._path(INDEX_FILE))
+        for row, key in enumerate(self.index):
+            self.index[key] = row
+        self.num_rows = len(rows)
+
+    def _all_rows(self) -> np.ndarray:
+        return np.memmap(self._path(VECTORS_FILE), dtype=np.float32, mode="r",
+                         shape=(self.num_rows, self.dim))
+
+    def close(self) -> None:
+        """Releases the directory."""
+        self._mmap = None
+        self._lock_file.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "items": len(self.index),
+            "rows": self.num_rows,
+        }
+
+
+# Process-wide caches by model; None if the model's directory couldn't be opened.
+_default_caches = {}
+_default_caches_lock = threading.Lock()
+
+
+def get_default_cache(model: str):
+    """Returns the process-wide cache of model's embeddings under
+    OPENAGI_EMBEDDING_CACHE, if that is set."""
+    directory = os.environ.get("OPENAGI_EMBEDDING_CACHE")
+    if not directory:
+        return None
+    with _default_caches_lock:
+        if model not in _default_caches:
+            try:
+                _default_caches[model] = EmbeddingCache(
+                    os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", model)))
+            except RuntimeError as e:
+                print("Not caching embeddings: ", e)
+                _default_caches[model] = None
+        return _default_caches[model]
@@ -0,0 +1,45 @@
+"""
+models/latency.py
+
+Tracks recent request latencies per model. The LLM layer uses the observed
+p95 to decide when a slow request should be hedged with a duplicate.
+"""
+
+import threading
+from collections import defaultdict, deque
+
+# Percentiles are not trusted until this many calls have been observed.
+MIN_SAMPLES = 20
+
+
+class LatencyHistogram:
+    """A rolling window of the latencies (in seconds) of the last window calls."""
+
+    def __init__(self, window=500):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p: float):
+        """Returns the p-th percentile latency, or None if there are too few samples."""
+        with self._lock:
+            if len(self.samples) < MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+_histograms = defaultdict(LatencyHistogram)
+_histograms_lock = threading.Lock()
+
+
+def get_histogram(model: str) -> LatencyHistogram:
+    """Returns the process-wide latency histogram for a model."""
+    with _histograms_lock:
+        return _histograms[model]
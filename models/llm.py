@@ -1,17 +1,86 @@
 """
 models/llm.py
 
-This file defines the class to call an LLM from OpenAI.
+This file defines the classes to call an LLM from OpenAI.
+
+LLM is the blocking client. AsyncLLM exposes the same methods as coroutines
+over a pooled keep-alive HTTP session, so callers can gather many completions.
 
 """
 
+import aiohttp
+import asyncio
+import json
 import openai
 import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from openai.openai_object import OpenAIObject
+from models.backend import get_backend
+from models.completion_cache import (
+    CompletionCache,
+    deltas_from_response,
+    get_default_cache,
+    response_from_deltas,
+)
+from models.latency import get_histogram
 from models.prompts import SYSTEM_PROMPT
+from models.scheduler import FOREGROUND, estimate_tokens, get_scheduler
 import tiktoken
 
 # Set api key from env vars
-openai.api_key = os.environ["OPENAI_API_KEY"]
+openai.api_key = os.environ.get("OPENAI_API_KEY")
+
+# Model the *_with_functions calls go to, whatever the client's own model is.
+FUNCTION_CALL_MODEL = "gpt-4-0613"
+
+# Runs the original and duplicate requests of hedged calls.
+_hedge_executor = ThreadPoolExecutor(max_workers=32)
+
+
+class StreamStats:
+    """Timing of a single streamed completion."""
+
+    def __init__(self, model):
+        self.model = model
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self.num_tokens = 0
+
+    def record_token(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        # Each streamed delta carries one token.
+        self.num_tokens += 1
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    @property
+    def ttft(self):
+        """Seconds from sending the request to receiving the first token."""
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+    @property
+    def tokens_per_second(self):
+        """Generation speed after the first token arrived."""
+        if self.first_token_time is None or self.end_time is None:
+            return None
+        elapsed = self.end_time - self.first_token_time
+        return self.num_tokens / elapsed if elapsed > 0 else None
+
+    def __str__(self):
+        ttft = f"{self.ttft:.2f}s" if self.ttft is not None else "n/a"
+        tps = f"{self.tokens_per_second:.1f}" if self.tokens_per_second is not None else "n/a"
+        return f"{self.model}: TTFT {ttft}, {self.num_tokens} tokens, {tps} tokens/s"
+
+
+def has_token(delta):
+    return bool(delta.get("content")) or bool(delta.get("function_call"))
 
 
 class LLM:
@@ -19,47 +88,390 @@ class LLM:
                  model="gpt-3.5-turbo",
                  temperature=0.0,
                  max_tokens=200,
-                 system_prompt=SYSTEM_PROMPT):
+                 system_prompt=SYSTEM_PROMPT,
+                 cache=None,
+                 priority=FOREGROUND,
+                 timeout=None,
+                 hedge=False):
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.system_prompt = system_prompt
+        # Optional CompletionCache; only consulted for temperature 0 requests.
+        self.cache = cache if cache is not None else get_default_cache()
+        # Requests are queued behind higher priority ones by the shared scheduler.
+        self.priority = priority
+        # Default per-request deadline in seconds (None waits forever).
+        self.timeout = timeout
+        # If set, a request that runs past the model's observed p95 latency is
+        # duplicated and whichever copy returns first is used.
+        self.hedge = hedge
+        self.hedged_requests = 0
+        # StreamStats of the most recent streamed calls.
+        self.stream_stats = deque(maxlen=100)
         self.messages = [{"role": "system", "content": self.system_prompt}]
 
-    def generate_chat_completion(self, prompt, messages=[]):
-        response = openai.ChatCompletion.create(
+    def build_messages(self, prompt, messages=[]):
+        return [
+            {"role": "system", "content": self.system_prompt},
+            *messages,
+            {"role": "user", "content": prompt},
+        ]
+
+    def create_chat_completion(self, timeout=None, **params):
+        use_cache = self.cache is not None and CompletionCache.cacheable(params)
+        if use_cache:
+            cached = self.cache.get(params)
+            if cached is not None:
+                return OpenAIObject.construct_from(cached)
+        timeout = timeout if timeout is not None else self.timeout
+        hedge_after = self.hedge_delay(params)
+        if hedge_after is None:
+            response = self.send_chat_completion(params, timeout)
+        else:
+            response = self.send_hedged(params, timeout, hedge_after)
+        if use_cache:
+            self.cache.put(params, response)
+        return response
+
+    def hedge_delay(self, params):
+        """Seconds to wait before hedging a request, or None if it shouldn't be."""
+        if not self.hedge or params.get("stream"):
+            return None
+        return get_histogram(params["model"]).percentile(95)
+
+    def send_chat_completion(self, params, timeout=None):
+        backend = get_backend()
+        estimated_tokens = estimate_tokens(params)
+        scheduler = get_scheduler()
+        if not backend.offline:
+            scheduler.acquire(estimated_tokens, self.priority)
+        start = time.perf_counter()
+        response = backend.chat_completion(params, timeout)
+        if not params.get("stream") and not backend.offline:
+            get_histogram(params["model"]).record(time.perf_counter() - start)
+            if "usage" in response:
+                scheduler.record_usage(estimated_tokens, response.usage.total_tokens)
+        return response
+
+    def send_hedged(self, params, timeout, hedge_after):
+        """Sends the request, plus a duplicate if it hasn't returned after
+        hedge_after seconds. The first successful response wins.
+
+        A blocking request can't be interrupted from another thread, so the
+        loser runs to completion in the background and its response is dropped.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = {_hedge_executor.submit(self.send_chat_completion, params, timeout)}
+        done, _ = wait(pending, timeout=hedge_after)
+        if not done:
+            self.hedged_requests += 1
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            pending.add(_hedge_executor.submit(self.send_chat_completion, params, remaining))
+        error = None
+        while pending:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+                error = future.exception()
+        if error is not None:
+            raise error
+        raise openai.error.Timeout(f"Request timed out after {timeout} seconds")
+
+    def generate_chat_completion(self, prompt, messages=[], timeout=None):
+        response = self.create_chat_completion(
+            timeout=timeout,
             model=self.model,
-            messages=[
-                {"role": "system", "content": self.system_prompt},
-                *messages,
-                {"role": "user", "content": prompt},
-            ],
+            messages=self.build_messages(prompt, messages),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
         )
         return response.choices[0].message.content
 
-    def generate_chat_completion_with_functions(self, prompt, messages=[], functions=[]):
-        response = openai.ChatCompletion.create(
-            model="gpt-4-0613",
-            messages=[
-                {"role": "system", "content": self.system_prompt},
-                *messages,
-                {"role": "user", "content": prompt},
-            ],
+    def generate_chat_completion_with_functions(self, prompt, messages=[], functions=[], timeout=None):
+        response = self.create_chat_completion(
+            timeout=timeout,
+            model=FUNCTION_CALL_MODEL,
+            messages=self.build_messages(prompt, messages),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
             functions=functions,
             function_call="auto",
         )
 
-        print("Usage:", response.usage)
+        # Streamed responses cached before usage was estimated have none.
+        print("Usage:", response.get("usage"))
 
         return response.choices[0].message
 
+    def stream_chat_completion(self, prompt, messages=[]):
+        """Yields the response content piece by piece as it is generated."""
+        for delta in self.stream_deltas(
+            model=self.model,
+            messages=self.build_messages(prompt, messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        ):
+            if delta.get("content"):
+                yield delta["content"]
+
+    def stream_chat_completion_with_functions(self, prompt, messages=[], functions=[]):
+        """Yields raw deltas, which hold either content or function_call fragments."""
+        yield from self.stream_deltas(
+            model=FUNCTION_CALL_MODEL,
+            messages=self.build_messages(prompt, messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            functions=functions,
+            function_call="auto",
+        )
+
+    def stream_deltas(self, **params):
+        stats = StreamStats(params["model"])
+        use_cache = self.cache is not None and CompletionCache.cacheable(params)
+        cached = self.cache.get(params) if use_cache else None
+        if cached is not None:
+            deltas = (OpenAIObject.construct_from(delta) for delta in deltas_from_response(cached))
+        else:
+            deltas = (chunk.choices[0].delta
+                      for chunk in self.create_chat_completion(stream=True, **params) if chunk.choices)
+        received = []
+        for delta in deltas:
+            if has_token(delta):
+                stats.record_token()
+                received.append(delta)
+                yield delta
+        stats.finish()
+        self.stream_stats.append(stats)
+        # Only reached if the stream was read to the end.
+        if use_cache and cached is None:
+            self.cache.put(params, response_from_deltas(received, params))
+
     def generate_chat_completion_stateful(self, prompt):
         self.messages.append({"role": "user", "content": prompt})
-        response = openai.ChatCompletion.create(
+        response = self.create_chat_completion(
+            model=self.model,
+            messages=self.messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        )
+        response_msg = response.choices[0].message.content
+        self.messages.append({"role": "assistant", "content": response_msg})
+        return response_msg
+
+
+class AsyncLLM(LLM):
+    """Async version of LLM that shares one pooled aiohttp session.
+
+    At most max_concurrency requests are in flight at a time; the rest wait on
+    a semaphore. api_base may point at any OpenAI-compatible server.
+    """
+
+    def __init__(self,
+                 model="gpt-3.5-turbo",
+                 temperature=0.0,
+                 max_tokens=200,
+                 system_prompt=SYSTEM_PROMPT,
+                 cache=None,
+                 priority=FOREGROUND,
+                 timeout=None,
+                 hedge=False,
+                 max_concurrency=16,
+                 api_base=None,
+                 api_key=None):
+        super().__init__(model, temperature, max_tokens, system_prompt, cache, priority, timeout, hedge)
+        self.max_concurrency = max_concurrency
+        self.api_base = (api_base or openai.api_base).rstrip("/")
+        self.api_key = api_key or openai.api_key
+        self._session = None
+        self._semaphore = None
+
+    def _get_session(self):
+        # The session and semaphore are created lazily so they bind to the
+        # event loop that actually runs the requests.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def create_chat_completion(self, timeout=None, **params):
+        """POST a chat completion request and return the parsed response."""
+        use_cache = self.cache is not None and CompletionCache.cacheable(params)
+        if use_cache:
+            cached = self.cache.get(params)
+            if cached is not None:
+                return OpenAIObject.construct_from(cached)
+        timeout = timeout if timeout is not None else self.timeout
+        hedge_after = self.hedge_delay(params)
+        if hedge_after is None:
+            data = await self.send_chat_completion(params, timeout)
+        else:
+            data = await self.send_hedged(params, timeout, hedge_after)
+        if use_cache:
+            self.cache.put(params, data)
+        return OpenAIObject.construct_from(data)
+
+    async def send_chat_completion(self, params, timeout=None):
+        backend = get_backend()
+        if not backend.passthrough:
+            # Recorded and replayed requests go through the backend instead.
+            return await asyncio.to_thread(super().send_chat_completion, params, timeout)
+        estimated_tokens = estimate_tokens(params)
+        scheduler = get_scheduler()
+        await scheduler.acquire_async(estimated_tokens, self.priority)
+        session = self._get_session()
+        async with self._semaphore:
+            start = time.perf_counter()
+            async with session.post(
+                f"{self.api_base}/chat/completions",
+                json=params,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                response.raise_for_status()
+                data = await response.json()
+            get_histogram(params["model"]).record(time.perf_counter() - start)
+        if "usage" in data:
+            scheduler.record_usage(estimated_tokens, data["usage"]["total_tokens"])
+        return data
+
+    async def send_hedged(self, params, timeout, hedge_after):
+        """Like LLM.send_hedged, except that the losing request is cancelled."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = {asyncio.ensure_future(self.send_chat_completion(params, timeout))}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done:
+                self.hedged_requests += 1
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                pending.add(asyncio.ensure_future(self.send_chat_completion(params, remaining)))
+            error = None
+            while pending:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(
+                    pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            if error is not None:
+                raise error
+            raise asyncio.TimeoutError(f"Request timed out after {timeout} seconds")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate_chat_completion(self, prompt, messages=[], timeout=None):
+        response = await self.create_chat_completion(
+            timeout=timeout,
+            model=self.model,
+            messages=self.build_messages(prompt, messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        )
+        return response.choices[0].message.content
+
+    async def generate_chat_completion_with_functions(self, prompt, messages=[], functions=[], timeout=None):
+        response = await self.create_chat_completion(
+            timeout=timeout,
+            model=FUNCTION_CALL_MODEL,
+            messages=self.build_messages(prompt, messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            functions=functions,
+            function_call="auto",
+        )
+
+        # Streamed responses cached before usage was estimated have none.
+        print("Usage:", response.get("usage"))
+
+        return response.choices[0].message
+
+    async def stream_chat_completion(self, prompt, messages=[]):
+        async for delta in self.stream_deltas(
+            model=self.model,
+            messages=self.build_messages(prompt, messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        ):
+            if delta.get("content"):
+                yield delta["content"]
+
+    async def stream_chat_completion_with_functions(self, prompt, messages=[], functions=[]):
+        async for delta in self.stream_deltas(
+            model=FUNCTION_CALL_MODEL,
+            messages=self.build_messages(prompt, messages),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            functions=functions,
+            function_call="auto",
+        ):
+            yield delta
+
+    async def stream_chunks(self, params):
+        """Reads the server-sent event stream and yields each chunk."""
+        backend = get_backend()
+        if not backend.passthrough:
+            chunks = await asyncio.to_thread(
+                lambda: list(super(AsyncLLM, self).send_chat_completion(params)))
+            for chunk in chunks:
+                yield chunk
+            return
+        await get_scheduler().acquire_async(estimate_tokens(params), self.priority)
+        session = self._get_session()
+        async with self._semaphore:
+            async with session.post(f"{self.api_base}/chat/completions", json=params) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    yield OpenAIObject.construct_from(json.loads(data))
+
+    async def stream_deltas(self, **params):
+        """Yields each non-empty delta of a streamed completion."""
+        stats = StreamStats(params["model"])
+        use_cache = self.cache is not None and CompletionCache.cacheable(params)
+        cached = self.cache.get(params) if use_cache else None
+        received = []
+        if cached is not None:
+            for delta in deltas_from_response(cached):
+                delta = OpenAIObject.construct_from(delta)
+                if has_token(delta):
+                    stats.record_token()
+                    yield delta
+        else:
+            async for chunk in self.stream_chunks({**params, "stream": True}):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if has_token(delta):
+                    stats.record_token()
+                    received.append(delta)
+                    yield delta
+        stats.finish()
+        self.stream_stats.append(stats)
+        if use_cache and cached is None:
+            self.cache.put(params, response_from_deltas(received, params))
+
+    async def generate_chat_completion_stateful(self, prompt):
+        self.messages.append({"role": "user", "content": prompt})
+        response = await self.create_chat_completion(
             model=self.model,
             messages=self.messages,
             temperature=self.temperature,
@@ -68,3 +480,13 @@ class LLM:
         response_msg = response.choices[0].message.content
         self.messages.append({"role": "assistant", "content": response_msg})
         return response_msg
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,84 @@
+"""
+models/local_embedding.py
+
+An embedding model that runs in-process with only NumPy.
+
+Each text is split into overlapping character n-grams, which are hashed into a
+fixed number of buckets and weighted by log(1 + count). The bucket counts are
+then mapped to dim dimensions by a fixed Gaussian random projection and
+normalized. Texts that share many n-grams end up close together, which is
+enough for tests and for low-value memories that aren't worth an API call.
+The vectors are deterministic, so they are the same across processes.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from models.embedding import BaseEmbeddingModel
+
+# Multiplier of the polynomial rolling hash over n-gram bytes.
+HASH_BASE = np.uint64(1_000_003)
+
+
+@lru_cache(maxsize=None)
+def projection_matrix(num_buckets: int, dim: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    projection = rng.standard_normal((num_buckets, dim), dtype=np.float32)
+    return projection / np.sqrt(dim, dtype=np.float32)
+
+
+class LocalEmbeddingModel(BaseEmbeddingModel):
+    def __init__(self, dim=256, ngram_range=(3, 5), num_buckets=2**14, seed=0):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.num_buckets = num_buckets
+        self.model = f"local-ngram-{dim}"
+        self.projection = projection_matrix(num_buckets, dim, seed)
+
+    def _features(self, text: str) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the unique hashed n-gram buckets of text and their weights."""
+        data = np.frombuffer(f" {text.lower()} ".encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+        buckets = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            if len(data) < n:
+                break
+            # hash = sum(byte[i + k] * base^(n - 1 - k)), wrapping at 2^64.
+            hashes = np.zeros(len(data) - n + 1, dtype=np.uint64)
+            for k in range(n):
+                hashes = hashes * HASH_BASE + data[k:len(data) - n + 1 + k]
+            # Mix in n so that n-grams of different lengths don't collide.
+            buckets.append((hashes ^ np.uint64(n)) % np.uint64(self.num_buckets))
+        if not buckets:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, counts = np.unique(np.concatenate(buckets).astype(np.int64), return_counts=True)
+        return ids, np.log1p(counts).astype(np.float32)
+
+    def get_embeddings(self, texts) -> np.ndarray:
+        texts = list(texts)
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            ids, weights = self._features(text)
+            if len(ids):
+                matrix[i] = weights @ self.projection[ids]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+if __name__ == "__main__":
+    import time
+
+    model = LocalEmbeddingModel()
+    texts = [f"Memory {i}: the agent searched for item {i} and found result {i * 7}." for i in range(5000)]
+
+    start = time.perf_counter()
+    matrix = model.get_embeddings(texts)
+    elapsed = time.perf_counter() - start
+    print(f"Embedded {len(texts)} texts in {elapsed * 1000:.1f} ms "
+          f"({elapsed / len(texts) * 1e6:.1f} us/text), shape {matrix.shape}")
+
+    query = model.get_embeddings(["the agent searched for apples"])[0]
+    candidates = ["I searched for apples at the market", "The weather is sunny today", "apple pie recipe"]
+    for text, score in zip(candidates, model.get_embeddings(candidates) @ query):
+        print(f"{score:.3f} {text}")
@@ -0,0 +1,211 @@
+"""
+models/scheduler.py
+
+A process-wide scheduler for OpenAI requests.
+
+Every request acquires a slot from the scheduler before it is sent. Slots are
+limited by two token buckets, one for requests per minute and one for tokens
+per minute, and are handed out by priority: foreground agent calls go ahead of
+background work like importance scoring and page summaries. Requests of the
+same priority are served in arrival order.
+
+The budgets default to OPENAGI_RPM and OPENAGI_TPM from the environment.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from models.tokens import approx_count_tokens
+
+FOREGROUND = 0
+BACKGROUND = 1
+
+PRIORITY_NAMES = {FOREGROUND: "foreground", BACKGROUND: "background"}
+
+
+class TokenBucket:
+    """Refills continuously at rate_per_minute up to capacity."""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def time_until(self, amount: float) -> float:
+        """Seconds until amount tokens are available (0 if they are now)."""
+        self.refill()
+        # A request larger than the whole bucket only has to wait for a full one.
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Corrects the balance once the real cost of a request is known.
+
+        The balance may go negative, which delays later requests."""
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute: float = 3500, tokens_per_minute: float = 90000):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._cond = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        # Event loop and event of each coroutine waiting in the queue, by ticket.
+        self._async_waiters = {}
+        # Wait times in seconds of recent requests, per priority.
+        self._wait_times = {priority: deque(maxlen=1000) for priority in PRIORITY_NAMES}
+        self.total_requests = 0
+
+    def acquire(self, tokens: int, priority: int = FOREGROUND) -> float:
+        """Blocks until the request may be sent. Returns the time spent waiting."""
+        start = time.monotonic()
+        ticket = (priority, next(self._counter))
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    wait = self._try_take(ticket, tokens)
+                    if wait == 0:
+                        return self._record_wait(priority, start)
+                    self._cond.wait(wait)
+            except BaseException:
+                # E.g. a KeyboardInterrupt; the ticket mustn't block the queue.
+                self._remove(ticket)
+                raise
+
+    async def acquire_async(self, tokens: int, priority: int = FOREGROUND) -> float:
+        """acquire() for coroutines. Waits on the event loop rather than in a
+        thread; a cancelled waiter gives up its place in the queue."""
+        start = time.monotonic()
+        ticket = (priority, next(self._counter))
+        event = asyncio.Event()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            self._async_waiters[ticket] = (asyncio.get_running_loop(), event)
+        try:
+            while True:
+                with self._cond:
+                    event.clear()
+                    wait = self._try_take(ticket, tokens)
+                    if wait == 0:
+                        return self._record_wait(priority, start)
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                self._remove(ticket)
+            raise
+        finally:
+            with self._cond:
+                del self._async_waiters[ticket]
+
+    def _try_take(self, ticket, tokens: int):
+        """Takes a slot for ticket if it is first in line and the budgets allow.
+        Returns 0 if it did, otherwise how long to wait before trying again
+        (None until it is woken). Called with the lock held."""
+        if self._queue[0] != ticket:
+            return None
+        wait = max(self.request_bucket.time_until(1), self.token_bucket.time_until(tokens))
+        if wait > 0:
+            return wait
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(tokens)
+        heapq.heappop(self._queue)
+        self._wake()
+        return 0
+
+    def _remove(self, ticket) -> None:
+        """Gives up a waiter's place in the queue. Called with the lock held."""
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            self._wake()
+
+    def _wake(self) -> None:
+        """Wakes every waiter, in threads and on event loops, to check the queue
+        again. Called with the lock held."""
+        self._cond.notify_all()
+        for loop, event in self._async_waiters.values():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # The loop is closed.
+                pass
+
+    def _record_wait(self, priority: int, start: float) -> float:
+        waited = time.monotonic() - start
+        self._wait_times[priority].append(waited)
+        self.total_requests += 1
+        return waited
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Charges (or refunds) the difference between the estimate and real usage."""
+        with self._cond:
+            self.token_bucket.adjust(actual_tokens - estimated_tokens)
+            self._wake()
+
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            queued = [priority for priority, _ in self._queue]
+            metrics = {"queue_depth": len(queued), "total_requests": self.total_requests}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._wait_times[priority])
+                metrics[f"{name}_queue_depth"] = queued.count(priority)
+                metrics[f"{name}_mean_wait"] = sum(waits) / len(waits) if waits else 0.0
+                metrics[f"{name}_p95_wait"] = waits[int(0.95 * (len(waits) - 1))] if waits else 0.0
+        return metrics
+
+
+def estimate_tokens(params) -> int:
+    """Rough token cost of a request: the approximate prompt size plus the
+    completion budget."""
+    prompt_tokens = sum(approx_count_tokens(str(message.get("content") or ""))
+                        for message in params.get("messages", []))
+    prompt_tokens += approx_count_tokens(str(params.get("functions", "")))
+    prompt_tokens += sum(approx_count_tokens(text) for text in params.get("input", []))
+    return prompt_tokens + (params.get("max_tokens") or 0)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """Returns the process-wide scheduler, creating it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(
+                requests_per_minute=float(os.environ.get("OPENAGI_RPM", 3500)),
+                tokens_per_minute=float(os.environ.get("OPENAGI_TPM", 90000)),
+            )
+        return _scheduler
+
+
+def configure_scheduler(requests_per_minute: float, tokens_per_minute: float) -> RequestScheduler:
+    """Replaces the process-wide scheduler with one using the given budgets."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(requests_per_minute, tokens_per_minute)
+        return _scheduler
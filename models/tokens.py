@@ -0,0 +1,101 @@
+"""
+models/tokens.py
+
+Token counting and budgeting shared by the agents, tools and memory.
+
+Encoders are loaded once per process and reused. approx_count_tokens is a
+cheap estimate for hot paths that don't need an exact count.
+"""
+
+from functools import lru_cache
+
+import tiktoken
+
+# Context window sizes in tokens. Models not listed here are matched by their
+# longest listed prefix, e.g. "gpt-4-0613" uses the "gpt-4" entry.
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "text-embedding-ada-002": 8191,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# English text averages about 4 characters per token.
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-4"):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model: str = "gpt-4"):
+    """Counts the tokens in a string, or in each string of a list."""
+    encoding = get_encoding(model)
+    if isinstance(text, str):
+        return len(encoding.encode(text))
+    return [len(tokens) for tokens in encoding.encode_batch(list(text))]
+
+
+def approx_count_tokens(text: str) -> int:
+    """Estimates the token count from the length of text, without encoding it."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@lru_cache(maxsize=None)
+def context_window(model: str) -> int:
+    if model in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[model]
+    prefixes = [name for name in CONTEXT_WINDOWS if model.startswith(name)]
+    if prefixes:
+        return CONTEXT_WINDOWS[max(prefixes, key=len)]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4", marker: str = "") -> str:
+    """Cuts text down to at most max_tokens tokens, appending marker if it was cut."""
+    # No token is shorter than one character, so short text can skip encoding.
+    if len(text) <= max_tokens:
+        return text
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max(0, max_tokens)]) + marker
+
+
+def remaining_tokens(model: str, max_tokens: int, *sections: str) -> int:
+    """Tokens left in the model's context window after the completion budget
+    (max_tokens) and the given prompt sections."""
+    used = sum(count_tokens(list(sections), model)) if sections else 0
+    return context_window(model) - max_tokens - used
+
+
+if __name__ == "__main__":
+    import time
+
+    texts = [f"Memory {i}: the agent searched for item {i} and found result {i * 7}." for i in range(2000)]
+
+    def bench(name, fn, repeat=3):
+        best = min(_time(fn) for _ in range(repeat))
+        print(f"{name:<45} {best * 1000:8.2f} ms")
+        return best
+
+    def _time(fn):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    uncached = bench("encoding_for_model + encode per text",
+                     lambda: [len(tiktoken.encoding_for_model("gpt-4").encode(t)) for t in texts])
+    cached = bench("cached encoder, count_tokens per text",
+                   lambda: [count_tokens(t) for t in texts])
+    batch = bench("count_tokens(list) batch", lambda: count_tokens(texts))
+    approx = bench("approx_count_tokens per text", lambda: [approx_count_tokens(t) for t in texts])
+    print(f"Speedup vs uncached: cached {uncached / cached:.1f}x, "
+          f"batch {uncached / batch:.1f}x, approx {uncached / approx:.1f}x")
@@ -0,0 +1,135 @@
+"""
+modules/history.py
+
+This class keeps the agent's conversation history within a token budget.
+"""
+
+from collections import deque
+from models.tokens import count_tokens, truncate_to_tokens
+
+# Tokens used by the chat format around each message's content.
+MESSAGE_OVERHEAD_TOKENS = 4
+TRUNCATION_MARKER = "\n[...truncated]"
+
+
+def message_tokens(message: dict, model: str) -> int:
+    return count_tokens(str(message.get("content") or ""), model) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ConversationHistory:
+    """Messages sent to the model on each step, kept within token_budget tokens.
+
+    Pinned messages (e.g. the objective and plan) are always kept. The other
+    messages are kept newest first until the budget runs out. Evicted messages
+    are dropped, or folded into a single running summary message if a
+    summarizer(previous_summary, evicted_messages) -> str is given.
+    Any single message longer than max_message_tokens is truncated on insert.
+
+    The newest turn is never evicted: if it doesn't fit in what the pinned
+    messages and summary leave, its longest messages are truncated instead.
+    Add a prompt and its reply together with append_turn, so that the prompt
+    isn't evicted before its reply arrives.
+    """
+
+    def __init__(self, token_budget=2000, model="gpt-3.5-turbo", summarizer=None, max_message_tokens=None):
+        self.token_budget = token_budget
+        self.model = model
+        self.summarizer = summarizer
+        self.max_message_tokens = max_message_tokens or token_budget // 2
+        self.pinned = []
+        # (message, tokens) pairs, oldest first.
+        self.turns = deque()
+        self.pinned_tokens = 0
+        self.turn_tokens = 0
+        self.summary = None
+        self.summary_tokens = 0
+
+    def pin(self, message: dict) -> None:
+        self.pinned.append(message)
+        self.pinned_tokens += message_tokens(message, self.model)
+        self._fit()
+
+    def append(self, message: dict) -> None:
+        self._add(message)
+        self._fit(newest=1)
+
+    def append_turn(self, *messages: dict) -> None:
+        """Appends a turn, e.g. a user prompt and the assistant's reply."""
+        for message in messages:
+            self._add(message)
+        self._fit(newest=len(messages))
+
+    def _add(self, message: dict) -> None:
+        message = self._truncate(message)
+        tokens = message_tokens(message, self.model)
+        self.turns.append((message, tokens))
+        self.turn_tokens += tokens
+
+    def messages(self) -> list:
+        summary = [self.summary] if self.summary is not None else []
+        return self.pinned + summary + [message for message, _ in self.turns]
+
+    @property
+    def total_tokens(self) -> int:
+        return self.pinned_tokens + self.summary_tokens + self.turn_tokens
+
+    def _truncate(self, message: dict, max_tokens: int = None) -> dict:
+        content = str(message.get("content") or "")
+        max_tokens = self.max_message_tokens if max_tokens is None else max_tokens
+        truncated = truncate_to_tokens(content, max_tokens, self.model, TRUNCATION_MARKER)
+        return message if truncated is content else {**message, "content": truncated}
+
+    def _fit(self, newest: int = 0) -> None:
+        """Evicts the oldest turns until the history fits, keeping the newest
+        messages."""
+        evicted = []
+        while self.total_tokens > self.token_budget and len(self.turns) > newest:
+            message, tokens = self.turns.popleft()
+            self.turn_tokens -= tokens
+            evicted.append(message)
+            # Evict whole turns so the history never starts with a dangling reply.
+            if len(self.turns) > newest and self.turns[0][0]["role"] == "assistant":
+                message, tokens = self.turns.popleft()
+                self.turn_tokens -= tokens
+                evicted.append(message)
+        if evicted and self.summarizer is not None:
+            previous = self.summary["content"] if self.summary is not None else ""
+            self.summary = self._truncate({
+                "role": "system",
+                "content": "Summary of earlier steps:\n" + self.summarizer(previous, evicted),
+            })
+            self.summary_tokens = message_tokens(self.summary, self.model)
+            # The new summary may itself need room; older turns go first.
+            if self.total_tokens > self.token_budget and len(self.turns) > newest:
+                self._fit(newest)
+        if self.total_tokens > self.token_budget and newest:
+            self._shrink_newest(newest)
+
+    def _shrink_newest(self, newest: int) -> None:
+        """Truncates the newest messages, longest first, until they fit."""
+        turns = list(self.turns)
+        for i in sorted(range(len(turns) - newest, len(turns)), key=lambda i: -turns[i][1]):
+            excess = self.total_tokens - self.token_budget
+            if excess <= 0:
+                break
+            message, tokens = turns[i]
+            # The marker comes on top of the truncated content.
+            room = tokens - MESSAGE_OVERHEAD_TOKENS - excess - count_tokens(TRUNCATION_MARKER, self.model)
+            message = self._truncate(message, max(0, room))
+            shrunk = message_tokens(message, self.model)
+            self.turns[i] = (message, shrunk)
+            self.turn_tokens -= tokens - shrunk
+
+
+def llm_summarizer(llm):
+    """Returns a summarizer that asks llm to merge evicted messages into the summary."""
+
+    def summarize(previous_summary, messages):
+        transcript = "\n".join(f"{m['role']}: {m.get('content')}" for m in messages)
+        return llm.generate_chat_completion(
+            "Update the summary of an agent's progress with the new messages. "
+            "Keep facts, results and decisions; drop everything else.\n\n"
+            f"Current summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}"
+        )
+
+    return summarize
@@ -0,0 +1,159 @@
+"""
+memory_stores/ann_index.py
+
+An inverted-file (IVF) index for approximate nearest-neighbour search over a
+matrix of normalized embeddings.
+
+The index clusters the embeddings with spherical k-means and keeps, for each
+centroid, the list of rows closest to it. A query is compared against the
+centroids first and then only against the rows in the nprobe closest lists,
+so raising nprobe trades latency for recall. Below exact_threshold rows the
+index isn't trained and every search is an exact scan.
+
+The embeddings themselves stay in the owning store; the index only holds row
+numbers, and catches up on rows appended since the last search.
+"""
+
+import numpy as np
+
+# Rows scored per chunk when assigning rows to centroids.
+ASSIGN_CHUNK_SIZE = 8192
+
+
+def exact_search(embeddings: np.ndarray, query: np.ndarray, top_k: int):
+    scores = embeddings @ query
+    return select_top_k(np.arange(len(scores)), scores, top_k)
+
+
+def select_top_k(ids: np.ndarray, scores: np.ndarray, top_k: int):
+    """Returns the ids and scores of the top_k highest scores, highest first."""
+    if top_k < len(scores):
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        ids, scores = ids[best], scores[best]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+
+class IVFIndex:
+    def __init__(self, nprobe=8, nlist=None, exact_threshold=10_000, kmeans_iterations=10,
+                 retrain_growth=4.0, seed=0):
+        self.nprobe = nprobe
+        # Number of clusters; defaults to sqrt(rows) when the index is trained.
+        self.nlist = nlist
+        self.exact_threshold = exact_threshold
+        self.kmeans_iterations = kmeans_iterations
+        # Retrain once the store has grown by this factor since the last training,
+        # so the centroids keep up with what the agent remembers.
+        self.retrain_growth = retrain_growth
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.num_indexed = 0
+        self.trained_size = 0
+        self._lists: list[np.ndarray] = []
+        self._list_sizes = None
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def reset(self) -> None:
+        """Forgets all rows, e.g. after the owning store renumbered them."""
+        self.centroids = None
+        self.num_indexed = 0
+        self.trained_size = 0
+        self._lists = []
+        self._list_sizes = None
+
+    def update(self, embeddings: np.ndarray) -> None:
+        """Indexes the rows of embeddings added since the last update."""
+        size = len(embeddings)
+        if size < self.exact_threshold:
+            return
+        if not self.trained or size >= self.retrain_growth * self.trained_size:
+            self.train(embeddings)
+        elif size > self.num_indexed:
+            self._assign(embeddings, self.num_indexed, size)
+
+    def train(self, embeddings: np.ndarray) -> None:
+        size = len(embeddings)
+        nlist = self.nlist or max(1, int(np.sqrt(size)))
+        # Cluster a sample; a few dozen points per centroid is plenty.
+        sample_size = min(size, 64 * nlist)
+        sample = embeddings[np.sort(self.rng.choice(size, sample_size, replace=False))]
+        centroids = sample[self.rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their previous centroid.
+            np.divide(sums, norms, out=centroids, where=norms > 0)
+
+        self.centroids = centroids
+        self._lists = [np.empty(16, dtype=np.int64) for _ in range(nlist)]
+        self._list_sizes = np.zeros(nlist, dtype=np.int64)
+        self.num_indexed = 0
+        self.trained_size = size
+        self._assign(embeddings, 0, size)
+
+    def _assign(self, embeddings: np.ndarray, start: int, end: int) -> None:
+        for chunk_start in range(start, end, ASSIGN_CHUNK_SIZE):
+            chunk_end = min(end, chunk_start + ASSIGN_CHUNK_SIZE)
+            assignments = np.argmax(embeddings[chunk_start:chunk_end] @ self.centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            lists, starts = np.unique(assignments[order], return_index=True)
+            for list_id, ids in zip(lists, np.split(order + chunk_start, starts[1:])):
+                self._extend(list_id, ids)
+        self.num_indexed = end
+
+    def _extend(self, list_id: int, ids: np.ndarray) -> None:
+        size = self._list_sizes[list_id]
+        if size + len(ids) > len(self._lists[list_id]):
+            grown = np.empty(max(2 * len(self._lists[list_id]), size + len(ids)), dtype=np.int64)
+            grown[:size] = self._lists[list_id][:size]
+            self._lists[list_id] = grown
+        self._lists[list_id][size:size + len(ids)] = ids
+        self._list_sizes[list_id] = size + len(ids)
+
+    def search(self, embeddings: np.ndarray, query: np.ndarray, top_k: int, nprobe: int = None):
+        """Returns the rows of the (approximately) top_k most similar embeddings
+        to the normalized query and their similarities, highest first."""
+        self.update(embeddings)
+        if not self.trained or top_k <= 0:
+            return exact_search(embeddings, query, top_k)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        candidates = np.concatenate([self._lists[i][:self._list_sizes[i]] for i in probed])
+        return select_top_k(candidates, embeddings[candidates] @ query, top_k)
+
+
+if __name__ == "__main__":
+    import time
+
+    # Synthetic memories: noisy points around a few hundred topics, which is
+    # closer to real embeddings than uniformly random vectors.
+    rng = np.random.default_rng(0)
+    num_items, dim, num_topics, num_queries, top_k = 100_000, 256, 500, 200, 10
+    topics = rng.standard_normal((num_topics, dim), dtype=np.float32)
+    embeddings = topics[rng.integers(num_topics, size=num_items)] + 1.5 * rng.standard_normal((num_items, dim), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    queries = topics[rng.integers(num_topics, size=num_queries)] + 1.5 * rng.standard_normal((num_queries, dim), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    start = time.perf_counter()
+    truth = [set(exact_search(embeddings, query, top_k)[0]) for query in queries]
+    exact = (time.perf_counter() - start) / num_queries
+    print(f"{num_items} items x {dim} dims, recall@{top_k} over {num_queries} queries")
+    print(f"exact       {exact * 1000:7.3f} ms/query  recall 1.000")
+
+    index = IVFIndex()
+    start = time.perf_counter()
+    index.update(embeddings)
+    print(f"trained {len(index.centroids)} lists in {time.perf_counter() - start:.2f}s")
+    for nprobe in [1, 2, 4, 8, 16, 32]:
+        start = time.perf_counter()
+        results = [index.search(embeddings, query, top_k, nprobe=nprobe)[0] for query in queries]
+        elapsed = (time.perf_counter() - start) / num_queries
+        recall = np.mean([len(truth[i] & set(ids)) / top_k for i, ids in enumerate(results)])
+        print(f"nprobe={nprobe:<4d} {elapsed * 1000:7.3f} ms/query  recall {recall:.3f}  "
+              f"({exact / elapsed:.0f}x faster)")
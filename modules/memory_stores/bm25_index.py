@@ -0,0 +1,108 @@
+"""
+memory_stores/bm25_index.py
+
+An incremental inverted index with BM25 scoring over the values of a store.
+
+Embeddings are poor at exact identifiers such as URLs, dates and email
+addresses, which BM25 matches term for term. Like the IVF index, this index
+is keyed by row and catches up lazily: rows added since the last search are
+tokenized on the next one, so stores that never search lexically (and stores
+just loaded from disk) pay nothing for it.
+"""
+
+import re
+from collections import Counter
+
+import numpy as np
+
+# Letters and digits; identifiers like "bob@example.com" or "2023-06-01" are
+# split into their parts, and a query containing them is split the same way.
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_indexed = 0
+        self.total_length = 0
+        self._doc_lengths = np.zeros(0, dtype=np.float32)
+        # term -> ([row, ...], [term frequency, ...])
+        self._postings: dict[str, tuple[list[int], list[int]]] = {}
+        # term -> the postings as arrays, rebuilt after the term changes.
+        self._arrays: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+    def reset(self) -> None:
+        """Forgets all rows, e.g. after the owning store renumbered them."""
+        self.__init__(self.k1, self.b)
+
+    def update(self, values, size: int) -> None:
+        """Indexes values[num_indexed:size]."""
+        if size <= self.num_indexed:
+            return
+        if size > len(self._doc_lengths):
+            grown = np.zeros(max(size, 2 * len(self._doc_lengths)), dtype=np.float32)
+            grown[:self.num_indexed] = self._doc_lengths[:self.num_indexed]
+            self._doc_lengths = grown
+        for row in range(self.num_indexed, size):
+            self._add(row, values[row])
+        self.num_indexed = size
+
+    def _add(self, row: int, value: str) -> None:
+        terms = tokenize(value)
+        for term, count in Counter(terms).items():
+            rows, counts = self._postings.setdefault(term, ([], []))
+            rows.append(row)
+            counts.append(count)
+            self._arrays.pop(term, None)
+        self._doc_lengths[row] = len(terms)
+        self.total_length += len(terms)
+
+    def replace(self, row: int, old_value: str, new_value: str) -> None:
+        """Re-indexes a row whose value changed. Rows not indexed yet are
+        picked up with their new value by the next update."""
+        if row >= self.num_indexed:
+            return
+        for term in set(tokenize(old_value)):
+            rows, counts = self._postings[term]
+            position = rows.index(row)
+            del rows[position], counts[position]
+            self._arrays.pop(term, None)
+        self.total_length -= int(self._doc_lengths[row])
+        self._add(row, new_value)
+
+    def _term_arrays(self, term: str):
+        if term not in self._arrays:
+            rows, counts = self._postings[term]
+            self._arrays[term] = (np.array(rows, dtype=np.int64), np.array(counts, dtype=np.float32))
+        return self._arrays[term]
+
+    def scores(self, query: str, size: int) -> np.ndarray:
+        """BM25 score of every row (0 where no query term occurs)."""
+        scores = np.zeros(size, dtype=np.float32)
+        if self.num_indexed == 0:
+            return scores
+        average_length = self.total_length / self.num_indexed or 1.0
+        doc_lengths = self._doc_lengths[:self.num_indexed]
+        for term in set(tokenize(query)):
+            if term not in self._postings or not self._postings[term][0]:
+                continue
+            rows, counts = self._term_arrays(term)
+            idf = np.log(1 + (self.num_indexed - len(rows) + 0.5) / (len(rows) + 0.5))
+            norms = self.k1 * (1 - self.b + self.b * doc_lengths[rows] / average_length)
+            scores[rows] += idf * counts * (self.k1 + 1) / (counts + norms)
+        return scores
+
+
+def reciprocal_rank_fusion(rankings: list[np.ndarray], top_k: int, k: int = 60) -> np.ndarray:
+    """Merges ranked lists of rows; each row scores sum(1 / (k + rank)) over
+    the lists it appears in. Returns the top_k rows, best first."""
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking.tolist()):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return np.array(sorted(fused, key=fused.get, reverse=True)[:top_k], dtype=np.int64)
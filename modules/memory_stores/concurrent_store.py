@@ -0,0 +1,155 @@
+"""
+memory_stores/concurrent_store.py
+
+A VectorStore that several agents or worker threads can query at once.
+
+VectorStore guards its arrays with one lock, so queries run one at a time even
+though the matrix products behind them release the GIL. ConcurrentVectorStore
+swaps it for a reader-writer lock: any number of queries share it, and writers
+(inserts, deletes, updates, the end of a compaction) take it alone. Writers
+only hold it to write a row or swap arrays; embedding, rating and the copy of a
+compaction all happen outside it, so queries wait on inserts for microseconds
+at most. Waiting writers go first, so a steady stream of queries can't starve
+the background insert thread.
+"""
+
+import threading
+
+from modules.memory_stores.vector_store import VectorStore
+
+
+class ReadWriteLock:
+    """A lock held by many readers or by one writer.
+
+    The write side is reentrant, like the RLock it replaces; the read side
+    isn't, and can't be taken by a thread holding the write side."""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # Ident of the thread holding the write side.
+        self._write_depth = 0
+        self._waiting_writers = 0
+        self.read = _LockSide(self.acquire_read, self.release_read)
+        self.write = _LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self) -> None:
+        with self._condition:
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self) -> None:
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self) -> None:
+        with self._condition:
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._writer = None
+                self._condition.notify_all()
+
+
+class _LockSide:
+    """One side of a ReadWriteLock, usable in a with statement."""
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ConcurrentVectorStore(VectorStore):
+    """A VectorStore whose queries run in parallel. Takes the same arguments.
+
+    Access counts are bumped under the shared lock, so concurrent queries can
+    occasionally lose an increment; they only feed eviction, where that
+    doesn't matter."""
+
+    def __init__(self, *args, **kwargs):
+        # The BM25 and IVF indexes catch up with new rows lazily during
+        # queries, so searching them is serialized.
+        self._index_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _make_locks(self):
+        rw_lock = ReadWriteLock()
+        return rw_lock.write, rw_lock.read
+
+    def _search_lexical(self, query_string: str, top_k: int):
+        with self._index_lock:
+            return super()._search_lexical(query_string, top_k)
+
+    def _search_index(self, query_embedding, top_k: int):
+        with self._index_lock:
+            return super()._search_index(query_embedding, top_k)
+
+
+if __name__ == "__main__":
+    import time
+    import numpy as np
+    from models.local_embedding import LocalEmbeddingModel
+
+    # Queries per second against 100k memories, with a writer inserting
+    # continuously. Parallel speedup needs as many cores as threads.
+    num_items, duration = 100_000, 2.0
+    embedding_model = LocalEmbeddingModel()
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((num_items, embedding_model.dim), dtype=np.float32)
+    queries = [f"what did the agent learn about topic {i}" for i in range(64)]
+
+    for store_class in [VectorStore, ConcurrentVectorStore]:
+        store = store_class("{} {}", "", embedding_model=embedding_model)
+        for i, vector in enumerate(vectors):
+            store._append(vector, f"memory {i}", i, i % 10)
+        store.time_counter = num_items
+
+        for num_threads in [1, 2, 4, 8]:
+            stop = threading.Event()
+            counts = [0] * num_threads
+            inserted = [0]
+
+            def read(thread):
+                while not stop.is_set():
+                    store.query(queries[counts[thread] % len(queries)], 10)
+                    counts[thread] += 1
+
+            def write():
+                while not stop.is_set():
+                    with store._lock:
+                        store._append(vectors[inserted[0] % num_items], "new memory", store.time_counter, 5)
+                    inserted[0] += 1
+                    time.sleep(0.001)
+
+            threads = [threading.Thread(target=read, args=(i,)) for i in range(num_threads)]
+            threads.append(threading.Thread(target=write))
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            print(f"{store_class.__name__:21s} {num_threads} query threads: "
+                  f"{sum(counts) / duration:7.1f} queries/s, {inserted[0] / duration:6.1f} inserts/s")
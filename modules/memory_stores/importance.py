@@ -0,0 +1,65 @@
+"""
+memory_stores/importance.py
+
+Rates the importance of memories with an LLM, several memories per prompt.
+
+The rating prompt asks for "FORMAT: <rating>" per memory, but models don't
+always comply, so replies are parsed leniently: FORMAT: markers first, then
+one number per line, and memories whose rating can't be recovered keep their
+provisional importance instead of failing the insert.
+"""
+
+import re
+
+# Importance a memory has until (or unless) the LLM rates it.
+PROVISIONAL_IMPORTANCE = 5
+MIN_RATING = 1
+MAX_RATING = 10
+
+NUMBER = r"\d+(?:\.\d+)?"
+
+BATCH_INSTRUCTIONS = """
+There are {count} numbered memories above. Rate each one separately, one line
+per memory, in order, using the format: <number>. FORMAT: <rating>
+"""
+
+
+def clamp(rating: float) -> float:
+    return float(min(MAX_RATING, max(MIN_RATING, rating)))
+
+
+def parse_ratings(text: str, count: int) -> list:
+    """Returns count ratings parsed from an LLM reply, with None for each one
+    that couldn't be recovered."""
+    ratings = re.findall(r"FORMAT:\s*(" + NUMBER + ")", text, flags=re.IGNORECASE)
+    if len(ratings) != count:
+        # One rating per line, e.g. "2. 7" or "Memory 2: 7/10"; the rating is
+        # the first number after the memory's own number, if there is one.
+        ratings = []
+        for line in text.splitlines():
+            numbers = re.findall(NUMBER, line)
+            if not numbers:
+                continue
+            numbered = count > 1 and re.match(r"\s*\W*\s*(?:memory\s*)?\d+\s*[.):]", line, flags=re.IGNORECASE)
+            if numbered and len(numbers) > 1:
+                ratings.append(numbers[1])
+            elif not numbered:
+                ratings.append(numbers[0])
+    if len(ratings) != count:
+        return [None] * count
+    return [clamp(float(rating)) for rating in ratings]
+
+
+def rating_prompt(importance_prompt, values: list[str]) -> str:
+    """Builds one prompt rating all values. importance_prompt formats the
+    prompt for a single memory."""
+    if len(values) == 1:
+        return importance_prompt(values[0])
+    memories = "\n".join(f"{i + 1}. {value}" for i, value in enumerate(values))
+    return importance_prompt(memories) + BATCH_INSTRUCTIONS.format(count=len(values))
+
+
+def rate(llm, importance_prompt, values: list[str]) -> list:
+    """Rates values with a single LLM call. Returns a rating or None for each."""
+    response = llm.generate_chat_completion(rating_prompt(importance_prompt, values))
+    return parse_ratings(response, len(values))
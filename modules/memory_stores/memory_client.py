@@ -0,0 +1,223 @@
+"""
+memory_stores/memory_client.py
+
+Client of a memory server (see memory_server.py).
+
+RemoteVectorStore has the add/query/query_recent API of VectorStore, backed by
+a named store on the server, so agents in different processes share one warm
+index and never embed the same memory twice. Calls from every thread of a
+process go through one MemoryClient, which runs an aiohttp session on a
+background event loop and batches them: operations submitted while earlier
+requests are in flight go out together in the next request.
+
+Set OPENAGI_MEMORY_SERVER to the server's address to make the agent keep its
+memory there, in a store named after its objective unless OPENAGI_MEMORY_STORE
+names one.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import threading
+from typing import List
+
+import aiohttp
+import numpy as np
+
+from modules.memory_stores.memory_server import decode_frame, encode_frame, get_address
+
+# Most operations sent in one request.
+MAX_BATCH_SIZE = 256
+
+
+class MemoryClient:
+    """A connection to a memory server, safe to share between threads.
+
+    At most max_in_flight requests are sent at a time; everything submitted
+    meanwhile queues up and is sent in batches of up to max_batch_size."""
+
+    def __init__(self, address: str = None, max_in_flight=4, max_batch_size=MAX_BATCH_SIZE, timeout=60):
+        self.address = address or get_address()
+        self.max_in_flight = max_in_flight
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.requests_sent = 0
+        self.operations_sent = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    async def _start(self) -> None:
+        if self.address.startswith("unix:"):
+            connector = aiohttp.UnixConnector(path=self.address[len("unix:"):])
+            self._url = "http://localhost/batch"
+        else:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60)
+            self._url = self.address.rstrip("/") + "/batch"
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._pending = asyncio.Queue()
+        self._senders = [asyncio.ensure_future(self._send_batches()) for _ in range(self.max_in_flight)]
+
+    def submit(self, ops: list[dict], arrays: list = None) -> list[concurrent.futures.Future]:
+        """Queues operations, all of which go out in the same request, and
+        returns a future of each one's result. arrays[i] is sent along with
+        ops[i] if it isn't None."""
+        entries = [(op, arrays[i] if arrays is not None else None, concurrent.futures.Future())
+                   for i, op in enumerate(ops)]
+
+        def enqueue():
+            for entry in entries:
+                self._pending.put_nowait(entry)
+
+        self._loop.call_soon_threadsafe(enqueue)
+        return [future for _, _, future in entries]
+
+    def call(self, op: dict, array: np.ndarray = None):
+        """Runs one operation and returns its result."""
+        return self.submit([op], [array])[0].result(self.timeout)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embeddings of texts from the server's model."""
+        return self.call({"op": "embed", "texts": list(texts)})
+
+    async def _send_batches(self) -> None:
+        while True:
+            batch = [await self._pending.get()]
+            while len(batch) < self.max_batch_size and not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+            try:
+                await self._send(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _send(self, batch) -> None:
+        ops, arrays = [], []
+        for op, array, _ in batch:
+            if array is not None:
+                op = dict(op, embedding=len(arrays))
+                arrays.append(array)
+            ops.append(op)
+        async with self._session.post(
+            self._url,
+            data=encode_frame({"ops": ops}, arrays),
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        ) as response:
+            response.raise_for_status()
+            header, result_arrays = decode_frame(await response.read())
+        self.requests_sent += 1
+        self.operations_sent += len(batch)
+        for (_, _, future), result in zip(batch, header["results"]):
+            if isinstance(result, dict) and "error" in result:
+                future.set_exception(RuntimeError(result["error"]))
+            elif isinstance(result, dict) and "embeddings" in result:
+                future.set_result(result_arrays[result["embeddings"]])
+            else:
+                future.set_result(result)
+
+    def close(self) -> None:
+        async def close():
+            for sender in self._senders:
+                sender.cancel()
+            await self._session.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+class RemoteVectorStore:
+    """A named store on a memory server, used like a VectorStore.
+
+    The store is created on first open; options are VectorStore arguments
+    (e.g. dedup_threshold, max_items) used only then."""
+
+    def __init__(self, name: str, importance_prompt: str, objective: str, client: MemoryClient = None, **options):
+        self.name = name
+        self.client = client if client is not None else get_default_client()
+        self.client.call({"op": "open", "store": name, "importance_prompt": importance_prompt,
+                          "objective": objective, "options": options})
+
+    def add(self, value: str, embedding=None) -> int:
+        return self.client.call({"op": "add", "store": self.name, "value": value}, embedding)
+
+    def query(self, query_string: str, top_k: int) -> List[str]:
+        return self.client.call({"op": "query", "store": self.name, "query": query_string, "top_k": top_k})
+
+    def query_many(self, query_strings: List[str], top_k: int) -> List[List[str]]:
+        futures = self.client.submit([{"op": "query", "store": self.name, "query": query_string, "top_k": top_k}
+                                      for query_string in query_strings])
+        return [future.result(self.client.timeout) for future in futures]
+
+    def query_recent(self, top_k: int) -> List[str]:
+        return self.client.call({"op": "query_recent", "store": self.name, "top_k": top_k})
+
+    def flush(self) -> None:
+        self.client.call({"op": "flush", "store": self.name})
+
+    def __len__(self) -> int:
+        return self.client.call({"op": "len", "store": self.name})
+
+    def empty(self) -> bool:
+        return len(self) == 0
+
+
+_default_client = None
+
+
+def get_default_client() -> MemoryClient:
+    """Returns the process-wide client of the server at OPENAGI_MEMORY_SERVER."""
+    global _default_client
+    if _default_client is None:
+        _default_client = MemoryClient()
+        atexit.register(_default_client.close)
+    return _default_client
+
+
+if __name__ == "__main__":
+    import json
+    import time
+    from models.local_embedding import LocalEmbeddingModel
+    from modules.memory_stores.memory_server import MemoryServer
+
+    # A server in this process, holding 20k memories, queried by 8 threads
+    # standing in for agent processes.
+    server = MemoryServer(embedding_model=LocalEmbeddingModel())
+    server_loop = asyncio.new_event_loop()
+    threading.Thread(target=server_loop.run_forever, daemon=True).start()
+    address = "http://127.0.0.1:8799"
+    asyncio.run_coroutine_threadsafe(server.start(address), server_loop).result()
+
+    rng = np.random.default_rng(0)
+    setup = MemoryClient(address)
+    RemoteVectorStore("bench", "{} {}", "", client=setup)
+    for i, vector in enumerate(rng.standard_normal((20_000, server.model.dim), dtype=np.float32)):
+        server.stores["bench"]._append(vector, f"memory {i}", i, 5)
+    setup.close()
+
+    num_threads, queries_per_thread = 8, 100
+    for max_batch_size in [1, MAX_BATCH_SIZE]:
+        client = MemoryClient(address, max_batch_size=max_batch_size)
+        store = RemoteVectorStore("bench", "{} {}", "", client=client)
+
+        def run(thread):
+            for i in range(queries_per_thread):
+                store.query(f"agent {thread} asks about topic {i}", 10)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print(f"max_batch_size={max_batch_size:3d}: {num_threads * queries_per_thread / elapsed:6.1f} queries/s, "
+              f"{client.operations_sent / client.requests_sent:.1f} operations/request")
+        client.close()
+
+    vector = rng.standard_normal(1536).astype(np.float32)
+    print(f"A 1536-dim vector: {len(encode_frame({}, [vector]))} bytes framed, "
+          f"{len(json.dumps(vector.tolist()))} bytes as JSON")
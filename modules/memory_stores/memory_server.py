@@ -0,0 +1,239 @@
+"""
+memory_stores/memory_server.py
+
+Hosts named vector stores shared by several agent processes.
+
+An agent process that builds its own VectorStore re-embeds facts other agents
+already embedded and warms up its own copy of the index. A MemoryServer keeps
+one ConcurrentVectorStore per name, and one embedding model shared by all of
+them, behind localhost HTTP or a Unix socket. Clients (see memory_client.py)
+POST batches of operations to /batch:
+
+    open          create or open a store: importance_prompt, objective, options
+    add           value, and optionally an embedding from the server's model
+    query         query and top_k; a batch's queries on one store are answered
+                  by a single query_many call
+    query_recent  top_k
+    len           number of items in the store
+    flush         wait until the store's pending adds are embedded and rated
+    embed         texts; returns their embeddings from the shared model
+
+Opens run first, then adds, then the rest. Requests and responses are frames:
+a little-endian uint32 header length, a JSON header, then the raw float32
+bytes of every array the header lists. A vector costs 4 bytes per dimension
+instead of ~20 as JSON text.
+
+Run it with python -m modules.memory_stores.memory_server. It listens on
+OPENAGI_MEMORY_SERVER (http://127.0.0.1:8765 by default, or unix:<path>) and
+keeps stores under OPENAGI_MEMORY_DIRECTORY if that is set.
+"""
+
+import asyncio
+import json
+import os
+import re
+import struct
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+from aiohttp import web
+
+from models.embedding import BaseEmbeddingModel, EmbeddingModel
+from modules.memory_stores.concurrent_store import ConcurrentVectorStore
+
+DEFAULT_ADDRESS = "http://127.0.0.1:8765"
+FRAME_HEADER = struct.Struct("<I")
+# Store names double as directory names.
+STORE_NAME = re.compile(r"[A-Za-z0-9_.-]+")
+# Operations that run before the others in a batch, in this order.
+FIRST_OPERATIONS = ("open", "add")
+# Seconds between checks of whether a store being flushed has caught up.
+FLUSH_POLL_INTERVAL = 0.05
+
+
+def get_address() -> str:
+    return os.environ.get("OPENAGI_MEMORY_SERVER", DEFAULT_ADDRESS)
+
+
+def encode_frame(header: dict, arrays=()) -> bytes:
+    arrays = [np.ascontiguousarray(array, dtype="<f4") for array in arrays]
+    encoded = json.dumps(dict(header, arrays=[list(array.shape) for array in arrays])).encode("utf-8")
+    return b"".join([FRAME_HEADER.pack(len(encoded)), encoded] + [array.tobytes() for array in arrays])
+
+
+def decode_frame(data: bytes):
+    """Returns the header and the arrays of a frame."""
+    (length,) = FRAME_HEADER.unpack_from(data)
+    header = json.loads(data[FRAME_HEADER.size:FRAME_HEADER.size + length])
+    arrays = []
+    position = FRAME_HEADER.size + length
+    for shape in header.pop("arrays", []):
+        count = int(np.prod(shape))
+        arrays.append(np.frombuffer(data, dtype="<f4", count=count, offset=position).reshape(shape))
+        position += 4 * count
+    return header, arrays
+
+
+class MemoryServer:
+    def __init__(self, directory: str = None, embedding_model: BaseEmbeddingModel = None,
+                 store_class=ConcurrentVectorStore):
+        self.directory = directory
+        self.model = embedding_model if embedding_model is not None else EmbeddingModel()
+        self.store_class = store_class
+        self.stores = {}
+        self._stores_lock = threading.Lock()
+        self._handlers = {
+            "open": self._open,
+            "add": self._add,
+            "query": self._query,
+            "query_recent": self._query_recent,
+            "len": self._len,
+            "flush": self._flush,
+            "embed": self._embed,
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 2**20)
+        app.router.add_post("/batch", self.handle_batch)
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def start(self, address: str = None) -> web.AppRunner:
+        """Starts serving on address and returns the runner; cleanup() stops it."""
+        address = address or get_address()
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        if address.startswith("unix:"):
+            site = web.UnixSite(runner, address[len("unix:"):])
+        else:
+            url = urlparse(address)
+            site = web.TCPSite(runner, url.hostname, url.port)
+        await site.start()
+        return runner
+
+    async def handle_batch(self, request: web.Request) -> web.Response:
+        header, arrays = decode_frame(await request.read())
+        # Off the event loop, so that batches from different clients run in
+        # parallel against the stores.
+        results, result_arrays = await asyncio.to_thread(self.run_batch, header["ops"], arrays)
+        # Flushes wait here, on the event loop, so that a slow one doesn't
+        # hold a thread of the pool other clients' batches run on.
+        for i, op in enumerate(header["ops"]):
+            if op.get("op") == "flush" and results[i] is None:
+                results[i] = await self._wait_for_flush(op["store"])
+        return web.Response(body=encode_frame({"results": results}, result_arrays),
+                            content_type="application/octet-stream")
+
+    def run_batch(self, ops: list[dict], arrays: list[np.ndarray]):
+        """Runs a batch of operations. Returns a result for every operation,
+        {"error": message} for a failed one, and the arrays results refer to.
+        Flushes only check that their store is open; handle_batch then waits
+        for them."""
+        results = [None] * len(ops)
+        result_arrays = []
+        groups = {}
+        for i, op in enumerate(ops):
+            groups.setdefault((op.get("op"), op.get("store")), []).append(i)
+
+        def order(group):
+            kind = group[0][0]
+            return FIRST_OPERATIONS.index(kind) if kind in FIRST_OPERATIONS else len(FIRST_OPERATIONS)
+
+        for (kind, name), indices in sorted(groups.items(), key=order):
+            try:
+                if kind not in self._handlers:
+                    raise ValueError(f"Unknown operation {kind!r}")
+                group_results = self._handlers[kind](name, [ops[i] for i in indices], arrays, result_arrays)
+            except Exception as e:
+                group_results = [{"error": f"{type(e).__name__}: {e}"}] * len(indices)
+            for i, result in zip(indices, group_results):
+                results[i] = result
+        return results, result_arrays
+
+    def _store(self, name: str):
+        if name not in self.stores:
+            raise ValueError(f"Store {name!r} isn't open")
+        return self.stores[name]
+
+    def _open(self, name, ops, arrays, result_arrays):
+        if not isinstance(name, str) or not STORE_NAME.fullmatch(name):
+            raise ValueError(f"Invalid store name {name!r}")
+        with self._stores_lock:
+            if name not in self.stores:
+                op = ops[0]
+                directory = os.path.join(self.directory, name) if self.directory is not None else None
+                self.stores[name] = self.store_class(op["importance_prompt"], op["objective"],
+                                                     embedding_model=self.model, directory=directory,
+                                                     **op.get("options", {}))
+        return [None] * len(ops)
+
+    def _add(self, name, ops, arrays, result_arrays):
+        store = self._store(name)
+        results = []
+        # One client's bad add (e.g. an embedding of the wrong size) doesn't
+        # fail the others batched with it.
+        for op in ops:
+            try:
+                results.append(store.add(op["value"], arrays[op["embedding"]] if "embedding" in op else None))
+            except Exception as e:
+                results.append({"error": f"{type(e).__name__}: {e}"})
+        return results
+
+    def _query(self, name, ops, arrays, result_arrays):
+        top_k = max(op["top_k"] for op in ops)
+        results = self._store(name).query_many([op["query"] for op in ops], top_k)
+        return [result[:op["top_k"]] for op, result in zip(ops, results)]
+
+    def _query_recent(self, name, ops, arrays, result_arrays):
+        store = self._store(name)
+        return [store.query_recent(op["top_k"]) for op in ops]
+
+    def _len(self, name, ops, arrays, result_arrays):
+        return [len(self._store(name))] * len(ops)
+
+    def _flush(self, name, ops, arrays, result_arrays):
+        self._store(name)
+        return [None] * len(ops)
+
+    async def _wait_for_flush(self, name: str):
+        store = self.stores[name]
+        while store.pending():
+            await asyncio.sleep(FLUSH_POLL_INTERVAL)
+        try:
+            store.flush()
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+        return None
+
+    def _embed(self, name, ops, arrays, result_arrays):
+        texts = [text for op in ops for text in op["texts"]]
+        embeddings = np.asarray(self.model.get_embeddings(texts) if texts else np.empty((0, 0)), dtype=np.float32)
+        results = []
+        start = 0
+        for op in ops:
+            results.append({"embeddings": len(result_arrays)})
+            result_arrays.append(embeddings[start:start + len(op["texts"])])
+            start += len(op["texts"])
+        return results
+
+    async def _close(self, app) -> None:
+        for store in list(self.stores.values()):
+            await asyncio.to_thread(store.close)
+
+
+async def serve(server: MemoryServer, address: str = None) -> None:
+    address = address or get_address()
+    runner = await server.start(address)
+    print(f"Memory server listening on {address}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(MemoryServer(os.environ.get("OPENAGI_MEMORY_DIRECTORY"))))
+    except KeyboardInterrupt:
+        pass
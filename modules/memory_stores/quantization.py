@@ -0,0 +1,140 @@
+"""
+memory_stores/quantization.py
+
+Compact storage of embeddings for large vector stores.
+
+An embedding can be kept as float16, or as int8 with one float32 scale per
+vector (symmetric, so row * scale approximates the original). A
+QuantizedMatrix wraps such a matrix so that it can be scored like a float32
+one: it is converted to float32 a chunk at a time, so no full-size float32
+copy is ever made.
+
+Quantized scores are close but not exact, so the full-precision vectors are
+also written to a VectorFile on disk and the best candidates are re-ranked
+against them.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+MODES = ("int8", "float16")
+DTYPES = {None: np.float32, "int8": np.int8, "float16": np.float16}
+
+# Rows converted to float32 at a time when scanning a quantized matrix. Small
+# enough for the converted chunk to stay in cache for the matrix product.
+SCAN_CHUNK_SIZE = 256
+
+
+def quantize(embedding: np.ndarray, mode: str):
+    """Returns (stored vector, scale) for a normalized float32 embedding."""
+    if mode == "int8":
+        scale = float(np.abs(embedding).max()) / 127 or 1.0
+        return np.round(embedding / scale).astype(np.int8), scale
+    return embedding.astype(DTYPES[mode]), 1.0
+
+
+class QuantizedMatrix:
+    """A read-only float32 view of a quantized (rows, dim) matrix."""
+
+    def __init__(self, data: np.ndarray, scales: np.ndarray):
+        self.data = data
+        self.scales = scales
+        self.shape = (data.shape[0], data.shape[1] if data.ndim == 2 else 0)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index) -> np.ndarray:
+        rows = self.data[index].astype(np.float32)
+        scales = self.scales[index]
+        return rows * (scales[..., None] if rows.ndim == 2 else scales)
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        result = np.empty((len(self.data),) + other.shape[1:], dtype=np.float32)
+        buffer = np.empty((SCAN_CHUNK_SIZE, self.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.data), SCAN_CHUNK_SIZE):
+            chunk = self.data[start:start + SCAN_CHUNK_SIZE]
+            converted = buffer[:len(chunk)]
+            converted[...] = chunk
+            result[start:start + len(chunk)] = converted @ other
+        scales = self.scales[:len(self.data)]
+        return result * (scales[:, None] if result.ndim == 2 else scales)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.scales.nbytes
+
+
+class VectorFile:
+    """Full-precision float32 vectors stored on disk by item id.
+
+    Ids are never reused, so row id of the file always holds item id. Reads go
+    through a memory map, so only the rows actually re-ranked are paged in.
+    Without a path, the file is an anonymous temporary file."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.dim = None
+        self._mmap = None
+
+    def write(self, item_id: int, vector: np.ndarray) -> None:
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        self.dim = len(vector)
+        self._file.seek(item_id * 4 * self.dim)
+        self._file.write(vector.tobytes())
+        self._file.flush()
+
+    def read(self, item_ids: np.ndarray, dim: int) -> np.ndarray:
+        num_rows = os.fstat(self._file.fileno()).st_size // (4 * dim)
+        if self._mmap is None or len(self._mmap) < num_rows:
+            self._mmap = np.memmap(self._file, dtype=np.float32, mode="r", shape=(num_rows, dim))
+        return self._mmap[item_ids]
+
+    def copy_to(self, path: str) -> None:
+        self._file.flush()
+        self._file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self._file, f)
+
+    def close(self) -> None:
+        self._mmap = None
+        self._file.close()
+
+
+if __name__ == "__main__":
+    import time
+    from models.local_embedding import LocalEmbeddingModel
+    from modules.memory_stores.vector_store import VectorStore
+
+    # Synthetic clustered memories, as in ann_index.py.
+    rng = np.random.default_rng(0)
+    num_items, dim, num_topics, num_queries, top_k = 50_000, 1536, 500, 100, 10
+    topics = rng.standard_normal((num_topics, dim), dtype=np.float32)
+    embeddings = topics[rng.integers(num_topics, size=num_items)] + 1.5 * rng.standard_normal((num_items, dim), dtype=np.float32)
+    queries = topics[rng.integers(num_topics, size=num_queries)] + 1.5 * rng.standard_normal((num_queries, dim), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    results = {}
+    for mode in [None, "float16", "int8"]:
+        store = VectorStore("{} {}", "", embedding_model=LocalEmbeddingModel(), quantization=mode)
+        for i, embedding in enumerate(embeddings):
+            store._append(embedding, str(i), i, 5)
+        matrix_bytes = store.embeddings.nbytes
+        for rerank in ([False, True] if mode else [False]):
+            start = time.perf_counter()
+            results[mode, rerank] = [store._search(query, top_k, rerank=rerank) for query in queries]
+            elapsed = (time.perf_counter() - start) / num_queries
+            truth = results[None, False]
+            recall = np.mean([len(set(truth[i]) & set(rows)) / top_k for i, rows in enumerate(results[mode, rerank])])
+            print(f"{str(mode):8s} rerank={str(rerank):5s} {matrix_bytes / num_items:5.0f} B/item "
+                  f"({embeddings.nbytes / matrix_bytes:.1f}x smaller than float32, "
+                  f"{2 * embeddings.nbytes / matrix_bytes:.1f}x than float64)  "
+                  f"{elapsed * 1000:6.2f} ms/query  recall@{top_k} {recall:.3f}")
+        store.close()
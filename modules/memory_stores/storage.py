@@ -0,0 +1,289 @@
+"""
+memory_stores/storage.py
+
+On-disk format of a persistent VectorStore.
+
+A store directory holds numbered snapshot generations and a CURRENT file
+naming the live one:
+
+    CURRENT                  {"generation": 3}
+    3/meta.json              dim, size, next id and time counter
+    3/ids.npy                (size,) int64 item ids, ascending
+    3/embeddings.npy         (size, dim) normalized, float32 unless quantized
+    3/scales.npy             (size,) float32 int8 scales, 1 otherwise
+    3/timestamps.npy         (size,) float64
+    3/importances.npy        (size,) float32
+    3/counts.npy             (size,) int32 times the item was added, with duplicates
+    3/accesses.npy           (size,) int32 times the item was returned by a query
+    3/values.npy             UTF-8 bytes of every value, concatenated
+    3/offsets.npy            (size + 1,) int64 offsets into values.npy
+    3/append.log             changes made since the snapshot was written
+    full.f32                 full-precision embeddings by id, if quantized
+
+The .npy files are memory-mapped copy-on-write when loading, so opening a
+store only reads the small metadata, and in-memory edits never touch the
+snapshot. Every add, delete and update is appended to append.log as a
+length-prefixed record before the store acknowledges it; on load, records are
+replayed and a torn record at the end (from a crash mid-write) is dropped.
+add() returns before the value is embedded, so it logs a PENDING record with
+just the value; an ADD record with the embedding follows once it's inserted
+(or a DELETE if it was merged into a duplicate or deleted before insertion).
+An UPDATE of a pending item is applied when it is inserted. Pending records
+left without an ADD or DELETE are embedded again on load.
+Snapshots only contain live items, so deleted items are dropped on save.
+Access counts change on every query, so they aren't logged; they're only as
+fresh as the latest snapshot.
+Writing a snapshot creates the next generation and only then points CURRENT
+at it, so a crash at any point leaves the previous generation intact.
+"""
+
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+
+CURRENT_FILE = "CURRENT"
+META_FILE = "meta.json"
+LOG_FILE = "append.log"
+FULL_FILE = "full.f32"
+ARRAY_FILES = ("ids", "embeddings", "scales", "timestamps", "importances", "counts", "accesses",
+               "values", "offsets")
+# Arrays missing from snapshots written before they were added.
+OPTIONAL_ARRAY_FILES = ("counts", "accesses")
+
+# Kinds of log records.
+ADD = 0
+DELETE = 1
+UPDATE = 2
+# A duplicate was added and merged into the item; the record's timestamp is
+# the duplicate's.
+MERGE = 3
+# An added value that hasn't been embedded and inserted yet.
+PENDING = 4
+
+# kind, item id, timestamp, importance, embedding dim, value length in bytes.
+RECORD_HEADER = struct.Struct("<BqdfII")
+# Value length of a record without a value, e.g. an importance-only update.
+NO_VALUE = 0xFFFFFFFF
+
+
+class StringArray:
+    """A sequence of strings backed by one UTF-8 buffer and an offsets array.
+
+    Strings appended after loading are kept in a plain list until the next
+    snapshot, so a memory-mapped buffer is never copied just to grow it."""
+
+    def __init__(self, data: np.ndarray = None, offsets: np.ndarray = None):
+        self._data = data if data is not None else np.empty(0, dtype=np.uint8)
+        self._offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self._tail: list[str] = []
+        # Replaced values of strings in the buffer, by index.
+        self._overrides: dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1 + len(self._tail)
+
+    def __getitem__(self, index: int) -> str:
+        base = len(self._offsets) - 1
+        if index < 0:
+            index += len(self)
+        if index >= base:
+            return self._tail[index - base]
+        if index in self._overrides:
+            return self._overrides[index]
+        return self._data[self._offsets[index]:self._offsets[index + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __setitem__(self, index: int, value: str) -> None:
+        base = len(self._offsets) - 1
+        if index < 0:
+            index += len(self)
+        if index >= base:
+            self._tail[index - base] = value
+        else:
+            self._overrides[index] = value
+
+    def append(self, value: str) -> None:
+        self._tail.append(value)
+
+    def buffers(self) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the (data, offsets) arrays of all strings, including the tail."""
+        if self._overrides:
+            # Rare: values were edited in place, so re-encode everything.
+            strings, base = list(self), StringArray()
+            base._tail = strings
+            return base.buffers()
+        if not self._tail:
+            return self._data, self._offsets
+        encoded = [value.encode("utf-8") for value in self._tail]
+        lengths = np.fromiter((len(value) for value in encoded), dtype=np.int64, count=len(encoded))
+        data = np.concatenate([self._data, np.frombuffer(b"".join(encoded), dtype=np.uint8)])
+        offsets = np.concatenate([self._offsets, self._offsets[-1] + np.cumsum(lengths)])
+        return data, offsets
+
+    def take(self, indices: np.ndarray) -> "StringArray":
+        """Returns a new StringArray of the strings at indices, in that order."""
+        data, offsets = self.buffers()
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        # Source position of every byte of the new buffer.
+        positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+        return StringArray(data[positions], new_offsets)
+
+
+class AppendLog:
+    def __init__(self, path: str, sync: bool = False):
+        self.path = path
+        # fsync after every record; without it a record survives a process
+        # crash but not necessarily a power loss.
+        self.sync = sync
+        self._file = open(path, "ab")
+
+    def append(self, kind: int, item_id: int, embedding: np.ndarray = None, value: str = None,
+               timestamp: float = 0.0, importance: float = float("nan")) -> None:
+        """Writes one record. A NaN importance and a None value or embedding
+        mean "unchanged" in an UPDATE record."""
+        encoded = value.encode("utf-8") if value is not None else b""
+        embedding = np.ascontiguousarray(embedding if embedding is not None else [], dtype=np.float32)
+        self._file.write(RECORD_HEADER.pack(kind, item_id, timestamp, importance, len(embedding),
+                                            len(encoded) if value is not None else NO_VALUE)
+                         + embedding.tobytes() + encoded)
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+    @staticmethod
+    def replay(path: str):
+        """Yields (kind, item_id, embedding, value, timestamp, importance) for
+        every complete record, then truncates any torn record off the end of
+        the file."""
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            kind, item_id, timestamp, importance, dim, length = RECORD_HEADER.unpack_from(data, position)
+            value_length = 0 if length == NO_VALUE else length
+            end = position + RECORD_HEADER.size + 4 * dim + value_length
+            if end > len(data):
+                break
+            embedding = np.frombuffer(data, dtype=np.float32, count=dim, offset=position + RECORD_HEADER.size) if dim else None
+            value = data[end - value_length:end].decode("utf-8") if length != NO_VALUE else None
+            yield kind, item_id, embedding, value, timestamp, importance
+            position = end
+        if position < len(data):
+            os.truncate(path, position)
+
+
+def current_generation(directory: str):
+    path = os.path.join(directory, CURRENT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["generation"]
+
+
+def generation_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, str(generation))
+
+
+def write_snapshot(directory: str, arrays: dict, meta: dict) -> int:
+    """Writes a new generation containing arrays and meta, makes it current,
+    and removes the previous one. Returns the new generation number."""
+    os.makedirs(directory, exist_ok=True)
+    previous = current_generation(directory)
+    generation = 0 if previous is None else previous + 1
+    path = generation_path(directory, generation)
+    # Leftovers of a snapshot that crashed before it became current.
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    for name in ARRAY_FILES:
+        np.save(os.path.join(path, name + ".npy"), arrays[name])
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+    tmp_current = os.path.join(directory, CURRENT_FILE + ".tmp")
+    with open(tmp_current, "w") as f:
+        json.dump({"generation": generation}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_current, os.path.join(directory, CURRENT_FILE))
+    if previous is not None:
+        shutil.rmtree(generation_path(directory, previous), ignore_errors=True)
+    return generation
+
+
+def read_snapshot(directory: str, generation: int) -> tuple[dict, dict]:
+    """Returns the copy-on-write memory-mapped arrays and the meta of a
+    generation. Optional arrays the generation doesn't have are left out."""
+    path = generation_path(directory, generation)
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in ARRAY_FILES:
+        file = os.path.join(path, name + ".npy")
+        if name in OPTIONAL_ARRAY_FILES and not os.path.exists(file):
+            continue
+        arrays[name] = np.load(file, mmap_mode="c")
+    return arrays, meta
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    from models.local_embedding import LocalEmbeddingModel
+    from modules.memory_stores.vector_store import VectorStore
+
+    num_items, dim = 1_000_000, 128
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((num_items, dim), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    values = [f"memory {i}: the agent did step {i} of the plan" for i in range(num_items)]
+    data = StringArray()
+    for value in values:
+        data.append(value)
+    buffer, offsets = data.buffers()
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        write_snapshot(directory, {
+            "ids": np.arange(num_items, dtype=np.int64),
+            "embeddings": embeddings,
+            "scales": np.ones(num_items, dtype=np.float32),
+            "timestamps": np.arange(num_items, dtype=np.float64),
+            "importances": rng.integers(1, 10, num_items).astype(np.float32),
+            "counts": np.ones(num_items, dtype=np.int32),
+            "accesses": np.zeros(num_items, dtype=np.int32),
+            "values": buffer,
+            "offsets": offsets,
+        }, {"size": num_items, "dim": dim, "next_id": num_items, "time_counter": num_items})
+        print(f"Wrote {num_items} items in {time.perf_counter() - start:.2f}s")
+
+        embedding_model = LocalEmbeddingModel(dim=dim)
+        for attempt in range(3):
+            start = time.perf_counter()
+            store = VectorStore.load(directory, "{} {}", "", embedding_model=embedding_model)
+            print(f"Loaded {store.size} items in {(time.perf_counter() - start) * 1000:.1f} ms")
+            store.close()
+
+        start = time.perf_counter()
+        with open(os.path.join(directory, "values.json"), "w") as f:
+            json.dump(values, f)
+        with open(os.path.join(directory, "values.json")) as f:
+            json.load(f)
+        print(f"(For comparison, a JSON round trip of just the values takes {time.perf_counter() - start:.2f}s)")
+
+        start = time.perf_counter()
+        result = store.query_relevance("the agent did step 12 of the plan", 3)
+        print(f"First query in {(time.perf_counter() - start) * 1000:.1f} ms: {result}")
+        store.close()
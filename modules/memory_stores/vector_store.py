@@ -5,10 +5,19 @@ Stores items within a vector store.
 """
 
 import datetime
+import os
+import queue
+import threading
+import time
 import numpy as np
-import math
-from models.embedding import EmbeddingModel
+from models.embedding import BaseEmbeddingModel, EmbeddingModel
+from modules.memory_stores import storage
+from modules.memory_stores.ann_index import IVFIndex
+from modules.memory_stores.bm25_index import BM25Index, reciprocal_rank_fusion
+from modules.memory_stores.importance import PROVISIONAL_IMPORTANCE, rate
+from modules.memory_stores.quantization import DTYPES, QuantizedMatrix, VectorFile, quantize
 from models.llm import LLM
+from models.scheduler import BACKGROUND
 from numpy.linalg import norm
 from textwrap import dedent
 from functools import partial
@@ -16,10 +25,32 @@ from functools import partial
 from typing import List
 
 
+# Capacity of the embedding matrix when the first item is added.
+INITIAL_CAPACITY = 64
+# Deleted rows are only compacted away once there are at least this many.
+MIN_COMPACTION_ROWS = 1024
+# Candidates taken from each of the vector and lexical rankings in a hybrid
+# query before they are fused.
+HYBRID_CANDIDATES = 50
+# Column stride of the sample that top_k_rows takes its cut-off score from.
+SAMPLE_STRIDE = 16
+# Most pending memories embedded in one request by the background writer.
+EMBEDDING_BATCH_SIZE = 64
+# Tries at embedding a batch, waiting EMBEDDING_RETRY_DELAY seconds after the
+# first failure and twice as long after each next one.
+EMBEDDING_ATTEMPTS = 4
+EMBEDDING_RETRY_DELAY = 1.0
+# Queued by close() to stop a worker thread.
+STOP = None
+
+
 class VectorStoreItem:
+    __slots__ = ("id", "embedding", "value", "timestamp", "importance")
+
     def __init__(
-        self, embedding: np.array, value: str, timestamp: float, importance: int
+        self, embedding: np.array, value: str, timestamp: float, importance: int, id: int = None
     ):
+        self.id: int = id
         self.embedding: np.array = embedding
         self.value: str = value
         self.timestamp: float = timestamp
@@ -29,129 +60,953 @@ class VectorStoreItem:
 class VectorStore:
     """An in-memory vector store.
 
-    TODO: support removal and use an ordered dict
+    Items are kept in parallel arrays: the embeddings, normalized to unit
+    length, are rows of one contiguous float32 matrix that doubles in capacity
+    as it fills up, so a query is scored with a single matrix-vector product.
+
+    Every item has a stable id, returned by add(). Ids only grow, so the ids
+    array stays sorted and an id is found by binary search. Deleting an item
+    only marks its row dead; once dead rows pass compaction_threshold of the
+    matrix, a background thread rewrites the arrays without them.
+
+    Given a directory, the store is durable: it is loaded from the directory's
+    latest snapshot (memory-mapped, see storage.py), every change is appended
+    to a log before it returns, and save() writes a new snapshot. Values added
+    but not embedded yet are logged as pending and embedded again on load.
+
+    With quantization="int8" or "float16", the matrix is stored at that
+    precision (int8 with a scale per row) and scanned a chunk at a time, and
+    the best rerank_factor * top_k matches are re-ranked against full-precision
+    copies kept in a memory-mapped side file (see quantization.py).
+
+    Values are also indexed for BM25 (see bm25_index.py), so query_relevance
+    can match exact identifiers lexically and fuse both rankings.
+
+    add() doesn't wait on the network: it reserves an id and queues the value.
+    A background thread embeds queued values in batches (retrying failed
+    requests; flush() raises if a batch still fails) and inserts them, and
+    rating workers then score their importance with the LLM, up to
+    rating_batch_size memories per prompt (see importance.py).
+
+    So that memory stays bounded over long runs, a new item at least
+    dedup_threshold similar to an existing one is merged into it instead,
+    bumping its count and recency, and beyond max_items the items with the
+    lowest recency * importance * (count + accesses) are evicted. The id add()
+    returned for a merged item never becomes live.
     """
 
-    def __init__(self, importance_prompt: str, objective: str, use_real_time=False):
+    def __init__(self, importance_prompt: str, objective: str, use_real_time=False,
+                 embedding_model: BaseEmbeddingModel = None,
+                 weights=(1.0, 1.0, 1.0), decay_rate=0.99, ann_index: IVFIndex = None,
+                 directory: str = None, compaction_threshold=0.25,
+                 quantization: str = None, rerank_factor=4,
+                 rating_batch_size=8, rating_workers=2,
+                 dedup_threshold: float = None, max_items: int = None):
         SYSTEM_PROMPT = dedent(
                 """
                 You rate the importance of various things using the format: FORMAT: <rating>
                 """)
-        self.items: list[VectorStoreItem] = []
-        self.model = EmbeddingModel()
+        self.size = 0  # Rows in use, including deleted ones.
+        self.num_deleted = 0
+        self.next_id = 0
+        if quantization not in DTYPES:
+            raise ValueError(f"Unknown quantization {quantization!r}")
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self._embeddings = None  # (capacity, dim), rows past size unused.
+        self._scales = np.empty(0, dtype=np.float32)  # Per-row int8 scales, else 1.
+        self._ids = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._timestamps = np.empty(0, dtype=np.float64)
+        self._importances = np.empty(0, dtype=np.float32)
+        self._counts = np.empty(0, dtype=np.int32)  # Times added, counting merged duplicates.
+        self._accesses = np.empty(0, dtype=np.int32)  # Times returned by a query.
+        self.values = storage.StringArray()
+        # Defaults to OpenAI; pass a LocalEmbeddingModel to embed in-process.
+        self.model = embedding_model if embedding_model is not None else EmbeddingModel()
+        # Embedding added values is background work, like rating them; only
+        # queries embed at the default priority.
+        self._background_model = EmbeddingModel(priority=BACKGROUND) if embedding_model is None else None
         # Real time is useful for things like simulations, but isn't as useful for
         # things like agents, where time doesn't have as much meaning.
         # Instead of real time, we can just use a counter.
         self.use_real_time = use_real_time
+        # Weights of relevance, recency and importance in query().
+        self.weights = weights
+        self.decay_rate = decay_rate
+        # Optional approximate index used by query_relevance on large stores.
+        self.ann_index = ann_index
+        # Built lazily on the first lexical or hybrid query.
+        self.lexical_index = BM25Index()
+        # Fraction of dead rows that triggers a background compaction.
+        self.compaction_threshold = compaction_threshold
+        self.dedup_threshold = dedup_threshold
+        self.max_items = max_items
         self.time_counter = 0  # Only used when not using real time.
-        self.llm = LLM(system_prompt=SYSTEM_PROMPT.strip())
+        # Importance scoring shouldn't hold up the agent's own requests.
+        self.llm = LLM(system_prompt=SYSTEM_PROMPT.strip(), priority=BACKGROUND)
         def format_importance_prompt(objective: str, memory_str: str) -> str:
             return importance_prompt.format(objective, memory_str)
         self.importance_prompt = partial(format_importance_prompt, objective)
+        # _lock guards the arrays; held while reading them too, since
+        # compaction swaps them. Queries take _read_lock instead.
+        self._lock, self._read_lock = self._make_locks()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+        # Rows whose embedding changed while a compaction was copying the matrix.
+        self._dirty_rows = None
+        self.rating_batch_size = rating_batch_size
+        self.rating_workers = rating_workers
+        # (id, value, timestamp, embedding or None) waiting to be embedded
+        # and inserted, then (id, value)
+        # waiting for an importance rating.
+        self._to_embed = queue.Queue()
+        self._to_rate = queue.Queue()
+        self._workers = []
+        # Values added but not inserted yet, by id: (value, timestamp).
+        self._pending = {}
+        # Updates of pending values, applied when they're inserted:
+        # (embedding, importance), None if unchanged.
+        self._pending_updates = {}
+        # The last error that made the embedding thread give up on a batch.
+        self._embedding_error = None
+        self.directory = directory
+        self._log = None
+        # Full-precision embeddings by id, for re-ranking quantized matches.
+        self._full = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        if quantization is not None:
+            self._full = VectorFile(os.path.join(directory, storage.FULL_FILE) if directory is not None else None)
+        if directory is not None:
+            self._open()
+
+    def _make_locks(self):
+        """Returns (lock, read lock). Here they're the same lock;
+        ConcurrentVectorStore makes them the sides of a reader-writer lock."""
+        lock = threading.RLock()
+        return lock, lock
+
+    @classmethod
+    def load(cls, directory: str, importance_prompt: str, objective: str, **kwargs) -> "VectorStore":
+        return cls(importance_prompt, objective, directory=directory, **kwargs)
+
+    def _open(self) -> None:
+        generation = storage.current_generation(self.directory)
+        if generation is None:
+            generation = self.save()
+        else:
+            arrays, meta = storage.read_snapshot(self.directory, generation)
+            if meta.get("quantization") != self.quantization:
+                raise ValueError(f"{self.directory} was saved with quantization={meta.get('quantization')!r}")
+            if meta["size"]:
+                # Copy-on-write maps; the first insert copies them into memory.
+                self._embeddings = arrays["embeddings"]
+                self._scales = arrays["scales"]
+                self._ids = arrays["ids"]
+                self._timestamps = arrays["timestamps"]
+                self._importances = arrays["importances"]
+                self._counts = arrays.get("counts", np.ones(meta["size"], dtype=np.int32))
+                self._accesses = arrays.get("accesses", np.zeros(meta["size"], dtype=np.int32))
+                self._alive = np.ones(meta["size"], dtype=bool)
+            self.values = storage.StringArray(arrays["values"], arrays["offsets"])
+            self.size = meta["size"]
+            self.next_id = meta["next_id"]
+            self.time_counter = meta["time_counter"]
+        log_path = os.path.join(storage.generation_path(self.directory, generation), storage.LOG_FILE)
+        pending = {}
+        for kind, item_id, embedding, value, timestamp, importance in storage.AppendLog.replay(log_path):
+            if kind == storage.PENDING:
+                pending[item_id] = (value, timestamp)
+                self.next_id = max(self.next_id, item_id + 1)
+                if not self.use_real_time:
+                    self.time_counter = max(self.time_counter, int(timestamp) + 1)
+                continue
+            if kind in (storage.ADD, storage.DELETE):
+                pending.pop(item_id, None)
+                self._pending_updates.pop(item_id, None)
+            if kind == storage.UPDATE and item_id in pending:
+                self._update_pending(pending, item_id, embedding, value,
+                                     None if np.isnan(importance) else importance)
+                continue
+            if kind == storage.ADD:
+                self._insert(embedding, value, timestamp, importance, item_id)
+                if not self.use_real_time:
+                    self.time_counter = max(self.time_counter, int(timestamp) + 1)
+            else:
+                row = self._row(item_id)
+                if row is None:
+                    continue
+                if kind == storage.DELETE:
+                    self._delete_row(row)
+                elif kind == storage.MERGE:
+                    self._merge_row(row, timestamp)
+                    if not self.use_real_time:
+                        self.time_counter = max(self.time_counter, int(timestamp) + 1)
+                else:
+                    self._update_row(row, embedding, value, None if np.isnan(importance) else importance)
+        self._log = storage.AppendLog(log_path)
+        self._requeue(pending)
+
+    def _requeue(self, pending: dict) -> None:
+        """Queues values that were added but never inserted, e.g. because the
+        process crashed first. Ids must be inserted in ascending order, so a
+        value whose id is now behind an inserted item's gets a new id."""
+        if not pending:
+            return
+        last_id = int(self._ids[self.size - 1]) if self.size else -1
+        with self._lock:
+            queued = [(item_id, value, timestamp)
+                      for item_id, (value, timestamp) in sorted(pending.items()) if item_id > last_id]
+            for old_id, (value, timestamp) in sorted(pending.items()):
+                if old_id > last_id:
+                    continue
+                item_id = self.next_id
+                self.next_id += 1
+                self._log.append(storage.PENDING, item_id, value=value, timestamp=timestamp)
+                if old_id in self._pending_updates:
+                    embedding, importance = self._pending_updates.pop(old_id)
+                    self._pending_updates[item_id] = (embedding, importance)
+                    self._log_pending_update(item_id, value)
+                self._log.append(storage.DELETE, old_id)
+                queued.append((item_id, value, timestamp))
+            for item_id, value, timestamp in queued:
+                self._pending[item_id] = (value, timestamp)
+                self._to_embed.put((item_id, value, timestamp, None))
+        self._start_workers()
+
+    def save(self, directory: str = None) -> int:
+        """Writes a snapshot of the store's live items to directory, by default
+        the store's own, and returns its generation. Saving to the store's own
+        directory also starts a new, empty append log."""
+        directory = directory or self.directory
+        with self._lock:
+            rows = self._live_rows()
+            values = self.values.take(rows) if rows is not None else self.values
+            data, offsets = values.buffers()
+
+            def live(array):
+                return array[rows] if rows is not None else array
+
+            arrays = {
+                "ids": live(self._ids[:self.size]),
+                "embeddings": live(self._raw_embeddings()),
+                "scales": live(self._scales[:self.size]),
+                "timestamps": live(self._timestamps[:self.size]),
+                "importances": live(self._importances[:self.size]),
+                "counts": live(self._counts[:self.size]),
+                "accesses": live(self._accesses[:self.size]),
+                "values": data,
+                "offsets": offsets,
+            }
+            meta = {
+                "size": len(arrays["ids"]),
+                "dim": self.embeddings.shape[1],
+                "next_id": self.next_id,
+                "time_counter": self.time_counter,
+                "quantization": self.quantization,
+            }
+            generation = storage.write_snapshot(directory, arrays, meta)
+            if self._full is not None and directory != self.directory:
+                # Re-ranking a store loaded from there needs the full-precision vectors too.
+                self._full.copy_to(os.path.join(directory, storage.FULL_FILE))
+            if directory == self.directory and self._log is not None:
+                self._log.close()
+                self._log = storage.AppendLog(os.path.join(storage.generation_path(directory, generation), storage.LOG_FILE))
+                # The snapshot doesn't have the values still being embedded.
+                for item_id, (value, timestamp) in self._pending.items():
+                    self._log.append(storage.PENDING, item_id, value=value, timestamp=timestamp)
+                    if item_id in self._pending_updates:
+                        self._log_pending_update(item_id, value)
+        return generation
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        except RuntimeError as e:
+            # The values are still logged as pending, so loading the store
+            # again retries them.
+            print("Closing with memories that couldn't be embedded: ", e)
+        self._stop_workers()
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self._full is not None:
+            self._full.close()
+            self._full = None
+
+    def add(self, value: str, embedding=None) -> int:
+        """Adds a value to the vector store and returns its id right away.
+
+        Queries see the value once its embedding arrives; passing in an
+        embedding from the store's model skips the request for it. Until the
+        LLM has rated it, its importance is PROVISIONAL_IMPORTANCE. flush()
+        waits for both. Raises ValueError if the embedding doesn't have the
+        store's dimension."""
+        if not self._workers:
+            self._start_workers()
+        with self._lock:
+            if embedding is not None:
+                embedding = self._check_embedding(embedding)
+            item_id = self.next_id
+            self.next_id += 1
+            timestamp = self._current_time()
+            if not self.use_real_time:
+                self.time_counter += 1
+            if self._log is not None:
+                self._log.append(storage.PENDING, item_id, value=value, timestamp=timestamp)
+            self._pending[item_id] = (value, timestamp)
+            # Queued under the lock so that ids are inserted in order.
+            self._to_embed.put((item_id, value, timestamp, embedding))
+        return item_id
+
+    def flush(self) -> None:
+        """Blocks until every added value is embedded, inserted and rated.
+        Raises RuntimeError if some values couldn't be embedded since the last
+        flush; those are dropped, unless the store is persistent, in which
+        case loading it again retries them."""
+        self._to_embed.join()
+        self._to_rate.join()
+        error, self._embedding_error = self._embedding_error, None
+        if error is not None:
+            raise RuntimeError(f"Failed to embed added memories: {error}") from error
+
+    def pending(self) -> int:
+        """How many added values are still waiting to be embedded or rated.
+        flush() returns without blocking once this is 0."""
+        return self._to_embed.unfinished_tasks + self._to_rate.unfinished_tasks
+
+    def _start_workers(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            # A single embedding thread, so items are inserted in id order.
+            self._workers.append(threading.Thread(
+                target=self._work, args=(self._to_embed, EMBEDDING_BATCH_SIZE, self._embed_batch), daemon=True))
+            for _ in range(self.rating_workers):
+                self._workers.append(threading.Thread(
+                    target=self._work, args=(self._to_rate, self.rating_batch_size, self._rate_batch), daemon=True))
+            for worker in self._workers:
+                worker.start()
+
+    def _stop_workers(self) -> None:
+        """Stops the worker threads once they've finished what is queued."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        if not workers:
+            return
+        # The embedding thread first, since it queues items for rating.
+        self._to_embed.put(STOP)
+        workers[0].join()
+        for _ in workers[1:]:
+            self._to_rate.put(STOP)
+        for worker in workers[1:]:
+            worker.join()
+
+    @staticmethod
+    def _work(pending: queue.Queue, batch_size: int, process) -> None:
+        """Runs process on batches from pending until it takes STOP."""
+        while True:
+            batch = drain(pending, batch_size)
+            stop = batch[-1] is STOP
+            if stop:
+                batch.pop()
+            try:
+                if batch:
+                    process(batch)
+            finally:
+                for _ in range(len(batch) + stop):
+                    pending.task_done()
+            if stop:
+                return
+
+    def _embed_batch(self, batch) -> None:
+        try:
+            embeddings = [embedding for _, _, _, embedding in batch]
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            if missing:
+                computed = self._embed_with_retries([batch[i][1] for i in missing])
+                for i, embedding in zip(missing, computed):
+                    embeddings[i] = embedding
+            inserted = []
+            with self._lock:
+                for (item_id, value, timestamp, _), embedding in zip(batch, embeddings):
+                    if item_id not in self._pending:
+                        # Deleted before it could be inserted.
+                        continue
+                    value, _ = self._pending.pop(item_id)
+                    updated_embedding, importance = self._pending_updates.pop(item_id, (None, None))
+                    if updated_embedding is not None:
+                        embedding = updated_embedding
+                    try:
+                        embedding = self._check_embedding(embedding)
+                    except ValueError as e:
+                        # Only this item is dropped, not the rest of the batch.
+                        print("Failed to embed memory: ", e)
+                        self._embedding_error = e
+                        if self._log is not None:
+                            self._log.append(storage.DELETE, item_id)
+                        continue
+                    if self._merge_duplicate(embedding, timestamp, item_id):
+                        continue
+                    if importance is not None:
+                        # Set explicitly, so it isn't rated.
+                        self._append(embedding, value, timestamp, importance, item_id)
+                        continue
+                    self._append(embedding, value, timestamp, PROVISIONAL_IMPORTANCE, item_id)
+                    inserted.append((item_id, value))
+                self._evict()
+            self._maybe_compact()
+            for item in inserted:
+                self._to_rate.put(item)
+        except Exception as e:
+            print("Failed to embed memories: ", e)
+            self._embedding_error = e
+
+    def _check_embedding(self, embedding) -> np.ndarray:
+        """Returns embedding as a float32 vector. Raises ValueError if it
+        doesn't have the store's dimension (or the model's, while empty)."""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        dim = self._embeddings.shape[1] if self._embeddings is not None else getattr(self.model, "dim", None)
+        if embedding.ndim != 1 or (dim is not None and embedding.shape[0] != dim):
+            raise ValueError(f"Expected an embedding of shape ({dim},), got one of shape {embedding.shape}")
+        return embedding
+
+    def _embed_with_retries(self, values: list[str]):
+        for attempt in range(EMBEDDING_ATTEMPTS):
+            try:
+                return (self._background_model or self.model).get_embeddings(values)
+            except Exception as e:
+                if attempt == EMBEDDING_ATTEMPTS - 1:
+                    raise
+                delay = EMBEDDING_RETRY_DELAY * 2 ** attempt
+                print(f"Failed to embed memories ({e}), retrying in {delay:.0f}s")
+                time.sleep(delay)
+
+    def _rate_batch(self, batch) -> None:
+        try:
+            ratings = rate(self.llm, self.importance_prompt, [value for _, value in batch])
+            for (item_id, _), rating in zip(batch, ratings):
+                if rating is not None:
+                    self.update(item_id, importance=rating)
+        except Exception as e:
+            print("Failed to rate memories: ", e)
+
+    def delete(self, item_id: int) -> bool:
+        """Removes an item. Returns False if there is no such item."""
+        with self._lock:
+            if item_id in self._pending:
+                # Not inserted yet; the embedding thread skips it.
+                if self._log is not None:
+                    self._log.append(storage.DELETE, item_id)
+                del self._pending[item_id]
+                self._pending_updates.pop(item_id, None)
+                return True
+            row = self._row(item_id)
+            if row is None:
+                return False
+            if self._log is not None:
+                self._log.append(storage.DELETE, item_id)
+            self._delete_row(row)
+        self._maybe_compact()
+        return True
+
+    def update(self, item_id: int, value: str = None, importance: float = None) -> bool:
+        """Replaces an item's value (re-embedding it) and/or its importance,
+        keeping its id and timestamp. Returns False if there is no such item."""
+        embedding = None
+        if value is not None:
+            embedding = normalize(np.asarray(self.model.get_embedding(value), dtype=np.float32))
+        with self._lock:
+            row = self._row(item_id)
+            if row is None and item_id not in self._pending:
+                return False
+            if self._log is not None:
+                self._log.append(storage.UPDATE, item_id, embedding, value,
+                                 importance=importance if importance is not None else float("nan"))
+            if row is None:
+                # Not inserted yet; applied when it is.
+                self._update_pending(self._pending, item_id, embedding, value, importance)
+            else:
+                self._update_row(row, embedding, value, importance)
+        return True
+
+    def _update_pending(self, pending: dict, item_id: int, embedding, value, importance) -> None:
+        old_embedding, old_importance = self._pending_updates.get(item_id, (None, None))
+        if value is not None:
+            pending[item_id] = (value, pending[item_id][1])
+        self._pending_updates[item_id] = (embedding if value is not None else old_embedding,
+                                          importance if importance is not None else old_importance)
+
+    def _log_pending_update(self, item_id: int, value: str) -> None:
+        embedding, importance = self._pending_updates[item_id]
+        self._log.append(storage.UPDATE, item_id, embedding, value if embedding is not None else None,
+                         importance=importance if importance is not None else float("nan"))
+
+    def get(self, item_id: int):
+        """Returns the value of an item, or None if there is no such item."""
+        with self._read_lock:
+            row = self._row(item_id)
+            return self.values[row] if row is not None else None
+
+    def _row(self, item_id: int):
+        """Row of a live item, or None."""
+        row = int(np.searchsorted(self._ids[:self.size], item_id))
+        if row < self.size and self._ids[row] == item_id and self._alive[row]:
+            return row
+        return None
+
+    def _append(self, embedding, value: str, timestamp: float, importance: float, item_id: int = None) -> int:
+        embedding = normalize(np.asarray(embedding, dtype=np.float32))
+        if item_id is None:
+            item_id = self.next_id
+        if self._log is not None:
+            self._log.append(storage.ADD, item_id, embedding, value, timestamp, importance)
+        self._insert(embedding, value, timestamp, importance, item_id)
+        return item_id
+
+    def _merge_duplicate(self, embedding, timestamp: float, item_id: int = None) -> bool:
+        """Merges a new item into the most similar live item if that one is at
+        least dedup_threshold similar. Returns whether it did."""
+        if self.dedup_threshold is None or self.empty():
+            return False
+        embedding = normalize(np.asarray(embedding, dtype=np.float32))
+        rows = self._search(embedding, 1)
+        if not len(rows) or float(self.embeddings[rows[0]] @ embedding) < self.dedup_threshold:
+            return False
+        if self._log is not None:
+            self._log.append(storage.MERGE, int(self._ids[rows[0]]), timestamp=timestamp)
+            if item_id is not None:
+                # The new item's pending record is settled.
+                self._log.append(storage.DELETE, item_id)
+        self._merge_row(rows[0], timestamp)
+        return True
+
+    def _merge_row(self, row: int, timestamp: float) -> None:
+        self._counts[row] += 1
+        # The memory was just observed again.
+        self._timestamps[row] = max(self._timestamps[row], timestamp)
+
+    def _evict(self) -> None:
+        """Deletes the live items least worth keeping until at most max_items
+        are left."""
+        if self.max_items is None or len(self) <= self.max_items:
+            return
+        rows = self._live_rows()
+        if rows is None:
+            rows = np.arange(self.size)
+        recency = np.exp(-(self._current_time() - self._timestamps[rows]) * (1 - self.decay_rate))
+        retention = recency * self._importances[rows] * (self._counts[rows] + self._accesses[rows])
+        for row in rows[top_k_indices(-retention, len(self) - self.max_items)]:
+            if self._log is not None:
+                self._log.append(storage.DELETE, int(self._ids[row]))
+            self._delete_row(row)
+
+    def _insert(self, embedding: np.ndarray, value: str, timestamp: float, importance: float, item_id: int) -> None:
+        if self._embeddings is None:
+            self._resize(INITIAL_CAPACITY, len(embedding))
+        elif self.size == len(self._embeddings):
+            self._resize(2 * self.size, self._embeddings.shape[1])
+        self._store_embedding(self.size, embedding, item_id)
+        self._ids[self.size] = item_id
+        self._alive[self.size] = True
+        self._timestamps[self.size] = timestamp
+        self._importances[self.size] = importance
+        self._counts[self.size] = 1
+        self._accesses[self.size] = 0
+        self.values.append(value)
+        self.size += 1
+        self.next_id = max(self.next_id, item_id + 1)
+
+    def _store_embedding(self, row: int, embedding: np.ndarray, item_id: int) -> None:
+        if self.quantization is None:
+            self._embeddings[row] = embedding
+            return
+        self._embeddings[row], self._scales[row] = quantize(embedding, self.quantization)
+        self._full.write(item_id, embedding)
+
+    def _delete_row(self, row: int) -> None:
+        self._alive[row] = False
+        self.num_deleted += 1
 
-    def add(self, value: str) -> None:
-        """Adds a value to the vector store."""
-        # Create embedding of the value using OpenAI
-        embedding = self.model.get_embedding(value)
-        generated_importance_str = self.llm.generate_chat_completion(self.importance_prompt(value))
-        print("Generated importance str: ", generated_importance_str)
-        importance_str = generated_importance_str.split("FORMAT:")[1].strip()
-        importance = int(importance_str)
-        item = VectorStoreItem(
-            np.array(embedding),
-            value,
-            datetime.datetime.now().timestamp()
-            if self.use_real_time
-            else self.time_counter,
-            importance,
-        )
-        self.items.append(item)
-        if not self.use_real_time:
-            self.time_counter += 1
+    def _update_row(self, row: int, embedding, value, importance) -> None:
+        if value is not None:
+            self.lexical_index.replace(row, self.values[row], value)
+            self.values[row] = value
+            self._store_embedding(row, embedding, int(self._ids[row]))
+            if self._dirty_rows is not None:
+                self._dirty_rows.append(row)
+        if importance is not None:
+            self._importances[row] = importance
+
+    def _resize(self, capacity: int, dim: int) -> None:
+        embeddings = np.empty((capacity, dim), dtype=DTYPES[self.quantization])
+        scales = np.ones(capacity, dtype=np.float32)
+        ids = np.empty(capacity, dtype=np.int64)
+        alive = np.zeros(capacity, dtype=bool)
+        timestamps = np.empty(capacity, dtype=np.float64)
+        importances = np.empty(capacity, dtype=np.float32)
+        counts = np.empty(capacity, dtype=np.int32)
+        accesses = np.empty(capacity, dtype=np.int32)
+        if self._embeddings is not None:
+            embeddings[:self.size] = self._embeddings[:self.size]
+            scales[:self.size] = self._scales[:self.size]
+            ids[:self.size] = self._ids[:self.size]
+            alive[:self.size] = self._alive[:self.size]
+            timestamps[:self.size] = self._timestamps[:self.size]
+            importances[:self.size] = self._importances[:self.size]
+            counts[:self.size] = self._counts[:self.size]
+            accesses[:self.size] = self._accesses[:self.size]
+        self._embeddings, self._scales, self._ids, self._alive = embeddings, scales, ids, alive
+        self._timestamps, self._importances = timestamps, importances
+        self._counts, self._accesses = counts, accesses
+
+    def _maybe_compact(self) -> None:
+        if (self.num_deleted >= MIN_COMPACTION_ROWS
+                and self.num_deleted > self.compaction_threshold * self.size
+                and self._compaction_thread is None):
+            self._compaction_thread = threading.Thread(target=self._compact_in_background, daemon=True)
+            self._compaction_thread.start()
+
+    def _compact_in_background(self) -> None:
+        try:
+            self.compact()
+        finally:
+            self._compaction_thread = None
+
+    def compact(self) -> None:
+        """Rewrites the arrays without the deleted rows and renumbers the rest.
+
+        The embedding matrix, the bulk of the work, is copied without holding
+        the store's lock, so queries, adds and deletes carry on meanwhile."""
+        with self._compaction_lock:
+            with self._lock:
+                if self.num_deleted == 0:
+                    return
+                num_rows = self.size
+                embeddings = self._raw_embeddings()
+                keep = np.flatnonzero(self._alive[:num_rows])
+                self._dirty_rows = []
+            # Rows below num_rows are never overwritten except by updates,
+            # which are recorded in _dirty_rows.
+            kept_embeddings = embeddings[keep]
+
+            with self._lock:
+                rows = np.concatenate([keep, np.arange(num_rows, self.size)])
+                capacity = max(INITIAL_CAPACITY, len(rows))
+                new_embeddings = np.empty((capacity, embeddings.shape[1]), dtype=embeddings.dtype)
+                new_embeddings[:len(keep)] = kept_embeddings
+                new_embeddings[len(keep):len(rows)] = self._embeddings[num_rows:self.size]
+                for row in self._dirty_rows:
+                    if row < num_rows and self._alive[row]:
+                        new_embeddings[np.searchsorted(keep, row)] = self._embeddings[row]
+                self._dirty_rows = None
+
+                def take(array, dtype):
+                    taken = np.zeros(capacity, dtype=dtype)
+                    taken[:len(rows)] = array[rows]
+                    return taken
+
+                self._scales = take(self._scales, np.float32)
+                self._ids = take(self._ids, np.int64)
+                self._alive = take(self._alive, bool)
+                self._timestamps = take(self._timestamps, np.float64)
+                self._importances = take(self._importances, np.float32)
+                self._counts = take(self._counts, np.int32)
+                self._accesses = take(self._accesses, np.int32)
+                self._embeddings = new_embeddings
+                self.values = self.values.take(rows)
+                self.size = len(rows)
+                # Items deleted while the matrix was being copied stay as tombstones.
+                self.num_deleted = int(self.size - np.count_nonzero(self._alive[:self.size]))
+                if self.ann_index is not None:
+                    self.ann_index.reset()
+                self.lexical_index.reset()
+
+    def _live_rows(self):
+        """Rows of the live items, or None if no item is deleted."""
+        if self.num_deleted == 0:
+            return None
+        return np.flatnonzero(self._alive[:self.size])
+
+    def __len__(self) -> int:
+        return self.size - self.num_deleted
+
+    def _current_time(self) -> float:
+        return datetime.datetime.now().timestamp() if self.use_real_time else self.time_counter
+
+    def _raw_embeddings(self) -> np.ndarray:
+        """The stored (size, dim) matrix, quantized if the store is."""
+        if self._embeddings is None:
+            return np.empty((0, 0), dtype=DTYPES[self.quantization])
+        return self._embeddings[:self.size]
+
+    @property
+    def embeddings(self):
+        """The (size, dim) matrix of normalized embeddings, including deleted
+        rows. For a quantized store this is a QuantizedMatrix, which supports
+        indexing and @ like a float32 array."""
+        if self.quantization is None or self._embeddings is None:
+            return self._raw_embeddings()
+        return QuantizedMatrix(self._embeddings[:self.size], self._scales[:self.size])
+
+    @property
+    def items(self) -> list[VectorStoreItem]:
+        with self._read_lock:
+            embeddings = self.embeddings
+            return [
+                VectorStoreItem(embeddings[i], self.values[i], self._timestamps[i], self._importances[i],
+                                int(self._ids[i]))
+                for i in range(self.size) if self._alive[i]
+            ]
 
     def cosine_similarity(self, a: np.array, b: np.array) -> float:
         return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
+    def similarities(self, query_embedding) -> np.ndarray:
+        """Cosine similarity of the query to every row, including deleted ones."""
+        return self.embeddings @ normalize(np.asarray(query_embedding, dtype=np.float32))
+
     def query_recent(self, top_k: int) -> List[str]:
         """Returns the top k most recent entries from the vector store."""
-        top_vector_items = sorted(
-            self.items, key=lambda item: item.timestamp, reverse=True
-        )[:top_k]
-        return [item.value for item in top_vector_items]
-
-    def query_relevance(self, query_string: str, top_k: int) -> List[str]:
-        """Returns the top k most relevant entries from the vector store."""
-        raw_embedding = self.model.get_embedding(query_string)
-        query_embedding = np.array(raw_embedding)
-
-        # Find the k items with highest cosine similarity to the query
-        similarities = []
-        for item in self.items:
-            similarity = self.cosine_similarity(query_embedding, item.embedding)
-            similarities.append(similarity)
-        similarities = np.array(similarities)
-
-        # Return the top k items. If there are less than k items, return all.
-        if len(self.items) < top_k:
-            top_k = len(self.items)
-        top_k_indices = reversed(similarities.argsort()[-top_k:])
-        top_k_items = [self.items[i].value for i in top_k_indices]
-        return top_k_items
+        with self._read_lock:
+            rows = self._live_rows()
+            timestamps = self._timestamps[:self.size]
+            if rows is None:
+                return [self.values[i] for i in top_k_indices(timestamps, top_k)]
+            return [self.values[rows[i]] for i in top_k_indices(timestamps[rows], top_k)]
+
+    def query_relevance(self, query_string: str, top_k: int, mode: str = "hybrid") -> List[str]:
+        """Returns the top k most relevant entries from the vector store.
+
+        mode is "vector" (embedding similarity), "lexical" (BM25, which needs
+        no embedding call) or "hybrid" (both, merged by reciprocal rank fusion).
+        """
+        if mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown mode {mode!r}")
+        if self.empty():
+            return []
+        if mode != "lexical":
+            query_embedding = normalize(np.asarray(self.model.get_embedding(query_string), dtype=np.float32))
+        with self._read_lock:
+            if mode == "vector":
+                rows = self._search(query_embedding, top_k)
+            elif mode == "lexical":
+                rows = self._search_lexical(query_string, top_k)
+            else:
+                candidates = max(top_k, HYBRID_CANDIDATES)
+                rows = reciprocal_rank_fusion([
+                    self._search(query_embedding, candidates),
+                    self._search_lexical(query_string, candidates),
+                ], top_k)
+            self._accesses[rows] += 1
+            return [self.values[i] for i in rows]
+
+    def _search_lexical(self, query_string: str, top_k: int) -> np.ndarray:
+        """Rows of the top_k live items by BM25 score, leaving out items that
+        share no term with the query."""
+        self.lexical_index.update(self.values, self.size)
+        scores = self.lexical_index.scores(query_string, self.size)
+        if self.num_deleted:
+            scores[~self._alive[:self.size]] = 0
+        return top_k_indices(scores, min(top_k, np.count_nonzero(scores)))
+
+    def _search(self, query_embedding: np.ndarray, top_k: int, rerank: bool = True) -> np.ndarray:
+        """Rows of the top_k live items most similar to the normalized query."""
+        rerank = rerank and self._full is not None
+        k = top_k * self.rerank_factor if rerank else top_k
+        if self.ann_index is not None:
+            rows = self._search_index(query_embedding, k)
+        else:
+            similarities = self.similarities(query_embedding)
+            if self.num_deleted:
+                similarities[~self._alive[:self.size]] = -np.inf
+            rows = top_k_indices(similarities, min(k, len(self)))
+        if rerank and len(rows):
+            exact = self._full.read(self._ids[rows], self._embeddings.shape[1]) @ query_embedding
+            rows = rows[top_k_indices(exact, top_k)]
+        return rows[:top_k]
+
+    def _search_index(self, query_embedding: np.ndarray, top_k: int) -> np.ndarray:
+        # Deleted rows are still in the index, so ask for more until enough
+        # live ones come back or the index has nothing more to give.
+        k = top_k
+        while True:
+            rows, _ = self.ann_index.search(self.embeddings, query_embedding, k)
+            live = rows[self._alive[rows]] if self.num_deleted else rows
+            if len(live) >= top_k or len(rows) < k or k >= self.size:
+                return live[:top_k]
+            k = min(2 * k, self.size)
 
     def query(self, query_string: str, top_k: int) -> List[str]:
         """Returns the top k scored entries from the vector store."""
-        raw_embedding = self.model.get_embedding(query_string)
-        query_embedding = np.array(raw_embedding)
-
-        current_time = (
-            datetime.datetime.now().timestamp
-            if self.use_real_time
-            else self.time_counter
-        )
-
-        # Calculate the raw scores for each item.
-        scores = []
-        for item in self.items:
-            relevance = self.cosine_similarity(query_embedding, item.embedding)
-            # Decay rate of 0.99
-            recency = math.exp(-1 * (current_time - item.timestamp) * (1 - 0.99))
-            scores.append((relevance, recency, item.importance))
-
-        # Normalize the scores.
-        min_relevance = min(scores, key=lambda x: x[0])[0]
-        max_relevance = max(scores, key=lambda x: x[0])[0]
-        min_recency = min(scores, key=lambda x: x[1])[1]
-        max_recency = max(scores, key=lambda x: x[1])[1]
-        min_importance = min(scores, key=lambda x: x[2])[2]
-        max_importance = max(scores, key=lambda x: x[2])[2]
-        normalized_scores = [
-            (
-                (relevance - min_relevance) / (max_relevance - min_relevance) if max_relevance != min_relevance else 0.5,
-                (recency - min_recency) / (max_recency - min_recency) if max_recency != min_recency else 0.5,
-                (importance - min_importance) / (max_importance - min_importance) if max_importance != min_importance else 0.5,
-            )
-            for relevance, recency, importance in scores
-        ]
-        combined_scores = [
-            relevance + recency + importance
-            for relevance, recency, importance in normalized_scores
-        ]
-        scored_items = zip(combined_scores, self.items)
-        return [
-            item.value
-            for _, item in sorted(
-                scored_items, key=lambda tuple: tuple[0], reverse=True
-            )[:top_k]
-        ]
-    
+        return self.query_many([query_string], top_k)[0]
+
+    def query_many(self, query_strings: List[str], top_k: int, union: bool = False):
+        """Scores several queries like query(), with one embedding request for
+        all of them and one matrix-matrix product.
+
+        Returns the top k entries of each query. With union=True, also returns
+        the entries of all queries without duplicates, ordered by their best
+        rank in any query."""
+        query_strings = list(query_strings)
+        if self.empty() or not query_strings:
+            results = [[] for _ in query_strings]
+            return (results, []) if union else results
+        query_embeddings = np.asarray(self.model.get_embeddings(query_strings), dtype=np.float32)
+        query_norms = np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+        query_embeddings = query_embeddings / np.where(query_norms > 0, query_norms, 1)
+
+        with self._read_lock:
+            # (queries, items), so that each query's scores are contiguous.
+            similarities = (self.embeddings @ query_embeddings.T).T
+            current_time = self._current_time()
+            timestamps = self._timestamps[:self.size]
+            importances = self._importances[:self.size]
+            rows = self._live_rows()
+            if rows is not None:
+                similarities, timestamps, importances = similarities[:, rows], timestamps[rows], importances[rows]
+            # Recency decays by decay_rate per time unit since the item was added.
+            recency = np.exp(-(current_time - timestamps) * (1 - self.decay_rate))
+            relevance_weight, recency_weight, importance_weight = self.weights
+            # Recency and importance don't depend on the query, so they're
+            # scored once and broadcast across the queries.
+            shared = recency_weight * min_max_scale(recency) + importance_weight * min_max_scale(importances)
+            scores = relevance_weight * min_max_scale(similarities) + shared.astype(np.float32)
+            best = top_k_rows(scores, top_k)
+            if rows is not None:
+                best = rows[best]
+            np.add.at(self._accesses, best.ravel(), 1)
+            results = [[self.values[i] for i in ranked] for ranked in best]
+
+        if not union:
+            return results
+        # Rank-major order: every query's best entry first, then every second best...
+        merged = dict.fromkeys(value for ranked in zip(*results) for value in ranked)
+        return results, list(merged)
+
     def empty(self) -> bool:
         """Returns true if the vector store is empty."""
-        return len(self.items) == 0
+        return len(self) == 0
+
+
+def drain(pending: queue.Queue, max_items: int) -> list:
+    """Blocks for one item, then takes whatever else is already queued, up to
+    max_items in all. Stops after a STOP, so each worker takes its own."""
+    batch = [pending.get()]
+    while len(batch) < max_items and batch[-1] is not STOP:
+        try:
+            batch.append(pending.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def normalize(vector: np.ndarray) -> np.ndarray:
+    vector_norm = norm(vector)
+    return vector / vector_norm if vector_norm > 0 else vector
+
+
+def min_max_scale(scores: np.ndarray) -> np.ndarray:
+    """Scales scores (each row, for a matrix) to [0, 1], or to 0.5 where
+    they are all equal."""
+    low, high = scores.min(axis=-1, keepdims=True), scores.max(axis=-1, keepdims=True)
+    spread = high - low
+    return np.where(spread > 0, (scores - low) / np.where(spread > 0, spread, 1), 0.5)
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, highest first."""
+    if top_k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < len(scores):
+        # Partial selection is O(n); only the k winners get sorted.
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def top_k_rows(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """For an (m, n) matrix, the (m, min(top_k, n)) column indices of the
+    top_k highest scores in each row, highest first."""
+    num_rows, num_columns = scores.shape
+    top_k = min(top_k, num_columns)
+    if top_k <= 0:
+        return np.empty((num_rows, 0), dtype=np.int64)
+    sample_size = 4 * top_k
+    if num_columns >= SAMPLE_STRIDE * sample_size:
+        # The sample_size-th best score among every SAMPLE_STRIDE-th column is
+        # reached by at least sample_size columns, so only the few columns at
+        # or above it need ranking instead of partitioning every row in full.
+        sample = scores[:, ::SAMPLE_STRIDE]
+        kth = sample.shape[1] - sample_size
+        thresholds = np.partition(sample, kth, axis=1)[:, kth]
+        rows, columns = np.nonzero(scores >= thresholds[:, None])
+        order = np.lexsort((-scores[rows, columns], rows))
+        rows, columns = rows[order], columns[order]
+        starts = np.searchsorted(rows, np.arange(num_rows))
+        counts = np.diff(np.append(starts, len(rows)))
+        # NaN scores can leave a row short of candidates; those take the slow path.
+        if (counts >= top_k).all():
+            return columns[starts[:, None] + np.arange(top_k)]
+    if top_k < num_columns:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(num_columns), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
 
 
 if __name__ == "__main__":
-    vector_store = VectorStore()
-    vector_store.add("banana")
-    vector_store.add("apple")
-    vector_store.add("shoe")
-    print(vector_store.query("grapes", 2))
+    import time
+    from models.local_embedding import LocalEmbeddingModel
+
+    def bench(fn, repeat=20):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return sorted(times)[len(times) // 2]
+
+    rng = np.random.default_rng(0)
+    for num_items, dim in [(100_000, 256), (100_000, 1536)]:
+        vector_store = VectorStore("{} {}", "", embedding_model=LocalEmbeddingModel())
+        vectors = rng.standard_normal((num_items, dim), dtype=np.float32)
+        start = time.perf_counter()
+        for i, vector in enumerate(vectors):
+            vector_store._append(vector, f"memory {i}", i, 5)
+        insert = time.perf_counter() - start
+        query = rng.standard_normal(dim, dtype=np.float32)
+        items = vector_store.items
+
+        def query_loop():
+            # The previous implementation: a Python loop and a full argsort.
+            similarities = np.array([vector_store.cosine_similarity(query, item.embedding) for item in items])
+            return [items[i].value for i in reversed(similarities.argsort()[-10:])]
+
+        def query_matrix():
+            return [vector_store.values[i] for i in top_k_indices(vector_store.similarities(query), 10)]
+
+        assert query_loop() == query_matrix()
+        loop = bench(query_loop, repeat=3)
+        matrix = bench(query_matrix)
+        print(f"{num_items} items x {dim} dims: insert {insert / num_items * 1e6:.2f} us/item, "
+              f"query loop {loop * 1000:.1f} ms, matrix {matrix * 1000:.2f} ms ({loop / matrix:.0f}x)")
+
+    # Several sub-goal queries at once, against 100k memories.
+    vector_store = VectorStore("{} {}", "", embedding_model=LocalEmbeddingModel())
+    for i, vector in enumerate(rng.standard_normal((100_000, vector_store.model.dim), dtype=np.float32)):
+        vector_store._append(vector, f"memory {i}", i, i % 10)
+    vector_store.time_counter = 100_000
+    for num_queries in [1, 4, 16, 64]:
+        queries = [f"sub-goal {i}: find what the agent learned about topic {i}" for i in range(num_queries)]
+        assert vector_store.query_many(queries, 10) == [vector_store.query(query, 10) for query in queries]
+        one_by_one = bench(lambda: [vector_store.query(query, 10) for query in queries], repeat=3)
+        batched = bench(lambda: vector_store.query_many(queries, 10), repeat=3)
+        print(f"{num_queries:3d} queries: query x {num_queries} {one_by_one * 1000:8.1f} ms, "
+              f"query_many {batched * 1000:7.1f} ms ({batched / num_queries * 1000:.2f} ms/query, "
+              f"{one_by_one / batched:.1f}x)")
@@ -0,0 +1,35 @@
+import re
+
+import pytest
+
+from models.local_embedding import LocalEmbeddingModel
+from modules.memory_stores.vector_store import VectorStore
+
+
+class FixedRating:
+    """Stands in for the rating LLM: rates every memory 6, however many a
+    prompt batches."""
+
+    def generate_chat_completion(self, prompt):
+        batched = re.search(r"There are (\d+) numbered memories", prompt)
+        count = int(batched.group(1)) if batched else 1
+        return "\n".join(f"{i + 1}. FORMAT: 6" for i in range(count))
+
+
+@pytest.fixture
+def rating_llm():
+    return FixedRating()
+
+
+@pytest.fixture
+def make_store(rating_llm):
+    """Returns a function making VectorStores (or store_class) that embed
+    locally and rate with rating_llm, persistent if given a directory."""
+
+    def make(directory=None, store_class=VectorStore, **kwargs):
+        store = store_class("{} {}", "objective", embedding_model=LocalEmbeddingModel(),
+                            directory=directory, **kwargs)
+        store.llm = rating_llm
+        return store
+
+    return make
@@ -0,0 +1,57 @@
+import time
+
+from models.completion_cache import CompletionCache
+
+
+def request(prompt, **params):
+    return dict({"model": "gpt-4", "temperature": 0, "max_tokens": 100,
+                 "messages": [{"role": "user", "content": prompt}]}, **params)
+
+
+def response(text):
+    return {"choices": [{"index": 0, "message": {"role": "assistant", "content": text}}]}
+
+
+def test_key_ignores_transport_params():
+    assert CompletionCache.key(request("a")) == CompletionCache.key(request("a", stream=True, request_timeout=5))
+    assert CompletionCache.key(request("a")) != CompletionCache.key(request("b"))
+    assert CompletionCache.key(request("a")) != CompletionCache.key(request("a", functions=[{"name": "f"}]))
+
+
+def test_only_deterministic_requests_are_cacheable():
+    assert CompletionCache.cacheable(request("a"))
+    assert not CompletionCache.cacheable(request("a", temperature=0.7))
+    assert not CompletionCache.cacheable(request("a", stream=True))
+
+
+def test_get_and_put_persist(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = CompletionCache(path)
+    assert cache.get(request("a")) is None
+    cache.put(request("a"), response("A"))
+    assert cache.get(request("a")) == response("A")
+    assert CompletionCache(path).get(request("a")) == response("A")
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used_by_bytes(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+    cache.put(request("probe"), response("x" * 100))
+    entry_size = cache.stats()["bytes"]
+    cache.clear()
+
+    cache.max_bytes = 3 * entry_size
+    for prompt in ["a", "b", "c"]:
+        cache.put(request(prompt), response("x" * 100))
+        time.sleep(0.01)
+    # Reading "a" makes "b" the least recently used.
+    assert cache.get(request("a")) is not None
+    time.sleep(0.01)
+    cache.put(request("d"), response("x" * 100))
+
+    assert cache.stats()["bytes"] == 3 * entry_size
+    assert [cache.get(request(prompt)) is not None for prompt in "abcd"] == [True, False, True, True]
+
+    # Replacing an entry doesn't count it twice.
+    cache.put(request("d"), response("x" * 100))
+    assert cache.stats()["bytes"] == 3 * entry_size
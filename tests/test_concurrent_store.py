@@ -0,0 +1,97 @@
+import threading
+import time
+
+from modules.memory_stores.concurrent_store import ConcurrentVectorStore, ReadWriteLock
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    both_reading = threading.Barrier(2, timeout=5)
+
+    def read():
+        with lock.read:
+            both_reading.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_waiting_writer_goes_before_new_readers():
+    lock = ReadWriteLock()
+    order = []
+
+    def write():
+        with lock.write:
+            order.append("writer")
+
+    def read():
+        with lock.read:
+            order.append("reader")
+
+    lock.acquire_read()
+    writer = threading.Thread(target=write)
+    writer.start()
+    wait_until(lambda: lock._waiting_writers == 1)
+    reader = threading.Thread(target=read)
+    reader.start()
+    time.sleep(0.05)
+    # Neither gets in while the first reader holds the lock.
+    assert order == []
+    lock.release_read()
+    writer.join(5)
+    reader.join(5)
+    assert order == ["writer", "reader"]
+
+
+def test_write_side_is_reentrant_and_exclusive():
+    lock = ReadWriteLock()
+    read = threading.Event()
+
+    def reader():
+        with lock.read:
+            read.set()
+
+    with lock.write:
+        with lock.write:
+            thread = threading.Thread(target=reader)
+            thread.start()
+        # Still held once.
+        assert not read.wait(0.05)
+    assert read.wait(5)
+    thread.join()
+
+
+def test_queries_run_while_adding(make_store):
+    store = make_store(store_class=ConcurrentVectorStore)
+    ids = [store.add(f"memory {i} about topic {i % 5}") for i in range(50)]
+    errors = []
+
+    def query():
+        try:
+            for i in range(50):
+                results = store.query(f"topic {i % 5}", 3)
+                assert len(results) <= 3
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(50, 100):
+        ids.append(store.add(f"memory {i} about topic {i % 5}"))
+    for thread in threads:
+        thread.join()
+    store.flush()
+    assert errors == []
+    assert len(store) == 100 and ids == list(range(100))
+    store.close()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from models import embedding_cache
+from models.backend import Backend, set_backend
+from models.embedding import EmbeddingModel
+from models.embedding_cache import EmbeddingCache
+
+
+class FakeEmbeddingBackend(Backend):
+    """Embeds every text as a vector of dim ones."""
+    offline = True
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.requests = 0
+
+    def call(self, kind, request, fn):
+        self.requests += 1
+        return {"data": [{"index": i, "embedding": [1.0] * self.dim} for i, _ in enumerate(request["input"])]}
+
+
+@pytest.fixture
+def fake_backend():
+    backend = FakeEmbeddingBackend(4)
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+def test_put_and_reload(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many("model", ["a", "b"], np.arange(8, dtype=np.float32).reshape(2, 4))
+    assert cache.get("model", "c") is None and cache.get("other model", "a") is None
+    cache.close()
+    cache = EmbeddingCache(str(tmp_path))
+    assert cache.get_many("model", ["b", "a"])[0].tolist() == [4, 5, 6, 7]
+    cache.close()
+
+
+def test_rejects_other_dimension(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put("a", "text", np.ones(4))
+    with pytest.raises(ValueError):
+        cache.put("b", "text", np.ones(8))
+    cache.close()
+
+
+def test_directory_is_locked(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        EmbeddingCache(str(tmp_path))
+    cache.close()
+    EmbeddingCache(str(tmp_path)).close()
+
+
+def test_mismatched_cache_doesnt_fail_requests(tmp_path, fake_backend):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put("other", "text", np.ones(3))
+    model = EmbeddingModel(cache=cache)
+    assert model.get_embeddings(["text"]).shape == (1, 4)
+    assert model.get_embeddings(["text"]).shape == (1, 4)
+    assert fake_backend.requests == 2
+    cache.close()
+
+
+def test_default_cache_per_model(tmp_path, monkeypatch, fake_backend):
+    monkeypatch.setenv("OPENAGI_EMBEDDING_CACHE", str(tmp_path))
+    monkeypatch.setattr(embedding_cache, "_default_caches", {})
+    small, large = EmbeddingModel("small"), EmbeddingModel("large")
+    assert small.cache is not large.cache
+    assert small.get_embeddings(["text"]).shape == (1, 4)
+    fake_backend.dim = 8
+    assert large.get_embeddings(["text"]).shape == (1, 8)
+    assert small.get_embeddings(["text"]).shape == (1, 4)
+    assert fake_backend.requests == 2
+    small.cache.close()
+    large.cache.close()
@@ -0,0 +1,35 @@
+import pytest
+
+from modules.memory_stores import importance
+
+
+@pytest.mark.parametrize("text, count, expected", [
+    ("FORMAT: 7", 1, [7.0]),
+    ("format:3.5", 1, [3.5]),
+    ("1. FORMAT: 2\n2. FORMAT: 9\n3. FORMAT: 4", 3, [2.0, 9.0, 4.0]),
+    # Without FORMAT: markers, one rating per line.
+    ("1. 7\n2) 3\nMemory 3: 8/10", 3, [7.0, 3.0, 8.0]),
+    ("Ratings:\n6\n\n4", 2, [6.0, 4.0]),
+    ("I'd rate this an 8 out of 10.", 1, [8.0]),
+    # Out of range ratings are clamped.
+    ("1. FORMAT: 0\n2. FORMAT: 15", 2, [1.0, 10.0]),
+])
+def test_parse_ratings(text, count, expected):
+    assert importance.parse_ratings(text, count) == expected
+
+
+@pytest.mark.parametrize("text, count", [
+    ("I can't rate that.", 1),
+    ("1. FORMAT: 5\n2. FORMAT: 6", 3),
+    # Numbered lines without a rating after the number.
+    ("1.\n2.", 2),
+])
+def test_parse_ratings_unrecoverable(text, count):
+    assert importance.parse_ratings(text, count) == [None] * count
+
+
+def test_rating_prompt_batches_values():
+    prompt = importance.rating_prompt(lambda memory: f"Rate:\n{memory}", ["a", "b"])
+    assert prompt.startswith("Rate:\n1. a\n2. b")
+    assert "There are 2 numbered memories" in prompt
+    assert importance.rating_prompt(lambda memory: f"Rate: {memory}", ["a"]) == "Rate: a"
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from core.json_stream import IncrementalJSONParser, extract_json_object, parse_function_call
+
+
+def feed_chars(text: str) -> IncrementalJSONParser:
+    """Feeds text one character at a time, checking that the parser only
+    reports completion on the last one."""
+    parser = IncrementalJSONParser()
+    for i, char in enumerate(text):
+        assert parser.feed(char) == (i == len(text) - 1), text[:i + 1]
+    return parser
+
+
+@pytest.mark.parametrize("value", [
+    {"command": "echo '}'"},
+    {"command": "printf \"{\\n\""},
+    {"code": "print(\"a\\\\\")", "nested": {"list": [1, "]", {"x": "}}"}]}},
+    {"path": "C:\\"},
+    {"quote": "\"", "backslash": "\\", "both": "\\\""},
+])
+def test_strings_do_not_affect_nesting(value):
+    text = json.dumps(value)
+    assert feed_chars(text).value() == value
+
+
+def test_escape_split_across_fragments():
+    parser = IncrementalJSONParser()
+    assert not parser.feed('{"a": "x\\')
+    assert not parser.feed('"}')
+    assert parser.feed('"}')
+    assert parser.value() == {"a": 'x"}'}
+
+
+def test_trailing_text_is_kept():
+    parser = IncrementalJSONParser()
+    assert not parser.feed('  {"a": [1, 2]')
+    assert parser.feed('} done')
+    assert parser.feed(" and more")
+    assert parser.trailing == " done and more"
+    assert parser.value() == {"a": [1, 2]}
+
+
+def test_value_before_complete_raises():
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": "}')
+    with pytest.raises(ValueError):
+        parser.value()
+
+
+def test_extract_json_object_skips_invalid_candidates():
+    text = 'Using {curly braces} here.\n```json\n{"name": "Terminal", "args": {"cmd": "ls {}"}}\n```'
+    assert extract_json_object(text) == {"name": "Terminal", "args": {"cmd": "ls {}"}}
+    assert extract_json_object("no json at all") is None
+
+
+def test_parse_function_call():
+    assert parse_function_call('{"name": "Search", "query": "x"}') == {"name": "Search", "query": "x"}
+    assert parse_function_call('Sure:\n{"name": "Search", "query": "\\"quoted\\""}') == \
+        {"name": "Search", "query": '"quoted"'}
+    assert parse_function_call("{'name': 'Search', 'query': 'x'}") == {"name": "Search", "query": "x"}
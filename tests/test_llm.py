@@ -0,0 +1,142 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from aiohttp import web
+
+from models import llm
+from models.backend import Backend, set_backend
+from models.completion_cache import CompletionCache
+
+FUNCTIONS = [{"name": "Terminal", "parameters": {"type": "object", "properties": {"command": {"type": "string"}}}}]
+
+
+class FakeBackend(Backend):
+    """Answers every chat completion with a Terminal call, streamed or not."""
+    offline = True
+
+    def __init__(self):
+        self.requests = []
+
+    def call(self, kind, request, fn):
+        self.requests.append(request)
+        function_call = {"name": "Terminal", "arguments": '{"command": "ls"}'}
+        if request.get("stream"):
+            return [{"choices": [{"index": 0, "delta": delta}]} for delta in [
+                {"role": "assistant"},
+                {"function_call": {"name": "Terminal", "arguments": ""}},
+                {"function_call": {"arguments": '{"command": '}},
+                {"function_call": {"arguments": '"ls"}'}},
+            ]]
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": None,
+                                                     "function_call": function_call}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}}
+
+
+def test_streamed_completion_is_served_to_non_streamed_call(tmp_path):
+    backend = FakeBackend()
+    set_backend(backend)
+    try:
+        model = llm.LLM(cache=CompletionCache(str(tmp_path / "cache.sqlite")))
+        deltas = list(model.stream_chat_completion_with_functions("list files", functions=FUNCTIONS))
+        assert "".join(delta["function_call"]["arguments"] for delta in deltas) == '{"command": "ls"}'
+
+        message = model.generate_chat_completion_with_functions("list files", functions=FUNCTIONS)
+        assert message.function_call.name == "Terminal"
+        assert message.function_call.arguments == '{"command": "ls"}'
+        # And back as a stream.
+        replayed = list(model.stream_chat_completion_with_functions("list files", functions=FUNCTIONS))
+        assert replayed[0]["function_call"] == {"name": "Terminal", "arguments": '{"command": "ls"}'}
+        assert len(backend.requests) == 1
+    finally:
+        set_backend(None)
+
+
+class FakeOpenAI:
+    """An OpenAI-compatible /chat/completions server that echoes the last
+    message back, and counts how many requests it is serving at once."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+    async def chat_completions(self, request):
+        params = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        content = "echo:" + params["messages"][-1]["content"]
+        if not params.get("stream"):
+            return web.json_response({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 5, "total_tokens": 10},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for delta in [{"role": "assistant"}] + [{"content": char} for char in content]:
+            chunk = {"choices": [{"index": 0, "delta": delta}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+@pytest.fixture
+def fake_openai():
+    """A FakeOpenAI served from a background thread; its URL is api_base."""
+    server = FakeOpenAI()
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", server.chat_completions)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def start():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        return runner
+
+    runner = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    host, port = runner.addresses[0][:2]
+    server.api_base = f"http://{host}:{port}/v1"
+    yield server
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_async_gather_is_bounded(fake_openai):
+    async def main():
+        async with llm.AsyncLLM(max_concurrency=3, api_base=fake_openai.api_base, api_key="test") as model:
+            return await asyncio.gather(*[model.generate_chat_completion(f"prompt {i}") for i in range(12)])
+
+    assert asyncio.run(main()) == [f"echo:prompt {i}" for i in range(12)]
+    assert fake_openai.requests == 12
+    assert fake_openai.max_in_flight == 3
+
+
+def test_async_stream(fake_openai, tmp_path):
+    async def main(model):
+        return [chunk async for chunk in model.stream_chat_completion("hello")]
+
+    async def run():
+        async with llm.AsyncLLM(api_base=fake_openai.api_base, api_key="test",
+                                cache=CompletionCache(str(tmp_path / "cache.sqlite"))) as model:
+            streamed = await main(model)
+            replayed = await main(model)
+            stats = model.stream_stats[0]
+        return streamed, replayed, stats
+
+    streamed, replayed, stats = asyncio.run(run())
+    assert streamed == list("echo:hello")
+    # The second stream is served from the cache.
+    assert "".join(replayed) == "echo:hello" and fake_openai.requests == 1
+    assert stats.ttft is not None and stats.ttft >= fake_openai.delay
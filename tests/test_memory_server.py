@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from models.local_embedding import LocalEmbeddingModel
+from modules.memory_stores.memory_client import MemoryClient, RemoteVectorStore
+from modules.memory_stores.memory_server import MemoryServer, decode_frame, encode_frame
+
+
+def open_store(server, rating_llm, name="agent"):
+    server.run_batch([{"op": "open", "store": name, "importance_prompt": "{} {}", "objective": "o"}], [])
+    server.stores[name].llm = rating_llm
+    return server.stores[name]
+
+
+def test_bad_add_fails_alone(rating_llm):
+    server = MemoryServer(embedding_model=LocalEmbeddingModel())
+    store = open_store(server, rating_llm)
+    good = server.model.get_embeddings(["good"])[0]
+    results, _ = server.run_batch([
+        {"op": "add", "store": "agent", "value": "bad", "embedding": 0},
+        {"op": "add", "store": "agent", "value": "good", "embedding": 1},
+        {"op": "add", "store": "agent", "value": "good after bad"},
+        {"op": "flush", "store": "agent"},
+    ], [np.ones(3, dtype=np.float32), good])
+    assert "ValueError" in results[0]["error"]
+    assert results[1:3] == [0, 1]
+    store.flush()
+    assert len(store) == 2 and list(store.values) == ["good", "good after bad"]
+    store.close()
+
+
+def test_frame_round_trip():
+    arrays = [np.arange(6, dtype=np.float32).reshape(2, 3), np.empty((0,), dtype=np.float32), np.ones(4)]
+    header, decoded = decode_frame(encode_frame({"ops": [{"op": "len"}]}, arrays))
+    assert header == {"ops": [{"op": "len"}]}
+    assert [array.shape for array in decoded] == [(2, 3), (0,), (4,)]
+    for array, original in zip(decoded, arrays):
+        assert array.dtype == np.float32
+        np.testing.assert_array_equal(array, original)
+    assert decode_frame(encode_frame({}))[1] == []
+
+
+@pytest.fixture
+def served(tmp_path, rating_llm):
+    """A MemoryServer on a Unix socket, served from a background thread."""
+    server = MemoryServer(embedding_model=LocalEmbeddingModel())
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    address = f"unix:{tmp_path / 'memory.sock'}"
+    runner = asyncio.run_coroutine_threadsafe(server.start(address), loop).result()
+    client = MemoryClient(address)
+    yield server, client
+    client.close()
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_round_trip(served, rating_llm):
+    server, client = served
+    store = RemoteVectorStore("agent", "{} {}", "objective", client=client, dedup_threshold=0.99)
+    server.stores["agent"].llm = rating_llm
+    assert store.empty()
+
+    embedding = client.embed(["the sky is blue"])[0]
+    assert embedding.shape == (server.model.dim,)
+    ids = [store.add("the sky is blue", embedding), store.add("water is wet"), store.add("grass is green")]
+    assert ids == [0, 1, 2]
+    store.flush()
+    assert len(store) == 3
+    assert store.query_recent(2) == ["grass is green", "water is wet"]
+    assert store.query("water is wet", 1) == ["water is wet"]
+    assert store.query_many(["the sky is blue", "grass is green"], 1) == [["the sky is blue"], ["grass is green"]]
+
+    with pytest.raises(RuntimeError, match="isn't open"):
+        client.call({"op": "query", "store": "missing", "query": "x", "top_k": 1})
+    with pytest.raises(RuntimeError, match="Invalid store name"):
+        RemoteVectorStore("../escape", "{} {}", "objective", client=client)
+    with pytest.raises(RuntimeError, match="ValueError"):
+        store.add("wrong size", np.ones(3, dtype=np.float32))
+
+
+def test_operations_are_batched(served, rating_llm):
+    server, client = served
+    RemoteVectorStore("agent", "{} {}", "objective", client=client)
+    server.stores["agent"].llm = rating_llm
+    requests_sent = client.requests_sent
+    futures = client.submit([{"op": "add", "store": "agent", "value": f"fact {i}"} for i in range(100)])
+    assert sorted(future.result(5) for future in futures) == list(range(100))
+    # Sent together, in at most max_in_flight requests of up to max_batch_size.
+    assert client.requests_sent - requests_sent <= client.max_in_flight
+    client.call({"op": "flush", "store": "agent"})
+    assert client.call({"op": "len", "store": "agent"}) == 100
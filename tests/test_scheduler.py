@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+import pytest
+
+from models.scheduler import BACKGROUND, FOREGROUND, RequestScheduler
+
+
+def exhausted_scheduler(requests_per_minute=600):
+    """A scheduler with no requests left; one more is allowed every
+    60 / requests_per_minute seconds."""
+    scheduler = RequestScheduler(requests_per_minute=requests_per_minute, tokens_per_minute=10**9)
+    scheduler.request_bucket.tokens = 0
+    return scheduler
+
+
+def test_priority_order():
+    scheduler = exhausted_scheduler()
+    order = []
+
+    async def wait(name, priority):
+        await scheduler.acquire_async(1, priority)
+        order.append(name)
+
+    async def main():
+        background = [asyncio.create_task(wait(f"background {i}", BACKGROUND)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        foreground = asyncio.create_task(wait("foreground", FOREGROUND))
+        thread = threading.Thread(target=lambda: (scheduler.acquire(1, FOREGROUND), order.append("thread")))
+        await asyncio.sleep(0.01)
+        thread.start()
+        await asyncio.gather(foreground, *background)
+        await asyncio.to_thread(thread.join)
+
+    asyncio.run(main())
+    assert order == ["foreground", "thread", "background 0", "background 1"]
+    assert scheduler.queue_depth() == 0 and scheduler.total_requests == 4
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    scheduler = exhausted_scheduler()
+
+    async def main():
+        waiter = asyncio.create_task(scheduler.acquire_async(1))
+        await asyncio.sleep(0.01)
+        assert scheduler.queue_depth() == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.queue_depth() == 0
+        scheduler.request_bucket.tokens = 1
+        await asyncio.wait_for(scheduler.acquire_async(1), 1)
+
+    asyncio.run(main())
+
+
+def test_interrupted_waiter_leaves_the_queue():
+    scheduler = exhausted_scheduler(requests_per_minute=60)
+
+    def interrupted(timeout=None):
+        raise KeyboardInterrupt
+
+    scheduler._cond.wait = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.acquire(1)
+    assert scheduler.queue_depth() == 0
+
+
+def test_many_async_waiters_need_no_threads():
+    scheduler = RequestScheduler(requests_per_minute=600, tokens_per_minute=10**9)
+    threads = threading.active_count()
+
+    async def main():
+        await asyncio.gather(*[scheduler.acquire_async(1) for _ in range(500)])
+
+    asyncio.run(main())
+    assert threading.active_count() == threads
+    assert scheduler.total_requests == 500
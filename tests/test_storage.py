@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+
+from modules.memory_stores import storage
+
+
+def test_append_log_replay(tmp_path):
+    path = str(tmp_path / storage.LOG_FILE)
+    log = storage.AppendLog(path)
+    log.append(storage.ADD, 0, np.arange(4, dtype=np.float32), "first", timestamp=1.0, importance=3.0)
+    log.append(storage.PENDING, 1, value="héllo", timestamp=2.0)
+    log.append(storage.UPDATE, 0, importance=7.0)
+    log.append(storage.DELETE, 1)
+    log.close()
+
+    records = list(storage.AppendLog.replay(path))
+    assert [(kind, item_id) for kind, item_id, *_ in records] == \
+        [(storage.ADD, 0), (storage.PENDING, 1), (storage.UPDATE, 0), (storage.DELETE, 1)]
+    _, _, embedding, value, timestamp, importance = records[0]
+    assert embedding.tolist() == [0, 1, 2, 3] and value == "first" and (timestamp, importance) == (1.0, 3.0)
+    assert records[1][2] is None and records[1][3] == "héllo"
+    # An importance-only update carries no value or embedding.
+    assert records[2][2] is None and records[2][3] is None and records[2][5] == 7.0
+    assert np.isnan(records[3][5])
+
+
+def test_append_log_truncates_torn_record(tmp_path):
+    path = str(tmp_path / storage.LOG_FILE)
+    log = storage.AppendLog(path)
+    log.append(storage.ADD, 0, np.ones(8, dtype=np.float32), "kept", timestamp=0.0, importance=5.0)
+    log.close()
+    complete = os.path.getsize(path)
+    log = storage.AppendLog(path)
+    log.append(storage.ADD, 1, np.ones(8, dtype=np.float32), "torn", timestamp=1.0, importance=5.0)
+    log.close()
+    # A crash in the middle of writing the second record.
+    os.truncate(path, complete + storage.RECORD_HEADER.size + 10)
+
+    assert [value for _, _, _, value, _, _ in storage.AppendLog.replay(path)] == ["kept"]
+    assert os.path.getsize(path) == complete
+    # Records appended after the truncation are read back normally.
+    log = storage.AppendLog(path)
+    log.append(storage.DELETE, 0)
+    log.close()
+    assert [kind for kind, *_ in storage.AppendLog.replay(path)] == [storage.ADD, storage.DELETE]
+
+
+def test_append_log_torn_header(tmp_path):
+    path = str(tmp_path / storage.LOG_FILE)
+    with open(path, "wb") as f:
+        f.write(b"\x00" * (storage.RECORD_HEADER.size - 1))
+    assert list(storage.AppendLog.replay(path)) == []
+    assert os.path.getsize(path) == 0
+
+
+def test_string_array():
+    strings = storage.StringArray()
+    for value in ["a", "", "ünï", "last"]:
+        strings.append(value)
+    data, offsets = strings.buffers()
+    loaded = storage.StringArray(data, offsets)
+    loaded.append("tail")
+    loaded[2] = "replaced"
+    assert list(loaded) == ["a", "", "replaced", "last", "tail"]
+    assert list(loaded.take(np.array([4, 0, 2]))) == ["tail", "a", "replaced"]
+
+
+def test_snapshot_generations(tmp_path):
+    directory = str(tmp_path)
+    arrays = {name: np.arange(3) for name in storage.ARRAY_FILES}
+    assert storage.write_snapshot(directory, arrays, {"size": 3}) == 0
+    assert storage.write_snapshot(directory, arrays, {"size": 3}) == 1
+    assert storage.current_generation(directory) == 1
+    assert not os.path.exists(storage.generation_path(directory, 0))
+    loaded, meta = storage.read_snapshot(directory, 1)
+    assert meta == {"size": 3} and loaded["ids"].tolist() == [0, 1, 2]
+
+
+def test_store_reloads_from_snapshot_and_log(tmp_path, make_store):
+    directory = str(tmp_path)
+    store = make_store(directory)
+    for i in range(5):
+        store.add(f"saved memory {i}")
+    store.flush()
+    store.save()
+    # Logged after the snapshot, so only in the append log.
+    store.add("logged memory")
+    store.flush()
+    store.close()
+
+    store = make_store(directory)
+    store.flush()
+    assert list(store.values) == [f"saved memory {i}" for i in range(5)] + ["logged memory"]
+    assert store._ids[:store.size].tolist() == list(range(6))
+    assert store.next_id == 6
+    assert store.query("logged memory", 1) == ["logged memory"]
+    store.close()
+
+
+def test_store_retries_values_added_before_a_crash(tmp_path, make_store):
+    directory = str(tmp_path)
+    store = make_store(directory)
+    store.add("embedded")
+    store.flush()
+    # A crash after add() logged the value but before it was embedded.
+    with store._lock:
+        store._log.append(storage.PENDING, store.next_id, value="never embedded", timestamp=store.time_counter)
+
+    reloaded = make_store(directory)
+    reloaded.flush()
+    assert list(reloaded.values) == ["embedded", "never embedded"]
+    reloaded.close()
+    store.close()
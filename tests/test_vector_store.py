@@ -0,0 +1,223 @@
+import gc
+import shutil
+import threading
+import weakref
+
+import numpy as np
+import pytest
+
+from models.local_embedding import LocalEmbeddingModel
+from modules.memory_stores.vector_store import normalize
+
+
+def add_all(store, values):
+    ids = [store.add(value) for value in values]
+    store.flush()
+    return ids
+
+
+def contents(store):
+    """(id, value, importance, count) of every live item."""
+    return [(int(store._ids[row]), store.values[row], float(store._importances[row]), int(store._counts[row]))
+            for row in range(store.size) if store._alive[row]]
+
+
+def embedding_of(store, item_id):
+    return np.asarray(store.embeddings[store._row(item_id)], dtype=np.float32)
+
+
+def test_delete_update_and_merge(make_store):
+    store = make_store(dedup_threshold=0.99)
+    ids = add_all(store, ["the sky is blue", "water is wet", "grass is green"])
+    assert store.delete(ids[0])
+    assert not store.delete(ids[0])
+    assert store.get(ids[0]) is None
+    assert store.update(ids[1], value="fire is hot")
+    assert store.update(ids[2], importance=9)
+    assert not store.update(12345, importance=1)
+    add_all(store, ["grass is green"])
+
+    assert len(store) == 2
+    assert store.get(ids[1]) == "fire is hot"
+    assert store.query_relevance("fire is hot", 1, mode="vector") == ["fire is hot"]
+    assert [(item_id, importance, count) for item_id, _, importance, count in contents(store)] == \
+        [(ids[1], 6.0, 1), (ids[2], 9.0, 2)]
+
+
+def test_changes_survive_reload_from_log_and_snapshot(tmp_path, make_store):
+    directory = str(tmp_path)
+    store = make_store(directory, dedup_threshold=0.99)
+    ids = add_all(store, [f"memory number {i}" for i in range(6)])
+    store.save()
+    store.delete(ids[0])
+    store.update(ids[1], value="an updated memory", importance=2)
+    store.update(ids[2], importance=8)
+    add_all(store, ["memory number 3"])
+    expected = contents(store)
+    updated_embedding = embedding_of(store, ids[1])
+    # The merged duplicate used up an id too.
+    next_id = store.next_id
+    store.close()
+
+    # Replayed from the append log on top of the first snapshot.
+    store = make_store(directory, dedup_threshold=0.99)
+    assert contents(store) == expected
+    np.testing.assert_allclose(embedding_of(store, ids[1]), updated_embedding, atol=1e-6)
+    store.save()
+    store.close()
+
+    # Read from the second snapshot, which only has the live items.
+    store = make_store(directory, dedup_threshold=0.99)
+    assert contents(store) == expected
+    assert store.size == len(expected) and store.num_deleted == 0
+    assert store.next_id == next_id
+    assert store.add("a new memory") == next_id
+    store.close()
+
+
+def test_compaction(make_store):
+    store = make_store()
+    ids = add_all(store, [f"fact {i} about topic {i % 7}" for i in range(40)])
+    for item_id in ids[::2]:
+        store.delete(item_id)
+    expected = contents(store)
+    store.compact()
+
+    assert contents(store) == expected
+    assert store.size == 20 and store.num_deleted == 0
+    for item_id, value, _, _ in expected:
+        assert store.get(item_id) == value
+    assert store.query_relevance("fact 13 about topic 6", 1, mode="vector") == ["fact 13 about topic 6"]
+
+
+class HookedArray(np.ndarray):
+    """Runs a callback the first time it is indexed, i.e. while compaction
+    is copying the embedding matrix outside the store's lock."""
+
+    def __getitem__(self, index):
+        callback, self.callback = getattr(self, "callback", None), None
+        if callback is not None:
+            callback()
+        return super().__getitem__(index)
+
+
+def test_compaction_with_changes_during_copy(tmp_path, make_store):
+    directory = str(tmp_path)
+    store = make_store(directory)
+    ids = add_all(store, [f"fact {i} about topic {i % 7}" for i in range(20)])
+    for item_id in ids[:10:2]:
+        store.delete(item_id)
+
+    def change():
+        store.update(ids[11], value="a completely different memory")
+        store.update(ids[13], importance=10)
+        store.delete(ids[15])
+        add_all(store, ["added during compaction"])
+
+    raw_embeddings = store._raw_embeddings
+
+    def hooked():
+        embeddings = raw_embeddings().view(HookedArray)
+        embeddings.callback = change
+        return embeddings
+
+    store._raw_embeddings = hooked
+    store.compact()
+    del store._raw_embeddings
+
+    expected_ids = [item_id for item_id in ids if item_id not in ids[:10:2] + [ids[15]]] + [20]
+    assert [item_id for item_id, _, _, _ in contents(store)] == expected_ids
+    assert store.get(ids[11]) == "a completely different memory"
+    assert store.get(20) == "added during compaction"
+    assert contents(store)[expected_ids.index(ids[13])][2] == 10.0
+    # The update's new embedding wasn't lost to the stale copy.
+    new_embedding = normalize(LocalEmbeddingModel().get_embeddings(["a completely different memory"])[0])
+    np.testing.assert_allclose(embedding_of(store, ids[11]), new_embedding, atol=1e-6)
+    assert store.query_relevance("a completely different memory", 1, mode="vector") == \
+        ["a completely different memory"]
+    # The delete made during the copy is still a tombstone.
+    assert store.num_deleted == 1 and store.get(ids[15]) is None
+
+    expected = contents(store)
+    store.close()
+    store = make_store(directory)
+    assert contents(store) == expected
+    store.close()
+
+
+class OneBadEmbedding(LocalEmbeddingModel):
+    """Returns an embedding of the wrong size for "bad"."""
+
+    def get_embeddings(self, texts):
+        embeddings = list(super().get_embeddings(texts))
+        return [np.ones(3, dtype=np.float32) if text == "bad" else embedding
+                for text, embedding in zip(texts, embeddings)]
+
+
+def test_wrong_embedding_size_only_drops_that_item(make_store):
+    store = make_store()
+    store.model = OneBadEmbedding()
+    with pytest.raises(ValueError):
+        store.add("given", np.ones(3, dtype=np.float32))
+    store.add("good before bad")
+    store.add("bad")
+    store.add("good after bad")
+    with pytest.raises(RuntimeError):
+        store.flush()
+    assert list(store.values) == ["good before bad", "good after bad"]
+    store.flush()
+
+
+class GatedEmbedding(LocalEmbeddingModel):
+    """Blocks the embedding thread until released; other calls go through."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def get_embeddings(self, texts):
+        if threading.current_thread() is not threading.main_thread():
+            self.release.wait()
+        return super().get_embeddings(texts)
+
+
+def test_delete_and_update_before_insertion(tmp_path, make_store):
+    directory = str(tmp_path / "store")
+    store = make_store(directory)
+    store.model = GatedEmbedding()
+    deleted = store.add("deleted before insertion")
+    updated = store.add("original value")
+    rated = store.add("rated before insertion")
+    assert store.delete(deleted)
+    assert not store.delete(deleted)
+    assert store.update(updated, value="updated value")
+    assert store.update(rated, importance=9)
+
+    # A crash before anything was inserted: the log has it all.
+    reloaded = make_store(shutil.copytree(directory, str(tmp_path / "crashed")))
+    reloaded.flush()
+    assert [(item_id, value, importance) for item_id, value, importance, _ in contents(reloaded)] == \
+        [(updated, "updated value", 6.0), (rated, "rated before insertion", 9.0)]
+    reloaded.close()
+
+    store.model.release.set()
+    store.flush()
+    assert store.get(deleted) is None
+    assert store.get(updated) == "updated value"
+    assert store.query_relevance("updated value", 1, mode="vector") == ["updated value"]
+    assert [(item_id, importance) for item_id, _, importance, _ in contents(store)] == [(updated, 6.0), (rated, 9.0)]
+    store.close()
+
+
+def test_close_stops_worker_threads(make_store):
+    workers, stores = [], []
+    for i in range(5):
+        store = make_store()
+        add_all(store, [f"memory {i}"])
+        workers += store._workers
+        store.close()
+        stores.append(weakref.ref(store))
+    del store
+    gc.collect()
+    assert workers and not any(worker.is_alive() for worker in workers)
+    assert all(store() is None for store in stores)
@@ -7,13 +7,12 @@ This tool ingests a set of documents, stores chunks in a vector store, and then
 allows the agent to query the vector store for similar chunks.
 """
 
-import tiktoken
+from models import tokens
 
 
 def count_tokens(text: str) -> int:
     """Use tiktoken to count the number of tokens in a text."""
-    enc = tiktoken.encoding_for_model("gpt-4")
-    return len(enc.encode(text))
+    return tokens.count_tokens(text, "gpt-4")
 
 
 if __name__ == "__main__":
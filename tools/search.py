@@ -20,7 +20,7 @@ SERP_API_BASE_URL = "https://serpapi.com/search"
 
 class SearchTool(BaseTool):
     def __init__(self):
-        self.api_key = os.environ["SERP_API_KEY"]
+        self.api_key = os.environ.get("SERP_API_KEY")
         self.base_url = SERP_API_BASE_URL
         
         # Variables set by parse_input
@@ -10,7 +10,7 @@ from collections import namedtuple
 import os
 from serpapi import GoogleSearch
 from core.tool import BaseTool, InputSpec, OutputSpec
-import multiprocessing
+from multiprocessing.pool import ThreadPool
 from itertools import repeat
 
 
@@ -35,6 +35,7 @@ import re
 import requests
 from core.tool import BaseTool, InputSpec, OutputSpec
 from models import llm
+from models.scheduler import BACKGROUND
 
 MAX_CHUNKS_PER_PAGE = 5
 
@@ -117,7 +118,7 @@ def process_article(args, dir_name='data'):
 
 def summarize_qa(text, query, objective, num_sentences=5):
     # Use llm to get the answer to the query based on the text.
-    model = llm.LLM(model='gpt-3.5-turbo', max_tokens=200)
+    model = llm.LLM(model='gpt-3.5-turbo', max_tokens=200, priority=BACKGROUND)
     prompt = f"""
 Using the following text and query, provide only output that helps the user answer the query or meet the objective.
 You may use up to {num_sentences} sentences in your output.
@@ -138,7 +139,7 @@ Objective: {objective}
 
 class SearchBrowseTool(BaseTool):
     def __init__(self):
-        self.api_key = os.environ["SERP_API_KEY"]
+        self.api_key = os.environ.get("SERP_API_KEY")
         self.base_url = SERP_API_BASE_URL
         
         # Variables set by parse_input
@@ -175,18 +176,18 @@ class SearchBrowseTool(BaseTool):
     def run(self):
         search_results = self.search_query(self.query, self.num_results)
 
-        # Fork processes to call the browse tool on each URL
-        # Define the number of processes to use
-        num_processes = 5
-        # Create a pool of processes
-        pool = multiprocessing.Pool(processes=num_processes)
-        # Map the function to the list of articles using the pool of processes
+        # Call the browse tool on each URL in parallel. Threads (rather than
+        # processes) share the process-wide request scheduler, so the workers
+        # stay within the rate limits together.
+        num_threads = 5
+        pool = ThreadPool(processes=num_threads)
+        # Map the function to the list of articles using the pool of threads
         results = pool.imap_unordered(process_article, zip(search_results, repeat(self.query), repeat(self.objective)))
 
         # Collect the output in a list
         output = list(results)
 
-        # Close the pool of processes
+        # Close the pool of threads
         pool.close()
 
         # Print the output
@@ -9,13 +9,14 @@ TODO: make this generic beyond just webpage content.
 
 
 import json
-import openai
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
 )
 from core.tool import BaseTool, InputSpec, OutputSpec
+from models.backend import get_backend
+from models.scheduler import BACKGROUND, estimate_tokens, get_scheduler
 
 summarize_prompt = """
 You are an expert summarizer. Your goal is to summarize the user's content as truthfully and concisely as possible.
@@ -67,7 +68,7 @@ Current date: 2023-04-14
 
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
 def get_summary(title, url, text, prompt=summarize_prompt):
-    completion = openai.ChatCompletion.create(
+    params = dict(
         model="gpt-3.5-turbo",
         messages=[{"role": "system", "content": prompt},
                   {"role": "user", "content": f"Title: {title}"},
@@ -75,6 +76,11 @@ def get_summary(title, url, text, prompt=summarize_prompt):
                   {"role": "user", "content": f"Raw Text: ```{text}```"},
                   ]
     )
+    backend = get_backend()
+    if not backend.offline:
+        # Page summaries are background work, so they wait behind agent calls.
+        get_scheduler().acquire(estimate_tokens(params), BACKGROUND)
+    completion = backend.chat_completion(params)
 
     print(completion.choices[0].message.content)
     return completion.choices[0].message.content